@@ -1,14 +1,20 @@
+import argparse
 import os
+from datetime import datetime
 from urllib.parse import urlparse, unquote
 from zipfile import ZipFile
 
 import requests
 
-from loaders import WESADLoader
+from cache import ResponseCache
+from catalog import Catalog
 from connector import FHIRConnector
-from loaders.load_sdn import SDNLoader
-from loaders.load_srad import SRADLoader
-from loaders.load_wspcp import WSPCPLoader
+from jobqueue import JobQueue, coordinate, work
+from loaders import LOADERS, get_loader
+from loaders.selection import Selection
+from metrics import metrics, progress
+from routing import RoutingConnector, get_partition_urls
+from scheduler import Scheduler
 from static_resources.device_definition.empatica_e4 import crate_empatica_definitions
 from static_resources.device_definition.respiban import create_respiban_definitions
 from static_resources.device_definition.srad_recorder import create_srad_recorder_definitions
@@ -16,15 +22,28 @@ from static_resources.questionnaires.dim import crate_sam_questionnaire
 from static_resources.questionnaires.panas import crate_panas_questionnaire
 from static_resources.questionnaires.sssq import crate_sssq_questionnaire
 from static_resources.questionnaires.stai import crate_stai_questionnaire
+from static_resources.search_parameters.codex import create_codex_search_parameters
 from utils import get_file_name
 
 
-def init_fhir_server():
-    smart = FHIRConnector('http://localhost:8080/fhir')
-    return smart
+def init_fhir_server(urls=None, partitions=None, route_by="participant", cache_dir=None):
+    """Returns the connector of the FHIR server at `urls[0]` or, given several URLs or the names of the `partitions`
+    of the servers, a `RoutingConnector` spreading the participants over them. Reads go through a `ResponseCache`,
+    kept on disk in `cache_dir` if given, which the processes of an ingest may share."""
+    urls = urls or ['http://localhost:8080/fhir']
+    if partitions:
+        urls = [partition_url for url in urls for partition_url in get_partition_urls(url, partitions)]
+
+    cache = ResponseCache(directory=cache_dir)
+    if len(urls) == 1:
+        return FHIRConnector(urls[0], cache=cache)
+
+    return RoutingConnector(urls, key=route_by, cache=cache)
 
 
 def load_static_resources(server):
+    # Search parameters go first, so the server indexes the tags of every resource created afterwards.
+    create_codex_search_parameters(server)
     crate_empatica_definitions(server)
     create_respiban_definitions(server)
     create_srad_recorder_definitions(server)
@@ -34,69 +53,228 @@ def load_static_resources(server):
     crate_sam_questionnaire(server)
 
 
-def get_datasets(datasets_base_path):
+DATASET_URLS = dict(SDN=("https://datadryad.org/stash/downloads/file_stream/1022493",
+                          "https://datadryad.org/stash/downloads/file_stream/1022492"),
+                    SRAD=("https://physionet.org/static/published-projects/" \
+                          "drivedb/stress-recognition-in-automobile-drivers-1.0.0.zip",),
+                    WESAD=("https://uni-siegen.sciebo.de/s/HGdUkoNlW1Ub0Gx/download",),
+                    WSPCP=("https://physionet.org/static/published-projects/wearable-exam-stress/"
+                           "a-wearable-exam-stress-dataset-for-predicting-cognitive-performance-in-real-world-settings-1.0.0.zip",))
+
+
+def download_dataset(datasets_base_path, dataset):
+    """Downloads the files of `dataset` that are not available yet. Returns the paths of its zip files."""
+    dataset_path = os.path.join(datasets_base_path, dataset)
+    if not os.path.exists(dataset_path):
+        print(f"Creating dataset path: {dataset_path}")
+        os.makedirs(dataset_path, exist_ok=True)
+
+    zip_files = []
+    for u in DATASET_URLS[dataset]:
+        r = requests.get(u, allow_redirects=True, stream=True)
+        content_disposition = r.headers.get("content-disposition")
+        content_type = r.headers.get("content-type")
+        content_length = int(r.headers.get("content-length"))
+        file_name = urlparse(r.request.url).path.split("/")[-1]
+        if content_disposition is not None:
+            file_name = get_file_name(content_disposition)
+
+        file_name = os.path.join(dataset_path, f"{file_name}")
+        if not os.path.exists(file_name):
+            print(f"Downloading {file_name}:", end="")
+            with open(file_name, "wb") as zip_file:
+                for chunk in r.iter_content(chunk_size=content_length//20):
+                    zip_file.write(chunk)
+                    print(".", end="")
+
+            print()
+
+        if content_type == "application/zip":
+            zip_files.append(file_name)
+
+    return zip_files
+
+
+def unzip_dataset(dataset_path, zip_files):
+    tale = os.path.join(dataset_path, "unzipped")
+    if os.path.exists(tale):
+        return
+
+    for file_name in zip_files:
+        print(f"Unzipping {os.path.basename(file_name)}")
+        with ZipFile(file_name) as zip_io:
+            zip_io.extractall(dataset_path)
+
+    if zip_files:
+        with open(tale, "w") as file:
+            file.write("".join(f"{file_name}\n" for file_name in zip_files))
+
+
+def get_datasets(datasets_base_path, datasets=None):
+    """Downloads and unzips the given datasets (all by default) that are not available yet."""
     os.makedirs(datasets_base_path, exist_ok=True)
+    for dataset in DATASET_URLS:
+        if datasets is not None and dataset not in datasets:
+            continue
+
+        zip_files = download_dataset(datasets_base_path, dataset)
+        unzip_dataset(os.path.join(datasets_base_path, dataset), zip_files)
+
 
-    urls = dict(SDN=("https://datadryad.org/stash/downloads/file_stream/1022493",
-                     "https://datadryad.org/stash/downloads/file_stream/1022492"),
-                SRAD=("https://physionet.org/static/published-projects/" \
-                      "drivedb/stress-recognition-in-automobile-drivers-1.0.0.zip",),
-                WESAD=("https://uni-siegen.sciebo.de/s/HGdUkoNlW1Ub0Gx/download",),
-                WSPCP=("https://physionet.org/static/published-projects/wearable-exam-stress/"
-                       "a-wearable-exam-stress-dataset-for-predicting-cognitive-performance-in-real-world-settings-1.0.0.zip",))
+def schedule_datasets(scheduler, server, catalog, datasets, datasets_base_path="./datasets", queue=None,
+                      selection=None):
+    """Adds the tasks loading `datasets` to `scheduler`. Each dataset is downloaded, unzipped, loaded once the static
+    resources are on the server, and its EvidenceReport written after its data, independently of the other datasets:
 
-    for dataset, url in urls.items():
+        download -> unzip -> load -> report
+                  static resources /
+
+    If a job `queue` is given, the participants are loaded by the workers of the queue (see `jobqueue.py`), the load
+    task coordinating them and writing the report. A `selection` (see `loaders.selection`) restricts the load to a
+    part of the datasets."""
+    os.makedirs(datasets_base_path, exist_ok=True)
+    static_resources = scheduler.add("static resources", load_static_resources, server)
+    for dataset in datasets:
         dataset_path = os.path.join(datasets_base_path, dataset)
-        if not os.path.exists(dataset_path):
-            print(f"Creating dataset path: {dataset_path}")
-            os.mkdir(dataset_path)
-
-        for u in url:
-            r = requests.get(u, allow_redirects=True, stream=True)
-            content_disposition = r.headers.get("content-disposition")
-            content_type = r.headers.get("content-type")
-            content_length = int(r.headers.get("content-length"))
-            file_name = urlparse(r.request.url).path.split("/")[-1]
-            if content_disposition is not None:
-                file_name = get_file_name(content_disposition)
-
-            file_name = os.path.join(dataset_path, f"{file_name}")
-            if not os.path.exists(file_name):
-                print(f"Downloading {file_name}:", end="")
-                with open(file_name, "wb") as zip_file:
-                    for chunk in r.iter_content(chunk_size=content_length//20):
-                        zip_file.write(chunk)
-                        print(".", end="")
-
-                print()
-
-            if content_type == "application/zip":
-                tale = os.path.join(dataset_path, "unzipped")
-                if os.path.exists(tale):
-                    continue
-
-                print(f"Unzipping {os.path.basename(file_name)}")
-                with ZipFile(file_name) as zip_io:
-                    zip_io.extractall(dataset_path)
-
-                with open(tale, "w") as file:
-                    file.write(f"{file_name}\n")
-
-
-def main():
-    smart = init_fhir_server()
-    get_datasets("./datasets")
-    dataset_loaders = [
-        WESADLoader("datasets/WESAD", smart),
-        WSPCPLoader("datasets/WSPCP", smart),
-        SDNLoader("datasets/SDN", smart),
-        SRADLoader("datasets/SRAD", smart)
-    ]
-
-    load_static_resources(smart)
-    for data_loader in dataset_loaders:
-        data_loader.load_dataset()
+        loader = get_loader(dataset, dataset_path, server, catalog=catalog, selection=selection)
+        download = scheduler.add(f"download {dataset}", download_dataset, datasets_base_path, dataset,
+                                 pool="download")
+        unzip = scheduler.add(f"unzip {dataset}", lambda path=dataset_path, download=download:
+                              unzip_dataset(path, scheduler.result(download)), after=[download])
+        if queue is not None:
+            scheduler.add(f"load {dataset}", coordinate, queue, dataset, loader, after=[unzip, static_resources],
+                          pool="load")
+            continue
+
+        load = scheduler.add(f"load {dataset}", loader.load_data, after=[unzip, static_resources], pool="load")
+        scheduler.add(f"report {dataset}", loader.load_results, after=[load])
+
+
+def run_worker(server, queue, datasets_base_path="./datasets", selection=None):
+    """Loads the participants leased from `queue`, downloading their datasets if needed, until the queue stays empty.
+    The catalog rows of the participants are sent to the coordinator with the results. Workers must be given the
+    `selection` of the coordinator, the queue only holding participants."""
+    catalog = Catalog(":memory:")
+
+    def get_dataset_loader(dataset):
+        get_datasets(datasets_base_path, [dataset])
+        return get_loader(dataset, os.path.join(datasets_base_path, dataset), server, catalog=catalog,
+                          selection=selection)
+
+    done = work(queue, get_dataset_loader)
+    print(f"Loaded {done} participants")
+
+
+def main(datasets=None, metrics_path="codex_metrics.prom", metrics_port=None, catalog_path="datasets/catalog.sqlite",
+         max_workers=8, download_workers=2, load_workers=4, coordinator=None, worker=None, lease_seconds=300,
+         urls=None, partitions=None, route_by="participant", selection=None, cache_dir=None):
+    """Loads the given datasets (all by default), only their loaders are imported. Metrics are written to
+    `metrics_path` at the end of the run and, when `metrics_port` is given, served in the Prometheus text format while
+    the ingest runs. The uploaded signals are indexed in the SQLite catalog at `catalog_path`.
+
+    Datasets are downloaded and loaded concurrently (see `schedule_datasets`), by at most `max_workers` tasks, of
+    which at most `download_workers` downloads and `load_workers` loads.
+
+    With `coordinator`, the path of a job queue shared with workers, the participants are loaded by the workers. With
+    `worker`, this process is one of the workers and loads the participants of the queue at that path instead.
+
+    The resources are uploaded to the FHIR server at `urls` or spread over several servers or partitions, see
+    `init_fhir_server`, reads being cached in `cache_dir`. Only the part of the datasets in `selection` is loaded, see
+    `loaders.selection`."""
+    datasets = list(LOADERS) if not datasets else datasets
+    unknown = [dataset for dataset in datasets if dataset not in LOADERS]
+    if unknown:
+        raise RuntimeError(f"Unknown datasets {', '.join(unknown)}, available datasets: {', '.join(LOADERS)}")
+
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+
+    smart = init_fhir_server(urls, partitions, route_by, cache_dir)
+    catalog = None
+    queue = None
+    try:
+        if worker is not None:
+            queue = JobQueue(worker, lease_seconds)
+            run_worker(smart, queue, selection=selection)
+            return
+
+        if coordinator is not None:
+            queue = JobQueue(coordinator, lease_seconds)
+
+        catalog = Catalog(catalog_path)
+        scheduler = Scheduler(max_workers, limits=dict(download=download_workers, load=load_workers))
+        schedule_datasets(scheduler, smart, catalog, datasets, queue=queue, selection=selection)
+        scheduler.run()
+
+    finally:
+        if catalog is not None:
+            catalog.close()
+
+        if queue is not None:
+            queue.close()
+
+        if isinstance(smart, RoutingConnector):
+            smart.close()
+
+        progress.report()
+        metrics.export(metrics_path)
+
+
+def parse_time(value):
+    """Parses a time of the selection: an ISO datetime, or a number of seconds from the beginning of recordings."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value)
+
+
+def get_selection(arguments):
+    return Selection(arguments.participants, arguments.devices, arguments.modalities, arguments.sessions,
+                     arguments.labels, arguments.start, arguments.end)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Loads stress detection datasets into a FHIR server.")
+    parser.add_argument("datasets", nargs="*", metavar="DATASET",
+                        help=f"datasets to load ({', '.join(LOADERS)}), all by default")
+    parser.add_argument("--metrics-path", default="codex_metrics.prom")
+    parser.add_argument("--metrics-port", type=int)
+    parser.add_argument("--catalog-path", default="datasets/catalog.sqlite")
+    parser.add_argument("--workers", type=int, default=8, help="tasks running at the same time")
+    parser.add_argument("--download-workers", type=int, default=2, help="datasets downloaded at the same time")
+    parser.add_argument("--load-workers", type=int, default=4, help="datasets loaded at the same time")
+    parser.add_argument("--url", action="append", dest="urls", metavar="URL",
+                        help="FHIR server, repeated to spread the participants over several servers "
+                             "(default http://localhost:8080/fhir)")
+    parser.add_argument("--partition", action="append", dest="partitions", metavar="NAME",
+                        help="HAPI partition (URL based partitioning) of the servers, repeated to spread the "
+                             "participants over several partitions")
+    parser.add_argument("--route-by", choices=("participant", "study"), default="participant",
+                        help="resources kept on the same server or partition")
+    parser.add_argument("--cache-dir", help="caches the resources read from the servers, may be shared by workers")
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument("--coordinator", metavar="QUEUE", help="has the participants loaded by workers through the "
+                                                              "job queue file QUEUE, e.g. on a network mount")
+    modes.add_argument("--worker", metavar="QUEUE", help="loads participants of the job queue file QUEUE")
+    parser.add_argument("--lease-seconds", type=int, default=300, help="time after which the job of a worker that "
+                                                                       "stopped sending heartbeats is leased again")
+    selection = parser.add_argument_group("selection", "loads only a part of the datasets, each option being "
+                                                       "repeated to select several values")
+    selection.add_argument("--participant", action="append", dest="participants", metavar="ID")
+    selection.add_argument("--device", action="append", dest="devices", metavar="ID", help="e.g. E4 or RespiBAN")
+    selection.add_argument("--modality", action="append", dest="modalities", metavar="NAME",
+                           help="e.g. eda, also selecting the features derived from it")
+    selection.add_argument("--session", action="append", dest="sessions", metavar="NAME", help="e.g. TSST")
+    selection.add_argument("--label", action="append", dest="labels", metavar="NAME", help="e.g. stress")
+    selection.add_argument("--start", type=parse_time, metavar="TIME",
+                           help="ISO datetime, or seconds from the beginning of recordings")
+    selection.add_argument("--end", type=parse_time, metavar="TIME")
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    main()
+    arguments = parse_arguments()
+    main(arguments.datasets, arguments.metrics_path, arguments.metrics_port, arguments.catalog_path, arguments.workers,
+         arguments.download_workers, arguments.load_workers, arguments.coordinator, arguments.worker,
+         arguments.lease_seconds, arguments.urls, arguments.partitions, arguments.route_by, get_selection(arguments),
+         arguments.cache_dir)
@@ -0,0 +1,211 @@
+"""Size-bounded least recently used caches, in memory and on disk, and the response cache of `FHIRConnector`."""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCache:
+    """Keeps values in memory up to `max_bytes`, the size of each value being given when it is stored. The least
+    recently used values are evicted first."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __contains__(self, key):
+        return key in self.__items
+
+    def get(self, key, default=None):
+        with self.__lock:
+            if key not in self.__items:
+                return default
+
+            self.__items.move_to_end(key)
+            return self.__items[key][0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+
+        with self.__lock:
+            if key in self.__items:
+                self.nbytes -= self.__items.pop(key)[1]
+
+            self.__items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self.__items.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+
+    def remove(self, key):
+        with self.__lock:
+            if key in self.__items:
+                self.nbytes -= self.__items.pop(key)[1]
+
+
+class DiskCache:
+    """Keeps byte strings as files of `directory` up to `max_bytes`. Reads refresh the modification time of a file,
+    which orders the eviction. Files are written atomically, so several processes can share the directory.
+
+    The files and their sizes are indexed in memory in least recently used order, so storing a file does not list
+    the directory. The directory is only scanned again, to account for the files of the other processes, when the
+    index exceeds `max_bytes` and every `rescan_interval` seconds. Eviction then goes down to `low_water` times
+    `max_bytes`, so that a full cache is not scanned on every write."""
+
+    def __init__(self, directory, max_bytes, rescan_interval=60., low_water=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rescan_interval = rescan_interval
+        self.low_water = low_water
+        self.nbytes = 0
+        self.__files = OrderedDict()
+        self.__scanned = 0.
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        with self.__lock:
+            self.__scan()
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as cache_file:
+                data = cache_file.read()
+
+            os.utime(path)
+        except FileNotFoundError:
+            with self.__lock:
+                self.__forget(path)
+
+            return None
+
+        with self.__lock:
+            self.__index(path, len(data))
+
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        path = self.path(key)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(temporary_path, "wb") as cache_file:
+            cache_file.write(data)
+
+        with self.__lock:
+            os.replace(temporary_path, path)
+            self.__index(path, len(data))
+            if self.nbytes > self.max_bytes or time.time() - self.__scanned > self.rescan_interval:
+                self.__scan()
+                if self.nbytes > self.max_bytes:
+                    self.__evict(self.low_water * self.max_bytes)
+
+    def remove(self, key):
+        path = self.path(key)
+        with self.__lock:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            self.__forget(path)
+
+    def __index(self, path, size):
+        """Records `path` as the most recently used file."""
+        self.nbytes += size - self.__files.pop(path, 0)
+        self.__files[path] = size
+
+    def __forget(self, path):
+        self.nbytes -= self.__files.pop(path, 0)
+
+    def __scan(self):
+        """Indexes the files of the directory, whatever process wrote them, by modification time."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".part"):
+                continue
+
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+            except FileNotFoundError:
+                continue
+
+        self.__files = OrderedDict((path, size) for _, path, size in sorted(files))
+        self.nbytes = sum(self.__files.values())
+        self.__scanned = time.time()
+
+    def __evict(self, max_bytes):
+        """Removes the least recently used files until the directory fits in `max_bytes`."""
+        while self.nbytes > max_bytes and self.__files:
+            path, size = self.__files.popitem(last=False)
+            self.nbytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class ResponseCache:
+    """Cache of the json responses of a FHIR server keyed by URL, in memory and, if `directory` is given, on disk.
+
+    Each entry keeps the ETag and the `meta.lastUpdated` of the response and the time it was last validated. Entries
+    validated less than `max_age` seconds ago are served as they are, older ones are revalidated by the connector."""
+
+    def __init__(self, memory_bytes=64 * 1024 * 1024, directory=None, disk_bytes=1024 * 1024 * 1024, max_age=0):
+        self.max_age = max_age
+        self.memory = MemoryCache(memory_bytes)
+        self.disk = DiskCache(directory, disk_bytes) if directory is not None else None
+
+    def get(self, url):
+        """Returns the entry of `url`, a dict with the json `body`, `etag`, `last_updated` and `validated` time, or
+        None."""
+        entry = self.memory.get(url)
+        if entry is not None or self.disk is None:
+            return entry
+
+        data = self.disk.get(url)
+        if data is None:
+            return None
+
+        entry = json.loads(data)
+        self.memory.put(url, entry, len(data))
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry["validated"] < self.max_age
+
+    def put(self, url, body, etag=None):
+        entry = {"body": body,
+                 "etag": etag,
+                 "last_updated": body.get("meta", {}).get("lastUpdated"),
+                 "validated": time.time()}
+        self.__store(url, entry)
+
+    def validated(self, url, entry):
+        """Records that the entry of `url` is still valid."""
+        self.__store(url, dict(entry, validated=time.time()))
+
+    def remove(self, url):
+        self.memory.remove(url)
+        if self.disk is not None:
+            self.disk.remove(url)
+
+    def __store(self, url, entry):
+        data = json.dumps(entry).encode("utf-8")
+        self.memory.put(url, entry, len(data))
+        if self.disk is not None:
+            self.disk.put(url, data)
@@ -0,0 +1,99 @@
+"""Local SQLite catalog of the resources uploaded by the loaders.
+
+Each row describes one resource: its study, participant, device, modality and label, the time range it covers, and
+the size and hash of its attachment. Lookups such as "all EDA observations of participant S5 during the stress
+session" are answered locally instead of through FHIR searches.
+
+Times are seconds, `start` and `end` being the times of the first and last sample, and `frequency` is the sampling
+frequency of signals that have one. `time_reference` is "utc" for unix timestamps and "recording" for offsets from the
+beginning of the participant's recording (e.g. WESAD, which has no absolute time)."""
+
+import sqlite3
+import threading
+
+COLUMNS = ("resource_id", "resource_type", "study", "participant", "device", "modality", "label", "parent_id",
+           "chunk", "start", "end", "time_reference", "frequency", "payload_size", "payload_hash")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    resource_id TEXT NOT NULL,
+    resource_type TEXT NOT NULL,
+    study TEXT NOT NULL,
+    participant TEXT,
+    device TEXT,
+    modality TEXT,
+    label TEXT,
+    parent_id TEXT,
+    chunk INTEGER,
+    start REAL,
+    end REAL,
+    time_reference TEXT,
+    frequency REAL,
+    payload_size INTEGER,
+    payload_hash TEXT,
+    PRIMARY KEY (resource_type, resource_id)
+);
+CREATE INDEX IF NOT EXISTS resources_participant ON resources (study, participant, modality);
+CREATE INDEX IF NOT EXISTS resources_time ON resources (participant, start, end);
+CREATE INDEX IF NOT EXISTS resources_parent ON resources (parent_id);
+"""
+
+
+class Catalog:
+    def __init__(self, path):
+        """Rows added are committed by `commit` (or `close`), so that the rows of a load are committed together with
+        its results."""
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.row_factory = sqlite3.Row
+        self.__connection.executescript(SCHEMA)
+
+    def add(self, resource_id, resource_type, study, **fields):
+        """Adds or replaces the row of a resource, `fields` are any of the other `COLUMNS`."""
+        self.add_rows([dict(fields, resource_id=resource_id, resource_type=resource_type, study=study)])
+
+    def add_rows(self, rows):
+        rows = [tuple(row.get(column) for column in COLUMNS) for row in rows]
+        with self.__lock:
+            self.__connection.executemany(
+                f"INSERT OR REPLACE INTO resources ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                rows)
+
+    def commit(self):
+        with self.__lock:
+            self.__connection.commit()
+
+    def find(self, study=None, participant=None, device=None, modality=None, label=None, start=None, end=None,
+             resource_type="Observation", parent_id=None, chunks=False):
+        """Returns the rows (as dicts) matching every given field, sorted by participant, modality and start time.
+        `start` and `end` select resources overlapping that time range. Chunks of split resources are only returned
+        if `chunks` is set or `parent_id` is given."""
+        conditions = ["resource_type = ?"]
+        arguments = [resource_type]
+        for column, value in (("study", study), ("participant", participant), ("device", device),
+                              ("modality", modality), ("label", label), ("parent_id", parent_id)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                arguments.append(value)
+
+        if parent_id is None and not chunks:
+            conditions.append("parent_id IS NULL")
+
+        if start is not None:
+            conditions.append("end >= ?")
+            arguments.append(start)
+
+        if end is not None:
+            conditions.append("start < ?")
+            arguments.append(end)
+
+        query = (f"SELECT * FROM resources WHERE {' AND '.join(conditions)} "
+                 f"ORDER BY participant, modality, start, chunk")
+        with self.__lock:
+            return [dict(row) for row in self.__connection.execute(query, arguments)]
+
+    def close(self):
+        self.commit()
+        with self.__lock:
+            self.__connection.close()
@@ -1,19 +1,44 @@
 import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
+from urllib.parse import urlencode, urljoin
 
 from fhir.resources import FHIRAbstractModel
 from fhir.resources.resource import Resource
 from fhirclient.server import FHIRServer
-from requests import HTTPError
+from requests import HTTPError, RequestException
+from requests.adapters import HTTPAdapter
+
+from cache import ResponseCache
+from metrics import metrics, progress
+from throttle import TRANSIENT_STATUSES, UploadController, get_retry_after
 
 
 class FHIRConnector:
-    def __init__(self, url):
+    def __init__(self, url, cache: ResponseCache = None, controller: UploadController = None):
         """FHIRConnector decouples server operations from FHIR static_resources (The current approach from fhirclient). It
         uses `fhirclient.FHIRServer` to communicate with the remote FHIR server. But uses `fhir.static_resources` to enable
-        FHIR R5 descriptions."""
+        FHIR R5 descriptions.
+
+        With a `cache`, reads and searches are read-through: cached resources are revalidated with `If-None-Match`
+        and cached searches with a `_lastUpdated` count query, instead of being downloaded again.
+
+        Writes are throttled by `controller` (see `throttle.py`), which adapts the number of concurrent uploads and
+        the size of the batch Bundles of `create_all` to the server."""
 
         self.server = FHIRServer(None, url)
+        self.cache = cache
+        self.controller = controller if controller is not None else UploadController()
+        adapter = HTTPAdapter(pool_maxsize=max(self.controller.max_limit, 10))
+        self.server.session.mount("http://", adapter)
+        self.server.session.mount("https://", adapter)
+
+    @property
+    def base_uri(self):
+        return self.server.base_uri
 
     @staticmethod
     def resource_to_json(resource: FHIRAbstractModel):
@@ -21,11 +46,75 @@ class FHIRConnector:
         operations."""
         return json.loads(resource.json())
 
+    @staticmethod
+    def serialize(resource: FHIRAbstractModel):
+        """Same as `resource_to_json` but records the serialization time and payload size of the resource."""
+        return FHIRConnector.__serialize(resource)[0]
+
+    @staticmethod
+    def __serialize(resource: FHIRAbstractModel):
+        resource_type = resource.resource_type
+        with metrics.timer("serialization_seconds", resource_type=resource_type):
+            body = resource.json()
+            resource_json = json.loads(body)
+
+        metrics.observe("payload_bytes", len(body), resource_type=resource_type)
+        return resource_json, len(body)
+
+    def request(self, method, url, resource_type, send, *args):
+        """Calls `send(url, *args)` recording its latency, and the outcome of the request."""
+        try:
+            with metrics.timer("request_seconds", resource_type=resource_type, method=method):
+                response = send(url, *args)
+        except HTTPError as e:
+            metrics.increment("request_errors_total", resource_type=resource_type, method=method)
+            raise e
+
+        metrics.increment("requests_total", resource_type=resource_type, method=method)
+        return response
+
+    def upload(self, method, url, resource_type, send, *args, entries=1, max_retries=None):
+        """Same as `request` for writes of `entries` resources, throttled by `self.controller`. Requests failing
+        because the server is overloaded (see `throttle.TRANSIENT_STATUSES`) or unreachable are sent again, up to
+        `max_retries` times (`self.controller.max_retries` by default), after the `Retry-After` of the response or an
+        exponential backoff."""
+        max_retries = self.controller.max_retries if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            self.controller.acquire()
+            start = time.perf_counter()
+            transient = False
+            rejected = True
+            retry_after = None
+            try:
+                response = self.request(method, url, resource_type, send, *args)
+                rejected = False
+                return response
+            except HTTPError as e:
+                transient = e.response is not None and e.response.status_code in TRANSIENT_STATUSES
+                rejected = not transient
+                retry_after = get_retry_after(e.response)
+                if not transient or attempt >= max_retries:
+                    raise e
+            except RequestException as e:
+                transient = True
+                rejected = False
+                if attempt >= max_retries:
+                    raise e
+            finally:
+                # Only the outcome of requests the server accepted or failed to handle tells about its load.
+                self.controller.release(time.perf_counter() - start, entries, transient, retry_after, rejected)
+
+            metrics.increment("upload_retries_total", resource_type=resource_type, method=method)
+            time.sleep(retry_after if retry_after is not None else self.controller.get_backoff(attempt))
+            attempt += 1
+
     def create(self, resource: Resource):
+        resource_json = self.serialize(resource)
         if not hasattr(resource, "id") or resource.id is None or not resource.id:
             url = resource.resource_type
             try:
-                response = self.server.post_json(url, self.resource_to_json(resource))
+                response = self.upload("POST", url, resource.resource_type, self.server.post_json, resource_json)
             except HTTPError as e:
                 raise HTTPError(str(e) + e.response.text)
 
@@ -36,12 +125,109 @@ class FHIRConnector:
             url = "/".join([resource.resource_type, resource.id])
 
             try:
-                self.server.put_json(url, self.resource_to_json(resource))
+                self.upload("PUT", url, resource.resource_type, self.server.put_json, resource_json)
             except HTTPError as e:
-                pprint(self.resource_to_json(resource))
+                pprint(resource_json)
                 raise HTTPError(str(e) + e.response.text)
 
-        print(f"Created {type(resource).__name__}: {resource.id}")
+            self.invalidate(url)
+
+        progress.update(resource.resource_type)
+
+    def create_all(self, resources):
+        """Creates or updates `resources` with batch Bundles sent concurrently, the number of requests in flight and
+        of resources per Bundle following `self.controller`. The entries of a batch are processed in any order, so
+        `resources` must not reference one another. Entries failing because the server is overloaded are sent again
+        in a later Bundle."""
+        resources = list(resources)
+        if len(resources) <= 1:
+            for resource in resources:
+                self.create(resource)
+
+            return
+
+        entries = deque((resource, *self.__serialize(resource), 0) for resource in resources)
+        errors = []
+        lock = threading.Lock()
+
+        def take():
+            with lock:
+                batch = []
+                nbytes = 0
+                while entries and len(batch) < self.controller.get_bundle_size():
+                    if batch and nbytes + entries[0][2] > self.controller.max_bundle_bytes:
+                        break
+
+                    batch.append(entries.popleft())
+                    nbytes += batch[-1][2]
+
+                return batch
+
+        def send_batches():
+            batch = take()
+            while batch:
+                retry, failed = self.__send_batch(batch)
+                with lock:
+                    entries.extend(retry)
+                    errors.extend(failed)
+
+                batch = take()
+
+        while entries:
+            with ThreadPoolExecutor(max_workers=self.controller.max_limit) as executor:
+                for future in [executor.submit(send_batches) for _ in range(self.controller.max_limit)]:
+                    future.result()
+
+        if errors:
+            raise RuntimeError(f"Failed to create {len(errors)} resources: {'; '.join(errors)}")
+
+    def __send_batch(self, batch):
+        """Sends a batch Bundle. Returns the entries to send again and the errors of the entries that failed. A Bundle
+        rejected because the server is overloaded is not sent again as it is, its entries are put back so that they
+        are sent in Bundles of the size the controller decreased to."""
+        bundle = {"resourceType": "Bundle",
+                  "type": "batch",
+                  "entry": [{"resource": resource_json,
+                             "request": {"method": "PUT", "url": f"{resource.resource_type}/{resource.id}"}
+                             if resource.id else {"method": "POST", "url": resource.resource_type}}
+                            for resource, resource_json, _, _ in batch]}
+        attempts = max(attempts for _, _, _, attempts in batch)
+        try:
+            response = self.upload("POST", "", "Bundle", self.server.post_json, bundle, entries=len(batch),
+                                   max_retries=0)
+        except (HTTPError, RequestException) as e:
+            response = getattr(e, "response", None)
+            if response is not None and response.status_code not in TRANSIENT_STATUSES:
+                raise HTTPError(str(e) + response.text)
+
+            if attempts >= self.controller.max_retries:
+                raise e
+
+            if get_retry_after(response) is None:
+                time.sleep(self.controller.get_backoff(attempts))
+
+            metrics.increment("upload_retries_total", resource_type="Bundle", method="POST")
+            return [(resource, resource_json, nbytes, attempts + 1)
+                    for resource, resource_json, nbytes, attempts in batch], []
+
+        retry = []
+        failed = []
+        for (resource, resource_json, nbytes, attempts), result in zip(batch, response.json().get("entry", [])):
+            status = int(result["response"]["status"].split()[0])
+            if status < 300:
+                if not resource.id:
+                    resource.id = result["response"]["location"].split("/")[1]
+
+                self.invalidate(f"{resource.resource_type}/{resource.id}")
+                progress.update(resource.resource_type)
+            elif status in TRANSIENT_STATUSES and attempts < self.controller.max_retries:
+                metrics.increment("upload_retries_total", resource_type=resource.resource_type, method="BATCH")
+                retry.append((resource, resource_json, nbytes, attempts + 1))
+            else:
+                outcome = json.dumps(result["response"].get("outcome", {}))
+                failed.append(f"{resource.resource_type}/{resource.id} {result['response']['status']} {outcome}")
+
+        return retry, failed
 
     def update(self, resource: Resource):
         if not hasattr(resource, "id") or resource.id is None or not resource.id:
@@ -49,9 +235,204 @@ class FHIRConnector:
 
         url = "/".join([resource.resource_type, resource.id])
         try:
-            self.server.post_json(url, self.resource_to_json(resource))
+            self.upload("POST", url, resource.resource_type, self.server.post_json, self.serialize(resource))
+        except HTTPError as e:
+            raise HTTPError(str(e) + e.response.text)
+
+        self.invalidate(url)
+
+    def read(self, resource_type, resource_id, cached=True):
+        """Returns the json of a stored resource. `cached=False` bypasses the cache, e.g. for large resources
+        that are only read once."""
+        path = "/".join([resource_type, resource_id])
+        if not cached or self.cache is None:
+            return self.get_json(path, resource_type)
+
+        url = self.get_url(path)
+        entry = self.cache.get(url)
+        if entry is not None and self.cache.is_fresh(entry):
+            metrics.increment("cache_requests_total", resource_type=resource_type, outcome="hit")
+            return entry["body"]
+
+        headers = {"If-None-Match": entry["etag"]} if entry is not None and entry["etag"] else {}
+        try:
+            response = self.request("GET", path, resource_type, self.server._get, headers)
+        except HTTPError as e:
+            raise HTTPError(str(e) + e.response.text)
+
+        if response.status_code == 304:
+            metrics.increment("cache_requests_total", resource_type=resource_type, outcome="revalidated")
+            self.cache.validated(url, entry)
+            return entry["body"]
+
+        metrics.increment("cache_requests_total", resource_type=resource_type, outcome="miss")
+        body = response.json()
+        self.cache.put(url, body, response.headers.get("ETag"))
+        return body
+
+    def search(self, resource_type, params=None, cached=True):
+        """Returns the first page (a searchset Bundle) of a search, `params` being a dict or a list of (name, value)
+        pairs for repeated parameters such as `_include`."""
+        return self.__search(resource_type, params, cached)[0]
+
+    def search_all(self, resource_type, params=None, cached=True):
+        """Yields the resources (matches and includes) of every page of a search, following the `next` links. If
+        the first page is served from the cache, so are the following ones."""
+        bundle, unchanged = self.__search(resource_type, params, cached)
+        while bundle is not None:
+            for entry in bundle.get("entry", []):
+                yield entry["resource"]
+
+            next_url = next((link["url"] for link in bundle.get("link", []) if link["relation"] == "next"), None)
+            if next_url is None:
+                break
+
+            next_url = self.get_url(next_url)
+            entry = self.cache.get(next_url) if unchanged else None
+            if entry is not None:
+                bundle = entry["body"]
+                continue
+
+            bundle = self.get_json(next_url, resource_type)
+            if cached and self.cache is not None:
+                self.cache.put(next_url, bundle)
+
+    def __search(self, resource_type, params, cached):
+        """Returns the first page of a search and whether it was served from the cache."""
+        path = resource_type if not params else f"{resource_type}?{urlencode(params)}"
+        if not cached or self.cache is None:
+            return self.get_json(path, resource_type), False
+
+        url = self.get_url(path)
+        entry = self.cache.get(url)
+        if entry is not None and (self.cache.is_fresh(entry) or not self.__search_changed(path, entry, resource_type)):
+            metrics.increment("cache_requests_total", resource_type=resource_type, outcome="hit")
+            return entry["body"], True
+
+        metrics.increment("cache_requests_total", resource_type=resource_type, outcome="miss")
+        bundle = self.get_json(path, resource_type)
+        self.cache.put(url, bundle)
+        return bundle, False
+
+    def __search_changed(self, path, entry, resource_type):
+        """Counts the matches updated since the cached search ran (its `meta.lastUpdated`). Resources that stopped
+        matching or were deleted are not detected."""
+        if entry["last_updated"] is None:
+            return True
+
+        separator = "&" if "?" in path else "?"
+        count_query = urlencode({"_lastUpdated": "gt" + entry["last_updated"], "_summary": "count"})
+        if self.get_json(f"{path}{separator}{count_query}", resource_type).get("total", 1) > 0:
+            return True
+
+        self.cache.validated(self.get_url(path), entry)
+        return False
+
+    def get_json(self, path, resource_type):
+        try:
+            return self.request("GET", path, resource_type, self.server.request_json)
+        except HTTPError as e:
+            raise HTTPError(str(e) + e.response.text)
+
+    def get_url(self, path):
+        """Returns the absolute URL of a path relative to the server, the key of the cached responses, so that the
+        connectors of several servers can share a cache."""
+        return urljoin(self.server.base_uri, path)
+
+    def invalidate(self, path):
+        """Drops the cached read of a resource ("Type/id") after it was written."""
+        if self.cache is not None:
+            self.cache.remove(self.get_url(path))
+
+    def patch(self, resource_type, resource_id, operations, fhirpath=False):
+        """Applies a JSON Patch (a list of operations) or, if `fhirpath` is set, a FHIRPath Patch (a list of
+        `operation` parameters, see `fhirpath_add`) to a resource, sending only the change instead of the whole
+        resource."""
+        if fhirpath:
+            content_type = "application/fhir+json"
+            body = {"resourceType": "Parameters", "parameter": operations}
+        else:
+            content_type = "application/json-patch+json"
+            body = operations
+
+        body = json.dumps(body)
+        metrics.observe("payload_bytes", len(body), resource_type=resource_type)
+        url = "/".join([resource_type, resource_id])
+        try:
+            self.upload("PATCH", url, resource_type, self.__patch, body, content_type)
         except HTTPError as e:
             raise HTTPError(str(e) + e.response.text)
 
+        self.invalidate(url)
+
+    def __patch(self, path, body, content_type):
+        headers = {"Content-type": content_type,
+                   "Accept": "application/fhir+json",
+                   "Accept-Charset": "UTF-8"}
+        response = self.server.session.patch(urljoin(self.server.base_uri, path), headers=headers, data=body)
+        self.server.raise_for_status(response)
+        return response
+
+    def append_references(self, resource_type, resource_id, element, references):
+        """Appends references to a list element (`hasMember`, `derivedFrom`, `partOf`, ...) of a stored resource."""
+        self.patch(resource_type, resource_id,
+                   [fhirpath_add(resource_type, element, {"valueReference": reference}) for reference in references],
+                   fhirpath=True)
+
+    def append_section_entries(self, resource_id, section_title, references, resource_type="EvidenceReport"):
+        """Appends references to the `entryReference` list of the report section titled `section_title`."""
+        path = get_section_path(resource_type, section_title)
+        self.patch(resource_type, resource_id,
+                   [fhirpath_add(path, "entryReference", {"valueReference": reference}) for reference in references],
+                   fhirpath=True)
+
+
+def fhirpath_string(value):
+    """Returns `value` as a FHIRPath string literal, quotes and backslashes escaped."""
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def get_section_path(resource_type, section_title):
+    """FHIRPath of the section of a report titled `section_title`."""
+    return f"{resource_type}.section.where(title={fhirpath_string(section_title)})"
+
+
+def fhirpath_add(path, name, value):
+    """FHIRPath Patch `add` operation, `value` is a typed value such as {"valueReference": {...}}. Unlike a JSON
+    Patch `add` to `/hasMember/-`, it also works when the list does not exist yet."""
+    return {"name": "operation",
+            "part": [{"name": "type", "valueCode": "add"},
+                     {"name": "path", "valueString": path},
+                     {"name": "name", "valueString": name},
+                     {"name": "value", **value}]}
+
+
+class PatchBatch:
+    """Collects FHIRPath Patch operations and sends a single PATCH request per target resource."""
+
+    def __init__(self):
+        self.__operations = {}
+
+    def __len__(self):
+        return len(self.__operations)
+
+    def add(self, resource_type, resource_id, operation):
+        self.__operations.setdefault((resource_type, resource_id), []).append(operation)
+
+    def append_reference(self, target, element, reference):
+        """Appends `reference` to the `element` list (`hasMember`, `derivedFrom`, `partOf`, ...) of the `target`
+        ("Type/id") resource."""
+        resource_type, resource_id = target.split("/")
+        self.add(resource_type, resource_id, fhirpath_add(resource_type, element, {"valueReference": reference}))
+
+    def append_section_entry(self, report_id, section_title, reference, resource_type="EvidenceReport"):
+        """Appends `reference` to the entries of the report section titled `section_title`."""
+        self.add(resource_type, report_id, fhirpath_add(get_section_path(resource_type, section_title),
+                                                         "entryReference", {"valueReference": reference}))
 
+    def flush(self, connector):
+        """Sends the collected operations with `connector`, a `FHIRConnector` or a `routing.RoutingConnector`."""
+        for (resource_type, resource_id), operations in self.__operations.items():
+            connector.patch(resource_type, resource_id, operations, fhirpath=True)
 
+        self.__operations.clear()
@@ -0,0 +1,293 @@
+"""Export of a study stored on the FHIR server to numpy files.
+
+The export walks ResearchStudy -> EvidenceReport -> the device and estimated data sections of every participant, and
+writes each signal Observation to `<output_dir>/<study>/<participant>/<modality>/<source>/<observation id>.npy`,
+chunked signals being reassembled in sample order. The source is the DeviceMetric that recorded the signal, or
+"derived" for the signals computed from others (e.g. the features of SDN). pandas signals are written as their
+values. The times of the samples, from a datetime index or from the effectivePeriod of the Observation, are written in
+`<observation id>.time.npy` as UTC datetime64[ns].
+
+Once every Observation of a participant is written, the signals of each modality and source (e.g. the sessions or
+segments of a recording) are concatenated in time order into one array, `<participant>/<modality>/<source>.npy`, with
+its times in `<participant>/<modality>/<source>.time.npy` when every piece has times.
+
+Pages of Observations are fetched and their signals decoded and written concurrently. Files are written atomically and
+existing ones are skipped, as are the Observations that are not signals (e.g. the button presses of WSPCP), listed in
+`<participant>/non_signals.txt`, so an interrupted export resumes where it stopped. The array of a source is assembled
+again whenever one of its Observations is newer than it."""
+
+import argparse
+import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from cache import ResponseCache
+from connector import FHIRConnector
+from static_resources.search_parameters.codex import TAG_SYSTEMS
+from utils import read_pickle_attachment
+
+SIGNAL_CATEGORIES = ("signal", "feature")
+SIGNAL_SECTIONS = ("Device ", "Estimated Data")
+NON_SIGNALS_FILE = "non_signals.txt"
+DERIVED_SOURCE = "derived"
+
+
+def get_tag(resource, name):
+    return next((tag["code"] for tag in resource.get("meta", {}).get("tag", [])
+                 if tag.get("system") == TAG_SYSTEMS[name]), None)
+
+
+def get_category(observation):
+    return next((coding.get("code") for category in observation.get("category", [])
+                 for coding in category.get("coding", [])), None)
+
+
+def concatenate(pieces):
+    if hasattr(pieces[0], "iloc"):
+        return pd.concat(pieces)
+
+    return np.concatenate(pieces)
+
+
+def get_sample_offset(chunk):
+    """Returns the position in the signal of the first sample of a chunk, from its "sample range" component."""
+    for component in chunk.get("component", []):
+        if any(coding.get("code") == "sample range" for coding in component["code"].get("coding", [])):
+            return component["valueRange"]["low"]["value"]
+
+    return 0
+
+
+def get_times(observation, data):
+    """Returns the times of the samples of a decoded signal as UTC datetime64[ns], from its datetime index or spread
+    evenly over the effectivePeriod of its Observation, None if they are unknown."""
+    if isinstance(getattr(data, "index", None), pd.DatetimeIndex):
+        return data.index.asi8.astype("datetime64[ns]")
+
+    length = len(data)
+    if "effectivePeriod" in observation and length:
+        start = pd.Timestamp(observation["effectivePeriod"]["start"]).value
+        end = pd.Timestamp(observation["effectivePeriod"]["end"]).value
+        # Integer arithmetic, nanosecond timestamps do not fit the mantissa of a float.
+        steps = np.arange(length, dtype=np.int64) * (end - start) // max(length - 1, 1)
+        return (start + steps).astype("datetime64[ns]")
+
+    if "effectiveDateTime" in observation and length == 1:
+        return np.array([pd.Timestamp(observation["effectiveDateTime"]).value]).astype("datetime64[ns]")
+
+    return None
+
+
+def get_source_dirs(participant_dir):
+    """Returns the (modality dir, source) of the exported signals of a participant."""
+    if not os.path.isdir(participant_dir):
+        return []
+
+    return [(modality.path, source.name) for modality in os.scandir(participant_dir) if modality.is_dir()
+            for source in os.scandir(modality.path) if source.is_dir()]
+
+
+def get_signal_files(directory):
+    """Returns the names, without extension, of the signal files of a directory."""
+    return sorted(name[:-len(".npy")] for name in os.listdir(directory)
+                  if name.endswith(".npy") and not name.endswith((".part.npy", ".time.npy")))
+
+
+def save_array(path, array):
+    """Writes `array` to `path` through a temporary file, so `path` only exists once it is complete."""
+    temporary_path = f"{path}.part.npy"
+    np.save(temporary_path, array)
+    os.replace(temporary_path, path)
+
+
+class StudyExporter:
+    def __init__(self, server: FHIRConnector, output_dir, max_workers=8, page_size=50):
+        self.server = server
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+        self.page_size = page_size
+        self.__lock = threading.Lock()
+
+    def export(self, study_id):
+        """Exports every signal of the study. Returns the number of written and skipped signals.
+
+        Fetching a page and writing a signal are tasks of the same threads, at most twice as many tasks as threads
+        being in flight. Pages are only fetched once the signals of the previous ones are submitted, so that at most
+        a few pages of Observations are in memory."""
+        written = skipped = 0
+        pages = deque()
+        participant_dirs = []
+        study = self.server.read("ResearchStudy", study_id)
+        for result in study.get("result", []):
+            report = self.server.read(*result["reference"].split("/"))
+            for participant_id, observation_ids in self.get_signal_references(report):
+                participant_dir = os.path.join(self.output_dir, study_id, participant_id)
+                exported = self.get_exported_ids(participant_dir)
+                pending = [obs_id for obs_id in observation_ids if obs_id not in exported]
+                skipped += len(observation_ids) - len(pending)
+                pages.extend((participant_dir, pending[start:start + self.page_size])
+                             for start in range(0, len(pending), self.page_size))
+                participant_dirs.append(participant_dir)
+
+        observations = deque()
+        fetches = set()
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pages or observations or in_flight:
+                while len(in_flight) < 2 * self.max_workers and (observations or pages):
+                    if observations:
+                        in_flight.add(executor.submit(self.export_observation, *observations.popleft()))
+                    else:
+                        future = executor.submit(self.fetch_page, *pages.popleft())
+                        fetches.add(future)
+                        in_flight.add(future)
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in fetches:
+                        fetches.remove(future)
+                        observations.extend(future.result())
+                    else:
+                        written += future.result()
+
+            for _ in executor.map(self.assemble, dict.fromkeys(participant_dirs)):
+                pass
+
+        return written, skipped
+
+    @staticmethod
+    def get_signal_references(report):
+        """Yields (participant id, [observation id, ...]) from the device and estimated data sections of the
+        participant sections ("Participant <id>") of the report."""
+        sections = list(report.get("section", []))
+        while sections:
+            section = sections.pop(0)
+            title = section.get("title", "")
+            if not title.startswith("Participant "):
+                sections.extend(section.get("section", []))
+                continue
+
+            observation_ids = []
+            for subsection in section.get("section", []):
+                if not subsection.get("title", "").startswith(SIGNAL_SECTIONS):
+                    continue
+
+                for entry in subsection.get("entryReference", []):
+                    resource_type, resource_id = entry["reference"].split("/")
+                    if resource_type == "Observation" and resource_id not in observation_ids:
+                        observation_ids.append(resource_id)
+
+            yield title[len("Participant "):], observation_ids
+
+    @staticmethod
+    def get_exported_ids(participant_dir):
+        """Returns the ids of the signals written to `participant_dir` and of the Observations found not to be
+        signals."""
+        exported = set()
+        for modality_dir, source_dir in get_source_dirs(participant_dir):
+            exported.update(get_signal_files(os.path.join(modality_dir, source_dir)))
+
+        non_signals_path = os.path.join(participant_dir, NON_SIGNALS_FILE)
+        if os.path.exists(non_signals_path):
+            with open(non_signals_path) as non_signals:
+                exported.update(line.strip() for line in non_signals if line.strip())
+
+        return exported
+
+    def fetch_page(self, participant_dir, observation_ids):
+        """Returns the (participant dir, Observation) of a page of Observation ids."""
+        return [(participant_dir, observation) for observation in self.fetch_observations(observation_ids)]
+
+    def fetch_observations(self, observation_ids):
+        """Pages through the Observations with the given ids, `self.page_size` at a time."""
+        for start in range(0, len(observation_ids), self.page_size):
+            batch = observation_ids[start:start + self.page_size]
+            yield from self.server.search_all("Observation", {"_id": ",".join(batch), "_count": len(batch)},
+                                              cached=False)
+
+    def export_observation(self, participant_dir, observation):
+        """Decodes a signal Observation, reading its chunks if it was split, and writes it. Returns whether the
+        Observation was a signal, the ids of those that are not being recorded so they are not fetched again."""
+        if get_category(observation) not in SIGNAL_CATEGORIES and "valueAttachment" not in observation:
+            os.makedirs(participant_dir, exist_ok=True)
+            with self.__lock, open(os.path.join(participant_dir, NON_SIGNALS_FILE), "a") as non_signals:
+                non_signals.write(f"{observation['id']}\n")
+
+            return False
+
+        if "valueAttachment" in observation:
+            data = read_pickle_attachment(observation["valueAttachment"])
+        else:
+            chunks = [self.server.read(*member["reference"].split("/"), cached=False)
+                      for member in observation.get("hasMember", [])]
+            chunks.sort(key=get_sample_offset)
+            data = concatenate([read_pickle_attachment(chunk["valueAttachment"]) for chunk in chunks])
+
+        modality = get_tag(observation, "modality") or observation["code"]["coding"][0]["code"].lower()
+        device = observation.get("device", {}).get("reference")
+        source_dir = os.path.join(participant_dir, modality, device.split("/")[-1] if device else DERIVED_SOURCE)
+        os.makedirs(source_dir, exist_ok=True)
+
+        path = os.path.join(source_dir, observation["id"])
+        times = get_times(observation, data)
+        if times is not None:
+            save_array(f"{path}.time.npy", times)
+
+        save_array(f"{path}.npy", data.to_numpy() if hasattr(data, "iloc") else data)
+        return True
+
+    @staticmethod
+    def assemble(participant_dir):
+        """Concatenates the signals of each modality and source of a participant, in the order of their first sample
+        (by id for those without times), into `<modality>/<source>.npy`. Sources whose array is newer than all their
+        signals are skipped."""
+        for modality_dir, source in get_source_dirs(participant_dir):
+            source_dir = os.path.join(modality_dir, source)
+            names = get_signal_files(source_dir)
+            if not names:
+                continue
+
+            path = os.path.join(modality_dir, source)
+            newest = max(os.path.getmtime(os.path.join(source_dir, f"{name}.npy")) for name in names)
+            if os.path.exists(f"{path}.npy") and os.path.getmtime(f"{path}.npy") >= newest:
+                continue
+
+            pieces = []
+            for name in names:
+                times_path = os.path.join(source_dir, f"{name}.time.npy")
+                times = np.load(times_path) if os.path.exists(times_path) else None
+                pieces.append((times, name, np.load(os.path.join(source_dir, f"{name}.npy"), allow_pickle=True)))
+
+            pieces.sort(key=lambda piece: (piece[0] is None or len(piece[0]) == 0,
+                                           piece[0][0] if piece[0] is not None and len(piece[0]) else 0, piece[1]))
+            if all(times is not None for times, _, _ in pieces):
+                save_array(f"{path}.time.npy", np.concatenate([times for times, _, _ in pieces]))
+            elif os.path.exists(f"{path}.time.npy"):
+                os.remove(f"{path}.time.npy")
+
+            save_array(f"{path}.npy", np.concatenate([data for _, _, data in pieces]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports the signals of studies stored on a FHIR server.")
+    parser.add_argument("studies", nargs="+", help="ResearchStudy ids, e.g. WESAD")
+    parser.add_argument("--url", default="http://localhost:8080/fhir")
+    parser.add_argument("--output-dir", default="exports")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--cache-dir", help="caches the studies and reports read from the server")
+    args = parser.parse_args()
+
+    cache = ResponseCache(directory=args.cache_dir) if args.cache_dir is not None else None
+    exporter = StudyExporter(FHIRConnector(args.url, cache=cache), args.output_dir, args.workers, args.page_size)
+    for study_id in args.studies:
+        written, skipped = exporter.export(study_id)
+        print(f"{study_id}: {written} signals exported, {skipped} already exported")
+
+
+if __name__ == '__main__':
+    main()
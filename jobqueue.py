@@ -0,0 +1,257 @@
+"""Distributed loading of studies through a job queue stored in a SQLite file.
+
+The queue file is shared by the machines taking part, e.g. on a network mount (whose file system must support file
+locks, as NFS and SMB do). The coordinator sets each study up (participants, devices, ..., see `Loader.setup`),
+enqueues one job per participant and waits. Workers lease jobs, load the participant and store its results, the ids
+of the uploaded resources and their catalog rows, in the queue. The coordinator then merges the results and writes the
+EvidenceReport of the study.
+
+A worker renews its lease with heartbeats while it loads a participant. Jobs whose lease expired, because the worker
+died or lost the file, are put back in the queue, by the coordinator or the other workers, and leased again up
+to `max_attempts` times. Workers wait for the jobs leased by others before stopping, as their lease may expire.
+Resource ids are deterministic (see `loaders.ids`), so a participant loaded twice overwrites the same resources.
+
+    python app.py WESAD SDN --coordinator /mnt/shared/queue.sqlite     # on one machine
+    python app.py --worker /mnt/shared/queue.sqlite                    # on every machine
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import metrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    study TEXT NOT NULL,
+    participant TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    PRIMARY KEY (study, participant)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires);
+"""
+
+
+class JobQueue:
+    """Queue of (study, participant) jobs. A job is "pending" until a worker leases it, "leased" while the worker
+    loads it, and "done" or, after `max_attempts` failed or expired leases, "failed"."""
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self.__lock:
+            self.__connection.executescript(SCHEMA)
+
+    @contextmanager
+    def __transaction(self):
+        """Runs statements in a transaction holding the write lock of the file, so that concurrent workers do not
+        lease the same job."""
+        with self.__lock:
+            self.__connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.__connection
+            except BaseException:
+                self.__connection.execute("ROLLBACK")
+                raise
+
+            self.__connection.execute("COMMIT")
+
+    def enqueue(self, study, participants):
+        """Adds a pending job for each participant of `study`, replacing the jobs of a previous run."""
+        with self.__transaction() as connection:
+            connection.executemany("INSERT OR REPLACE INTO jobs (study, participant, state) VALUES (?, ?, 'pending')",
+                                   [(study, participant) for participant in participants])
+
+    def expire(self):
+        """Puts the jobs whose lease expired back in the queue, or marks them failed after `max_attempts`. Returns
+        the number of expired jobs."""
+        with self.__transaction() as connection:
+            expired = self.__expire(connection, time.time())
+
+        return expired
+
+    def __expire(self, connection, now):
+        cursor = connection.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' "
+                                    "END, error = 'Lease expired' WHERE state = 'leased' AND lease_expires < ?",
+                                    (self.max_attempts, now))
+        if cursor.rowcount:
+            metrics.increment("jobs_total", cursor.rowcount, event="expired")
+
+        return cursor.rowcount
+
+    def lease(self, worker):
+        """Leases the next pending or expired job to `worker`. Returns its (study, participant) or None."""
+        now = time.time()
+        with self.__transaction() as connection:
+            self.__expire(connection, now)
+            job = connection.execute("SELECT study, participant FROM jobs WHERE state = 'pending' "
+                                     "ORDER BY rowid LIMIT 1").fetchone()
+            if job is None:
+                return None
+
+            connection.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, "
+                               "attempts = attempts + 1 WHERE study = ? AND participant = ?",
+                               (worker, now + self.lease_seconds, *job))
+
+        metrics.increment("jobs_total", event="leased")
+        return job
+
+    def heartbeat(self, worker, study, participant):
+        """Renews the lease of a job. Returns False if `worker` lost it."""
+        with self.__transaction() as connection:
+            cursor = connection.execute("UPDATE jobs SET lease_expires = ? "
+                                        "WHERE study = ? AND participant = ? AND worker = ? AND state = 'leased'",
+                                        (time.time() + self.lease_seconds, study, participant, worker))
+
+        return cursor.rowcount == 1
+
+    def complete(self, worker, study, participant, result):
+        """Stores the json serializable `result` of a job. Returns False if `worker` had lost its lease, in which case
+        the result is dropped, the job being loaded again."""
+        with self.__transaction() as connection:
+            cursor = connection.execute("UPDATE jobs SET state = 'done', result = ?, error = NULL "
+                                        "WHERE study = ? AND participant = ? AND worker = ? AND state = 'leased'",
+                                        (json.dumps(result), study, participant, worker))
+
+        metrics.increment("jobs_total", event="done" if cursor.rowcount == 1 else "lost")
+        return cursor.rowcount == 1
+
+    def fail(self, worker, study, participant, error):
+        """Puts a job that `worker` failed to load back in the queue, or marks it failed after `max_attempts`."""
+        with self.__transaction() as connection:
+            connection.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                               "error = ? WHERE study = ? AND participant = ? AND worker = ? AND state = 'leased'",
+                               (self.max_attempts, error, study, participant, worker))
+
+        metrics.increment("jobs_total", event="failed")
+
+    def counts(self, study=None):
+        """Returns the number of jobs by state, of `study` or of every study."""
+        query = "SELECT state, COUNT(*) FROM jobs"
+        arguments = []
+        if study is not None:
+            query += " WHERE study = ?"
+            arguments.append(study)
+
+        with self.__lock:
+            return dict(self.__connection.execute(f"{query} GROUP BY state", arguments).fetchall())
+
+    def results(self, study):
+        """Returns the results of the done jobs of `study` by participant."""
+        with self.__lock:
+            rows = self.__connection.execute("SELECT participant, result FROM jobs WHERE study = ? AND state = 'done'",
+                                             (study,)).fetchall()
+
+        return {participant: json.loads(result) for participant, result in rows}
+
+    def errors(self, study):
+        """Returns the errors of the failed jobs of `study` by participant."""
+        with self.__lock:
+            return dict(self.__connection.execute(
+                "SELECT participant, error FROM jobs WHERE study = ? AND state = 'failed'", (study,)).fetchall())
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+
+class Heartbeat:
+    """Renews the lease of a job every third of the lease time while the block runs."""
+
+    def __init__(self, queue: JobQueue, worker, study, participant):
+        self.queue = queue
+        self.job = (worker, study, participant)
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.__stop.set()
+        self.__thread.join()
+
+    def __run(self):
+        while not self.__stop.wait(self.queue.lease_seconds / 3):
+            if not self.queue.heartbeat(*self.job):
+                print(f"Lost the lease of {self.job[1]} {self.job[2]}")
+                return
+
+
+def coordinate(queue: JobQueue, dataset, loader, poll_interval=5.):
+    """Loads `dataset` through the workers of `queue`: sets the study up with `loader`, enqueues its participants,
+    waits for the workers and writes the EvidenceReport from their results."""
+    loader.setup()
+    queue.enqueue(dataset, [patient.id for patient in loader.get_selected_patients()])
+    counts = None
+    while counts is None or counts.get("pending") or counts.get("leased"):
+        time.sleep(0 if counts is None else poll_interval)
+        # Expired jobs are failed here too, the workers that would have put them back in the queue may all be gone.
+        queue.expire()
+        last_counts, counts = counts, queue.counts(dataset)
+        if counts != last_counts:
+            print(f"{dataset}: " + ", ".join(f"{count} {state}" for state, count in sorted(counts.items())))
+
+    errors = queue.errors(dataset)
+    if errors:
+        raise RuntimeError(f"Failed to load {dataset} participants: " +
+                           "; ".join(f"{participant}: {error}" for participant, error in errors.items()))
+
+    for participant_id, results in queue.results(dataset).items():
+        loader.add_participant_results(participant_id, results)
+
+    loader.load_results()
+
+
+def work(queue: JobQueue, get_loader, worker=None, idle_timeout=None, poll_interval=5.):
+    """Loads the jobs of `queue` until it had no pending or leased job for `idle_timeout` seconds, by default the
+    lease time of the queue. `get_loader(dataset)` returns a new loader of a dataset, which is set up once, without
+    uploading. Returns the number of jobs done."""
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    idle_timeout = idle_timeout if idle_timeout is not None else queue.lease_seconds
+    loaders = {}
+    done = 0
+    idle_since = time.time()
+    while True:
+        job = queue.lease(worker)
+        if job is None:
+            # The jobs leased by other workers are put back in the queue if their worker dies.
+            if queue.counts().get("leased"):
+                idle_since = time.time()
+            elif time.time() - idle_since > idle_timeout:
+                return done
+
+            time.sleep(poll_interval)
+            continue
+
+        dataset, participant_id = job
+        try:
+            if dataset not in loaders:
+                loader = get_loader(dataset)
+                loader.setup(upload=False)
+                loaders[dataset] = loader
+
+            with Heartbeat(queue, worker, dataset, participant_id):
+                results = loaders[dataset].load_participant(participant_id)
+
+            done += queue.complete(worker, dataset, participant_id, results)
+        except Exception as e:
+            print(f"Failed to load {dataset} {participant_id}: {e!r}")
+            queue.fail(worker, dataset, participant_id, repr(e))
+            # The loader may hold part of the failed participant's results, the next job sets up a new one.
+            loaders.pop(dataset, None)
+
+        idle_since = time.time()
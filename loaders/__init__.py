@@ -1,5 +1,35 @@
-"""A loader is  function that reads a specific dataset and returns a FHIR obeject ready for transmission to a server."""
+"""A loader is  function that reads a specific dataset and returns a FHIR obeject ready for transmission to a server.
 
-from .load_wesad import WESADLoader
+Loaders are registered by dataset name and imported on first use, so selecting one dataset does not pay for the
+imports (pandas, scipy, wfdb, ...) of the others."""
 
+import importlib
 
+# Dataset name -> module and class of its loader.
+LOADERS = {
+    "WESAD": ("loaders.load_wesad", "WESADLoader"),
+    "WSPCP": ("loaders.load_wspcp", "WSPCPLoader"),
+    "SDN": ("loaders.load_sdn", "SDNLoader"),
+    "SRAD": ("loaders.load_srad", "SRADLoader"),
+}
+
+
+def get_loader_class(dataset):
+    if dataset not in LOADERS:
+        raise RuntimeError(f"Unknown dataset {dataset}, available datasets: {', '.join(LOADERS)}")
+
+    module_name, class_name = LOADERS[dataset]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def get_loader(dataset, dataset_dir, fhir_server, **kwargs):
+    return get_loader_class(dataset)(dataset_dir, fhir_server, **kwargs)
+
+
+def __getattr__(name):
+    """Loader classes (`loaders.WESADLoader`, ...) are imported on first access (PEP 562)."""
+    for dataset, (_, class_name) in LOADERS.items():
+        if class_name == name:
+            return get_loader_class(dataset)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
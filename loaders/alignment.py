@@ -0,0 +1,71 @@
+"""Alignment of signals sampled at different rates onto a common time grid.
+
+The Empatica E4 records each modality at its own rate (BVP at 64 Hz, ACC at 32 Hz, EDA and TEMP at 4 Hz, HR at
+1 Hz), in the time indexed frames of `resources.empatica_e4.empatica_read_dataframe`. Combining modalities with
+`pd.concat(frames, axis=1)` builds the union of their indexes, mostly NaN, before it can be filtered. `align` instead
+looks up, for each time of a target grid, the sample of each requested modality matching it, by binary search over
+the sorted sample times as `pd.merge_asof` does, so that the result is only as large as the grid:
+
+- "exact": the sample at the time of the grid, NaN if there is none,
+- "backward": the last sample at or before it,
+- "nearest": the closest sample.
+
+    # EDA, TEMP and HR where all of them have a sample, as the features of SDN are computed
+    aligned = align(modalities, modalities["HR"].index, ["EDA", "TEMP", "HR"]).dropna()
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def get_positions(times, grid, method="exact", tolerance=None):
+    """Returns the positions in `times`, sorted sample times in nanoseconds, of the samples matching each time of
+    `grid`, -1 where there is none. `tolerance` (nanoseconds) bounds the distance of matched samples."""
+    times = np.asarray(times, dtype=np.int64)
+    grid = np.asarray(grid, dtype=np.int64)
+    if len(times) == 0:
+        return np.full(len(grid), -1)
+
+    if method == "exact":
+        positions = np.minimum(np.searchsorted(times, grid), len(times) - 1)
+        return np.where(times[positions] == grid, positions, -1)
+
+    if method == "backward":
+        positions = np.searchsorted(times, grid, side="right") - 1
+    elif method == "nearest":
+        after = np.minimum(np.searchsorted(times, grid), len(times) - 1)
+        before = np.maximum(after - 1, 0)
+        positions = np.where(np.abs(grid - times[before]) <= np.abs(times[after] - grid), before, after)
+    else:
+        raise RuntimeError(f"Unknown alignment method {method}, use exact, backward or nearest")
+
+    matched = positions >= 0
+    if tolerance is not None:
+        matched &= np.abs(grid - times[np.maximum(positions, 0)]) <= tolerance
+
+    return np.where(matched, positions, -1)
+
+
+def align(frames, grid, modalities=None, method="exact", tolerance=None):
+    """Returns the samples of the `modalities` of `frames` (all by default), time indexed frames by modality, at the
+    times of `grid`, a DatetimeIndex. Columns are (modality, column) as with `pd.concat(frames, axis=1)`, and
+    unmatched samples are NaN."""
+    modalities = list(frames) if modalities is None else modalities
+    grid_times = grid.asi8
+    tolerance = pd.Timedelta(tolerance).value if tolerance is not None else None
+    columns = []
+    values = []
+    for modality in modalities:
+        frame = frames[modality]
+        if len(frame) == 0:
+            aligned = np.full((len(grid_times), frame.shape[1]), np.nan)
+        else:
+            positions = get_positions(frame.index.asi8, grid_times, method, tolerance)
+            aligned = frame.to_numpy(dtype=float)[np.maximum(positions, 0)]
+            aligned[positions < 0] = np.nan
+
+        columns.extend((modality, column) for column in frame.columns)
+        values.append(aligned)
+
+    return pd.DataFrame(np.hstack(values) if values else np.empty((len(grid_times), 0)), index=grid,
+                        columns=pd.MultiIndex.from_tuples(columns))
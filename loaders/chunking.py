@@ -0,0 +1,57 @@
+"""Splitting of long signals into Observations of bounded size."""
+
+import numpy as np
+
+
+class ChunkPolicy:
+    """Splits a signal into consecutive sample ranges lasting at most `max_seconds` and holding at most `max_bytes`
+    of raw sample data. Both limits are optional, a policy without limits keeps every signal in a single piece. The
+    duration limit only applies to signals with a known sampling frequency."""
+
+    def __init__(self, max_seconds=None, max_bytes=None):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+
+    def chunk_samples(self, frequency=None, sample_nbytes=1):
+        """Returns the maximum number of samples of a chunk, or None if the signal does not need to be split."""
+        limits = []
+        if self.max_seconds is not None and frequency:
+            limits.append(int(self.max_seconds * frequency))
+
+        if self.max_bytes is not None:
+            limits.append(int(self.max_bytes // max(sample_nbytes, 1)))
+
+        if not limits:
+            return None
+
+        return max(min(limits), 1)
+
+    def split(self, n_samples, frequency=None, sample_nbytes=1):
+        """Returns the [start, stop) sample ranges covering `n_samples`."""
+        size = self.chunk_samples(frequency, sample_nbytes)
+        if size is None or n_samples <= size:
+            return [(0, n_samples)]
+
+        return [(start, min(start + size, n_samples)) for start in range(0, n_samples, size)]
+
+
+def sample_nbytes(data):
+    """Average number of bytes per sample (row) of a numpy array or pandas object, including the pandas index."""
+    if len(data) == 0:
+        return 1
+
+    if hasattr(data, "memory_usage"):
+        return max(int(np.sum(data.memory_usage(index=True)) // len(data)), 1)
+
+    data = np.asarray(data)
+    return max(data.itemsize * int(np.prod(data.shape[1:], dtype=int)), 1)
+
+
+def slice_samples(data, start, stop):
+    if hasattr(data, "iloc"):
+        return data.iloc[start:stop]
+
+    return data[start:stop]
+
+
+DEFAULT_CHUNK_POLICY = ChunkPolicy(max_bytes=4 * 1024 * 1024)
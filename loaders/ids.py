@@ -0,0 +1,47 @@
+"""Deterministic identifiers for the resources created by the loaders.
+
+Ids are derived only from the coordinates of the resource (study, participant, session or segment, modality and
+chunk), so any worker can compute them independently and re-uploading a subset of a study overwrites the same
+resources instead of creating new ones."""
+
+import hashlib
+import re
+
+FHIR_ID_MAX_LENGTH = 64
+_INVALID_ID_CHARACTERS = re.compile(r"[^A-Za-z0-9.\-]+")
+
+
+class IdAllocator:
+    def __init__(self, study_id):
+        self.study_id = study_id
+        self.__issued = {}
+
+    def participant_key(self, participant_id):
+        """Some studies (e.g. SDN) already prefix the patient id with the study id. The prefix is dropped so every
+        study produces ids with the same `{study}-{participant}-...` layout."""
+        prefix = f"{self.study_id}-"
+        if participant_id.startswith(prefix):
+            return participant_id[len(prefix):]
+
+        return participant_id
+
+    def get(self, participant_id, *parts, chunk=None):
+        """Returns the id of the resource of `participant_id` identified by `parts` (session/segment, modality, ...).
+        Chunks of a split resource share the parts of their parent and add their chunk number.
+
+        Ids longer than the 64 characters allowed by FHIR are truncated and suffixed with a digest of the full key."""
+        key = [self.study_id, self.participant_key(participant_id)]
+        key.extend(str(part) for part in parts if part is not None and part != "")
+        if chunk is not None:
+            key.append(f"c{chunk:04}")
+
+        resource_id = "-".join(_INVALID_ID_CHARACTERS.sub("-", part).strip("-") for part in key)
+        if len(resource_id) > FHIR_ID_MAX_LENGTH:
+            digest = hashlib.sha1("\x1f".join(key).encode("utf-8")).hexdigest()[:12]
+            resource_id = f"{resource_id[:FHIR_ID_MAX_LENGTH - len(digest) - 1]}-{digest}"
+
+        key = tuple(key)
+        if self.__issued.setdefault(resource_id, key) != key:
+            raise RuntimeError(f"Id {resource_id} allocated to both {self.__issued[resource_id]} and {key}")
+
+        return resource_id
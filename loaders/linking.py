@@ -0,0 +1,52 @@
+"""Deferred linking of container resources (sessions, segments, ...) to their members."""
+
+from connector import PatchBatch
+from utils import get_reference
+
+
+class LinkGraph:
+    """Collects container -> member relationships as a compact edge list while the members are being uploaded, so
+    that each container is written exactly once, after all its members are committed, instead of growing and being
+    re-sent every time a member is added."""
+
+    def __init__(self):
+        self.__containers = {}
+        self.__edges = {}
+
+    def register(self, container):
+        """Registers a container to be written by `commit`. Its id must be set."""
+        self.__containers[get_reference(container)["reference"]] = container
+
+    def add(self, container, member, relation="hasMember"):
+        container_reference = get_reference(container)["reference"]
+        self.__edges.setdefault(container_reference, {}).setdefault(relation, []).append(
+            get_reference(member)["reference"])
+
+    def members(self, container, relation="hasMember"):
+        return list(self.__edges.get(get_reference(container)["reference"], {}).get(relation, []))
+
+    def commit(self, server, containers=None):
+        """Sets the collected references on the registered containers (all of them by default) and writes each one
+        once. Committed containers and their edges are forgotten."""
+        if containers is None:
+            containers = list(self.__containers.values())
+
+        for container in containers:
+            container_reference = get_reference(container)["reference"]
+            for relation, references in self.__edges.pop(container_reference, {}).items():
+                existing = getattr(container, relation) or []
+                setattr(container, relation, existing + [{"reference": reference} for reference in references])
+
+            server.create(container)
+            self.__containers.pop(container_reference, None)
+
+    def patch(self, server):
+        """Appends the collected references of containers that were not registered, i.e. that are already stored on
+        the server, sending a single FHIRPath Patch per container instead of re-writing it."""
+        batch = PatchBatch()
+        for container_reference in [c for c in self.__edges if c not in self.__containers]:
+            for relation, references in self.__edges.pop(container_reference).items():
+                for reference in references:
+                    batch.append_reference(container_reference, relation, {"reference": reference})
+
+        batch.flush(server)
@@ -1,9 +1,7 @@
-import base64
 import os.path
 import datetime
-import pickle
 import tempfile
-import pytz
+from functools import partial
 import numpy as np
 import pandas as pd
 import scipy as scipy
@@ -19,35 +17,111 @@ from fhir.resources.observation import Observation
 from fhir.resources.patient import Patient
 from fhir.resources.period import Period
 from fhir.resources.questionnaire import Questionnaire
-from fhir.resources.questionnaireresponse import QuestionnaireResponse
 
 
+from loaders.alignment import align
 from loaders.loader import Loader
+from loaders.questionnaire_response import QuestionnaireResponseBuilder
+from loaders.shared_arrays import SharedArrayPool, attach_frame, detach
+from loaders.timeline import LabelTimeline
 from resources.empatica_e4 import empatica_e4, empatica_read_dataframe
+from static_resources.search_parameters.codex import get_category, get_component_code
 from utils import get_reference, get_list_of_references
 
+# The study's models also use the means of the 10 previous windows as features. They are not stored, the mean
+# features recording the range of their lags in a "lags" component instead, see `reader.get_lags`.
+MEAN_LAGS = (1, 10)
+
+
+def compute_features(sensor_data, rolling_window_size=40):
+    """Computes the features of the study's notebook (available in the dataset's code repository in GitHub) over a
+    rolling window of the EDA, TEMP and HR signals of a segment. A module level function, so that it can run in the
+    processes of a pipeline."""
+    # The features are computed where EDA, TEMP and HR all have a sample, that is at some of the times of HR, the
+    # slowest of them.
+    features = align(sensor_data, sensor_data["HR"].index, ["EDA", "TEMP", "HR"])
+    features.columns = features.columns.droplevel(1)
+    features_selector = ~features.isnull().any(axis=1)
+    features = features[features_selector]
+    # Whether pandas infers the frequency of the index depends on how the signals were sliced, it is not kept.
+    features.index.freq = None
+
+    new_features = features.loc[:, ["TEMP", "HR"]].rolling(rolling_window_size).agg([
+        np.amin,
+        np.amax,
+        np.mean,
+        np.std, ])
+
+    __peaks_cache = {}
+
+    def num_peaks(arr):
+        peaks, properties = find_peaks(arr, width=5)
+        __peaks_cache.update(properties)
+        return len(peaks)
+
+    def amplitude(arr):
+        prominences = np.array(__peaks_cache['prominences'])
+        amplitude = np.sum(prominences)
+        return amplitude
+
+    def duration(arr):
+        widths = np.array(__peaks_cache['widths'])
+        duration = np.sum(widths)
+        return duration
+
+    eda_features = features.loc[:, ["EDA"]].rolling(rolling_window_size).agg([
+        np.amin,
+        np.amax,
+        np.mean,
+        np.std,
+        scipy.stats.kurtosis,
+        scipy.stats.skew,
+        num_peaks,
+        amplitude,
+        duration
+    ])
+
+    return pd.concat([eda_features, new_features], axis=1)
+
+
+def get_shared_features(shared_data, rolling_window_size=40):
+    """Pipeline stage computing the features of a segment from the shared memory descriptors of its sensor data, see
+    `SDNLoader.read_participants`. Returns None if no features were selected."""
+    if not shared_data:
+        return None
+
+    sensor_data = {name: attach_frame(shared) for name, shared in shared_data.items()}
+    # The features are copied out of any view of the shared memory, whose blocks are then closed in this process:
+    # the pool unlinks and reuses them, and a worker keeping them open would keep every block it ever attached.
+    features = compute_features(sensor_data, rolling_window_size).copy(deep=True)
+    del sensor_data
+    detach()
+    return features
+
 
 class SDNLoader(Loader):
     """Implements the loader abstract class to load the stress detection in Nurses (SDN)"""
 
-    def __init__(self, dataset_dir, fhir_server):
+    def __init__(self, dataset_dir, fhir_server, **kwargs):
         self.device_separator = "E4"
         study_title = "Stress Detection in Nurses"
         study_id = "SDN"
         autor = "Hosseini et al."
         date = "06.2022"
-        super().__init__(dataset_dir, fhir_server, study_id, study_title, autor, date)
+        super().__init__(dataset_dir, fhir_server, study_id, study_title, autor, date, **kwargs)
 
         self.survey_results_file_name = "SurveyResults.xlsx"
         self.survey_results_sheet = "in"
         self.sensor_data_folder = "Stress_dataset"
-        self.survey = self.load_survey_results()
-        self.load_questionnaire()
+        self.signal_freq = {"ACC": 32, "BVP": 64, "EDA": 4, "HR": 1, "TEMP": 4}
+        self.survey = None
+        self.shared_arrays = None
 
         # Items necessary to compute extracted features. This is part of the information contained in the
         # jupyter notebook available in the dataset's code repository in GitHub.
 
         self.rolling_window_size = 40
+        self.feature_modalities = ["EDA", "TEMP", "HR"]
         self.feature_columns = [
             'EDA_Mean', 'EDA_Min', 'EDA_Max', 'EDA_Std',
             'EDA_Kurtosis', 'EDA_Skew', 'EDA_Num_Peaks', 'EDA_Amplitude', 'EDA_Duration',
@@ -55,6 +129,11 @@ class SDNLoader(Loader):
             'TEMP_Mean', 'TEMP_Min', 'TEMP_Max', 'TEMP_Std'
         ]
 
+    def prepare(self, upload=True):
+        self.survey = self.load_survey_results()
+        if upload:
+            self.load_questionnaire()
+
     def generate_item_linkId(self, num):
         return f"{self.study_id}-questionnaire-{num + 1:02}"
 
@@ -116,35 +195,77 @@ class SDNLoader(Loader):
         return [device], [resources], [device_association]
 
     def read_dataset(self):
-        for participant in self.patients:
-            self.read_participant(participant)
-
-        return
+        self.read_participants(self.get_selected_patients())
 
     def read_participant(self, participant):
-        for label, sensor_data, questionnaire in self.get_participant_logs(participant):
-            observations = self.encode_observation_data(sensor_data, participant)
-            (self.device_observations
-                .setdefault(participant.id, {})
-                .setdefault(self.get_empatica_id(participant), [])
-                .extend([o.id for o in observations]))
-
-            questionnaire_response = self.encode_questionnaire_responses(questionnaire, participant)
-            self.questionnaire_responses.setdefault(participant.id, []).append([qr.id for qr in questionnaire_response])
-            self.upload_data(observations, questionnaire_response)
-
-            estimated_observations = self.compute_features(sensor_data, participant)
-            self.estimated_observations.setdefault(participant.id, []).extend([o.id for o in estimated_observations])
-            self.link_derived_from(estimated_observations, observations)
-            self.upload_data(estimated_observations)
-
-            reference = self.encode_label(label, participant)
-            self.reference_observations.setdefault(participant.id, []).append(reference)
-            self.link_has_member(reference, observations, questionnaire_response)
-            self.upload_data(reference)
-
-            self.link_part_of(reference, questionnaire_response)
-            self.upload_data(questionnaire_response)
+        self.read_participants([participant])
+
+    def read_participants(self, participants):
+        """Loads the segments of `participants` through a pipeline: segments are parsed, their features computed in
+        `self.max_workers` processes, encoded and uploaded concurrently, and recorded in order. The signals the
+        features are computed from are copied once per recording into shared memory, each segment being passed to the
+        processes as views of them.
+
+        Every resource is written once: the label Observation is uploaded after its members, and questionnaire
+        responses, linked to the label through `partOf`, after the label."""
+        pipeline = self.pipeline()
+        pipeline.add_stage("features", partial(get_shared_features, rolling_window_size=self.rolling_window_size),
+                           workers=self.max_workers, processes=True, key="features", argument="shared_data")
+        pipeline.add_stage("encode", self.encode_segment)
+        pipeline.add_stage("upload", self.upload_segment, workers=2)
+        with SharedArrayPool() as self.shared_arrays:
+            for segment in pipeline.run(self.get_segments(participants), source="parse"):
+                self.record_segment(segment)
+
+        self.shared_arrays = None
+
+    def get_segments(self, participants):
+        for participant in participants:
+            for segment, label, sensor_data, questionnaire, shared_data in self.get_participant_logs(
+                    participant, self.shared_arrays):
+                yield {"participant": participant, "segment": segment, "label": label, "sensor_data": sensor_data,
+                       "questionnaire": questionnaire, "shared_data": shared_data}
+
+    def encode_segment(self, segment):
+        """Encodes the signals, features, label and questionnaire responses of a segment and links them."""
+        participant, segment_id, label = segment["participant"], segment["segment"], segment["label"]
+        for shared in segment.pop("shared_data").values():
+            self.shared_arrays.release_frame(shared)
+
+        segment["observations"], segment["chunks"] = self.encode_observation_data(segment.pop("sensor_data"),
+                                                                                  participant, segment_id,
+                                                                                  label=label["value"])
+        segment["questionnaire_responses"] = self.encode_questionnaire_responses(segment.pop("questionnaire"),
+                                                                                 participant, segment_id)
+        features = segment.pop("features")
+        segment["estimated_observations"], segment["estimated_chunks"] = self.encode_observation_data(
+            features if features is not None else {}, participant, segment_id, is_device=False, label=label["value"])
+        self.link_derived_from(segment["estimated_observations"], segment["observations"])
+
+        segment["reference"] = self.encode_label(label, participant, segment_id)
+        self.link_has_member(segment["reference"], segment["observations"])
+        self.link_part_of(segment["reference"], segment["questionnaire_responses"])
+        return segment
+
+    def upload_segment(self, segment):
+        self.upload_data(segment["chunks"], segment["observations"])
+        self.upload_data(segment["estimated_chunks"], segment["estimated_observations"])
+        self.catalog_uploaded(segment["observations"] + segment["estimated_observations"])
+        self.upload_data(segment["reference"])
+        self.upload_data(segment["questionnaire_responses"])
+        return segment
+
+    def record_segment(self, segment):
+        participant = segment["participant"]
+        (self.device_observations
+            .setdefault(participant.id, {})
+            .setdefault(self.get_empatica_id(participant), [])
+            .extend([o.id for o in segment["observations"]]))
+        self.questionnaire_responses.setdefault(participant.id, []).extend(
+            [qr.id for qr in segment["questionnaire_responses"]])
+        self.estimated_observations.setdefault(participant.id, []).extend(
+            [o.id for o in segment["estimated_observations"]])
+        self.reference_observations.setdefault(participant.id, []).append(segment["reference"].id)
 
     def upload_data(self, *data):
         for data_ in data:
@@ -152,115 +273,154 @@ class SDNLoader(Loader):
                 self.server.create(data_)
 
             else:
-                for item_ in data_:
-                    self.server.create(item_)
+                self.server.create_all(data_)
 
-    def get_participant_logs(self, participant):
+    def get_participant_logs(self, participant, pool: SharedArrayPool = None):
+        """Yields the (segment, label, sensor data, questionnaire answers, shared data) of every segment of the
+        participant's recordings. With a `pool`, the shared data are descriptors of the segment's rows of the signals
+        features are computed from, in shared memory, else it is empty."""
         data_folder_id = participant.id[-2:]
         data_folder = os.path.join(self.dataset_dir, data_folder_id, "*")
+        features_selected = self.features_selected()
         for zip_file in glob(data_folder):
-            date_time = datetime.datetime.fromtimestamp(int(os.path.basename(zip_file)[3:-4]),
-                                                        tz=pytz.timezone("US/Central"))
+            session_timestamp = os.path.basename(zip_file)[3:-4]
             with ZipFile(zip_file) as zip_io:
+                # Only the files of the selected modalities, and those features are computed from, are extracted.
+                members = [name for name in zip_io.namelist()
+                           if self.selection.includes_modality(name[:-4], self.get_empatica_id(participant))
+                           or (features_selected and name[:-4] in self.feature_modalities)]
                 with tempfile.TemporaryDirectory() as temp_dir:
-                    zip_io.extractall(temp_dir)
+                    zip_io.extractall(temp_dir, members)
                     modalities = empatica_read_dataframe(temp_dir, tz="US/Central")
-                    for label, sensor_data, questionnaires in self.synchronize_labels_and_sensors(modalities,
-                                                                                                  data_folder_id):
-                        yield label, sensor_data, questionnaires
 
-    def synchronize_labels_and_sensors(self, modalities, participant_dir):
-        labels = self.survey.loc[(slice(None), participant_dir), :]
-        chunk_ids = set()
-        for mod_name, mod_values in modalities.items():
-            if len(mod_values) == 0:
-                continue
+            for name, data in modalities.items():
+                if len(data) > 0:
+                    first, stop = self.selection.get_times_range(data.index.asi8 / 1e9, float(session_timestamp))
+                    if (first, stop) != (0, len(data)):
+                        modalities[name] = data.iloc[first:stop].copy()
+
+            shared_modalities = {}
+            if pool is not None and features_selected:
+                shared_modalities = {name: pool.put_frame(modalities[name]) for name in self.feature_modalities
+                                     if len(modalities.get(name, ())) > 0}
+
+            try:
+                for chunk_id, label, sensor_data, questionnaires, rows in self.synchronize_labels_and_sensors(
+                        modalities, data_folder_id):
+                    if not self.selection.includes_label(label["value"]):
+                        continue
+
+                    shared_data = {name: pool.view_frame(shared, *rows[name])
+                                   for name, shared in shared_modalities.items() if name in rows}
+
+                    yield f"{session_timestamp}-{chunk_id:03}", label, sensor_data, questionnaires, shared_data
 
-            mod_values["label"] = -1
-            start_time = mod_values.index[0]
-            end_time = mod_values.index[-1]
-            applicable_labels = (labels["Start time"] > start_time) & (labels["Start time"] < end_time)
-            for idx, start, end in labels.loc[applicable_labels, ["Start time", "End time"]].itertuples():
-                mod_values.loc[start:end, "label"] = idx[0]
+            finally:
+                for shared in shared_modalities.values():
+                    pool.release_frame(shared)
 
-            mod_values["chunk"] = (mod_values["label"].diff().fillna(0) != 0).cumsum()
-            chunk_ids.update(mod_values["chunk"])
+    def features_selected(self):
+        return any(self.selection.includes_modality(name) for name in self.feature_modalities)
 
-        for chunk_id in chunk_ids:
+    def synchronize_labels_and_sensors(self, modalities, participant_dir):
+        """Yields the (chunk id, label, sensor data, questionnaire answers, rows) of every run of labels of a recording,
+        `rows` being the range of rows of each modality in the run. The labels are the periods of the survey starting
+        during the recording, a period taking precedence over the ones before it, and -1 between them."""
+        labels = self.survey.loc[(slice(None), participant_dir), :]
+        times = {mod_name: mod_values.index.asi8 for mod_name, mod_values in modalities.items() if len(mod_values) > 0}
+        if not times:
+            return
+
+        start = min(mod_times[0] for mod_times in times.values())
+        end = max(mod_times[-1] for mod_times in times.values()) + 1
+        # Timeline in nanoseconds, the end times of the survey being inclusive.
+        periods = [(start_time.value, end_time.value + 1, idx[0])
+                   for idx, start_time, end_time in labels.loc[:, ["Start time", "End time"]].itertuples()
+                   if start < start_time.value < end - 1]
+        timeline = LabelTimeline.from_periods(periods, start, end, default=-1, frequency=1e9)
+
+        chunk_id = 0
+        for run, (run_start, run_end, chunk_label_idx) in enumerate(timeline):
             sensor_data = {}
-            chunk_label_idx = set()
-            start_time = datetime.datetime.now(tz=pytz.timezone("US/Central"))
-            end_time = pd.Timestamp(0, tz=pytz.timezone("US/Central"))
+            rows = {}
             for mod_name, mod_values in modalities.items():
                 if len(mod_values) == 0:
                     sensor_data[mod_name] = mod_values
                     continue
 
-                indexer = mod_values["chunk"] == chunk_id
-                if not indexer.any():
+                first, stop = np.searchsorted(times[mod_name], [run_start, run_end])
+                if first == stop:
                     continue
 
-                sensor_data[mod_name] = mod_values[indexer].drop(["label", "chunk"], axis=1)
-                chunk_label_idx.update(mod_values[indexer]["label"])
-                start_time = min(mod_values[indexer].index[0], start_time)
-                end_time = max(mod_values[indexer].index[-1], end_time)
+                rows[mod_name] = (int(first), int(stop))
+                sensor_data[mod_name] = mod_values.iloc[first:stop]
+
+            if not rows:
+                continue
 
-            chunk_label_idx = chunk_label_idx.pop()
+            start_time = min(modalities[mod_name].index[first] for mod_name, (first, _) in rows.items())
+            end_time = max(modalities[mod_name].index[stop - 1] for mod_name, (_, stop) in rows.items())
             label = {"start_time": start_time, "end_time": end_time, "value": -1}
             if chunk_label_idx == -1:
-                yield label, sensor_data, []
+                yield chunk_id, label, sensor_data, [], rows
 
             else:
                 label["value"] = labels.loc[(chunk_label_idx, participant_dir), "Stress level"]
                 questions = labels.loc[(chunk_label_idx, participant_dir), "COVID related":]
-                yield label, sensor_data, questions
+                yield chunk_id, label, sensor_data, questions, rows
+
+            chunk_id += 1
 
-    def encode_observation_data(self, sensor_data, participant, is_device=True):
+    def encode_observation_data(self, sensor_data, participant, segment, is_device=True, label=None):
+        """Returns the Observations of every modality in `sensor_data` and the chunks they were split into."""
         observations = []
+        chunks = []
         for metric, data in sensor_data.items():
             if len(data) == 0:
                 continue
 
+            frequency = self.signal_freq.get(metric) if is_device else None
             if isinstance(metric, tuple):
                 metric = "-".join(metric)
                 metric = metric.replace("_", "-")
 
-            obs = Observation(
-                    id=f"{participant.id}-E4-{metric.lower()}-{self.observation_idx:05d}",  # participant.id includes study_id
-                    status="final",
-                    effectivePeriod=Period(start=data.index[0], end=data.index[-1]),
-                    code={"coding": [{"code": f"{metric}"}]},
-                    # device={"reference": f"DeviceMetric/{self.study_id}-E4-{participant.id}-{metric.lower()}-dm"},
-                    valueAttachment={
-                        "contentType": "application/python-pickle",
-                        "data": base64.encodebytes(pickle.dumps(data)).decode("utf-8")}
-                )
+            if not self.selection.includes_modality(metric, self.get_empatica_id(participant) if is_device else None):
+                continue
 
+            properties = {}
             if is_device:
-                obs.device = {"reference": f"DeviceMetric/{self.study_id}-E4-{participant.id}-{metric.lower()}-dm"}
+                properties["device"] = {
+                    "reference": f"DeviceMetric/{self.study_id}-E4-{participant.id}-{metric.lower()}-dm"}
+
+            elif metric.endswith("-mean"):
+                properties["component"] = [{"code": get_component_code("lags"),
+                                            "valueRange": {"low": {"value": MEAN_LAGS[0], "unit": "sample"},
+                                                           "high": {"value": MEAN_LAGS[1], "unit": "sample"}}}]
+
+            obs, obs_chunks = self.encode_signal(
+                (participant.id, segment, "E4" if is_device else "features", metric.lower()),
+                data,
+                frequency=frequency,
+                label=label,
+                category="signal" if is_device else "feature",
+                status="final",
+                code={"coding": [{"code": f"{metric}"}]},
+                **properties)
 
             observations.append(obs)
-        return observations
+            chunks.extend(obs_chunks)
+        return observations, chunks
 
-    def encode_questionnaire_responses(self, questionnaire, participant):
+    def encode_questionnaire_responses(self, questionnaire, participant, segment):
         if len(questionnaire) == 0:
             return []
 
-        responses = []
+        response = QuestionnaireResponseBuilder(self.get_questionnaire_reference(), get_reference(participant),
+                                                meta=self.get_meta(participant.id))
         for q_id, answer in enumerate(questionnaire):
-            stuqr = QuestionnaireResponse(
-                id=f"{self.study_id}-{participant.id}-{self.observation_idx:05}-qr",
-                questionnaire=self.get_questionnaire_reference(),
-                status="completed",
-                source=get_reference(participant),
-                item=[{
-                    "linkId": self.generate_item_linkId(q_id),
-                    "answer": [{"valueString": answer}]}
-                ])
-
-            responses.append(stuqr)
+            response.add(self.generate_item_linkId(q_id), {"valueString": str(answer)})
 
-        return responses
+        return [response.build(self.ids.get(participant.id, segment, "qr"))]
 
     def get_body_structures(self, participant):
         return {"dominant hand":
@@ -269,68 +429,25 @@ class SDNLoader(Loader):
                                   includedStructure=[{"structure": {"coding": [{"code": "Dominant Wrist"}]}}],
                                   description="Dominant wrist")}
 
-    def compute_features(self, sensor_data, participant):
-        features = pd.concat(sensor_data, axis=1).loc[:, ["EDA", "TEMP", "HR"]]
-        features.columns = features.columns.droplevel(1)
-        features_selector = ~features.isnull().any(axis=1)
-        features = features[features_selector]
-
-        new_features = features.loc[:, ["TEMP", "HR"]].rolling(self.rolling_window_size).agg([
-            np.amin,
-            np.amax,
-            np.mean,
-            np.std, ])
-
-        __peaks_cache = {}
-
-        def num_peaks(arr):
-            peaks, properties = find_peaks(arr, width=5)
-            __peaks_cache.update(properties)
-            return len(peaks)
-
-        def amplitude(arr):
-            prominences = np.array(__peaks_cache['prominences'])
-            amplitude = np.sum(prominences)
-            return amplitude
-
-        def duration(arr):
-            widths = np.array(__peaks_cache['widths'])
-            duration = np.sum(widths)
-            return duration
-
-        eda_features = features.loc[:, ["EDA"]].rolling(self.rolling_window_size).agg([
-            np.amin,
-            np.amax,
-            np.mean,
-            np.std,
-            scipy.stats.kurtosis,
-            scipy.stats.skew,
-            num_peaks,
-            amplitude,
-            duration
-        ])
-
-        features = pd.concat([eda_features, new_features], axis=1)
-
-        lag_features = pd.concat([features.loc[:, (slice(None), "mean")].copy().shift(i+1) for i in range(10)], axis=1,
-                                 keys=[f"shifted_mean_{i:02}" for i in range(10)])
-        lag_features.columns = lag_features.columns.droplevel(2).swaplevel(0, 1)
-
-        features = pd.concat([features, lag_features], axis=1)
-        return self.encode_observation_data(features, participant, is_device=False)
-
-    def link_derived_from(self, estimated_observations, observations):
-        modality_dict = {o.id.split("-")[-2]:o for o in observations}
+    @staticmethod
+    def link_derived_from(estimated_observations, observations):
+        """Features are coded as `{modality}-{feature}`, while device observations are coded by their modality."""
+        modality_dict = {o.code.coding[0].code: o for o in observations}
 
         for observation in estimated_observations:
-            e4_marker = observation.id.index(self.device_separator, len(self.study_id) + 2)
-            modality = observation.id[e4_marker+3:].split("-")[0]
-            base_observation = modality_dict[modality]
+            modality = observation.code.coding[0].code.split("-")[0]
+            base_observation = modality_dict.get(modality)
+            if base_observation is None:
+                # The signal was not selected.
+                continue
+
             observation.derivedFrom = [get_reference(base_observation)]
 
-    def encode_label(self, label, participant):
+    def encode_label(self, label, participant, segment):
         label_observation = Observation(
-                    id=f"{self.study_id}-{participant.id}-{self.observation_idx:05}",
+                    id=self.ids.get(participant.id, segment, "stress"),
+                    meta=self.get_meta(participant.id, label=label["value"]),
+                    category=get_category("label"),
                     status="final",
                     code={"coding": [{"code": f"stress"}]},
                     valueString=str(label["value"]),
@@ -340,10 +457,8 @@ class SDNLoader(Loader):
         return label_observation
 
     @staticmethod
-    def link_has_member(reference, observations, questionnaire_response):
-        reference.hasMember = []
-        reference.hasMember.extend(get_list_of_references(observations))
-        reference.hasMember.extend(get_list_of_references(questionnaire_response))
+    def link_has_member(reference, observations):
+        reference.hasMember = get_list_of_references(observations)
 
     @staticmethod
     def link_part_of(reference, questionnaire_response):
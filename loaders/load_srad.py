@@ -1,12 +1,9 @@
-import base64
 import os
-import pickle
-from datetime import date
+from datetime import date, timedelta
 
 import wfdb
 from fhir.resources.bodystructure import BodyStructure
 from fhir.resources.deviceassociation import DeviceAssociation
-from fhir.resources.observation import Observation
 from fhir.resources.patient import Patient
 
 from loaders.loader import Loader
@@ -15,13 +12,27 @@ from utils import get_reference
 
 
 class SRADLoader(Loader):
-    def __init__(self, dataset_dir, fhir_server):
+    def __init__(self, dataset_dir, fhir_server, **kwargs):
         self.body_locations = ["chest", "left shoulder", "diaphragm", "left foot", "left hand"]
         self.device_separator = "Recorder"
+        # Part of a WFDB channel name, lowercase, -> metric of the recorder's DeviceMetric, as the headers of the drives
+        # spell the channels differently (e.g. "foot GSR" and "Foot GSR"). Other channels are their own metric.
+        self.channel_metrics = {"foot": "sc-1", "hand": "sc-2", "marker": "EMG"}
+        # HR is derived from the EKG by the dataset's authors, not recorded, and the recorder has no DeviceMetric for
+        # it, so it is not uploaded.
+        self.skipped_channels = {"hr"}
+        # Signals are read as float32 (`return_res` of `wfdb.rdrecord`), enough for the 16 bit samples of the drives.
+        self.signal_resolution = 32
         study_id = "SRAD"
         title = "Detecting Stress During Real-World Driving Tasks Using Physiological Sensors"
-        data_name = next(os.walk(dataset_dir))[1][0]
-        super().__init__(os.path.join(dataset_dir, data_name), fhir_server, study_id, title, "Healey and Picard", date(day=16, month=6, year=2005))
+        super().__init__(dataset_dir, fhir_server, study_id, title, "Healey and Picard",
+                         date(day=16, month=6, year=2005), **kwargs)
+        self.download_dir = dataset_dir
+
+    def prepare(self, upload=True):
+        # The records are in the directory the archive unzips to, which does not exist before the download.
+        data_name = next(os.walk(self.download_dir))[1][0]
+        self.dataset_dir = os.path.join(self.download_dir, data_name)
 
     def get_patients(self):
         with open(os.path.join(self.dataset_dir, "RECORDS")) as records:
@@ -74,43 +85,87 @@ class SRADLoader(Loader):
                 }
 
     def read_dataset(self):
-        for participant in self.patients:
-            self.read_participant(participant)
-
-        return
-
-    def read_participant(self, participant):
-        record = wfdb.rdrecord(os.path.join(self.dataset_dir, participant.id)).to_dataframe()
-        observations = []
-        for metric in record.columns:
-            modality_df = record[metric]
-            if "foot" in metric.lower():
-                metric = "sc-1"
+        self.read_participants(self.get_selected_patients())
+
+    def get_channel_metrics(self, channel_names):
+        """Returns the (channel index, channel name, metric) of every channel that is uploaded."""
+        channels = []
+        for idx, channel in enumerate(channel_names):
+            name = channel.strip().lower()
+            if name in self.skipped_channels:
+                continue
 
-            if "hand" in metric.lower():
-                metric = "sc-2"
+            metric = next((metric for part, metric in self.channel_metrics.items() if part in name), channel.strip())
+            channels.append((idx, channel, metric))
 
-            if "marker" in metric:
-                metric = "EMG"
+        return channels
 
-            if metric == "HR":
-                # HR is a derived TODO
+    def read_participant(self, participant):
+        self.read_participants([participant])
+
+    def read_participants(self, participants):
+        """Records are read, encoded and uploaded by the stages of a pipeline, the next record being read while the
+        previous one is encoded and uploaded."""
+        pipeline = self.pipeline()
+        pipeline.add_stage("encode", self.encode_record)
+        pipeline.add_stage("upload", self.upload_record)
+        for record in pipeline.run(self.read_records(participants), source="parse"):
+            (self.device_observations
+                .setdefault(record["participant"].id, {})
+                .setdefault(self.get_srad_recorder_id(record["participant"]), [])
+                .extend([obs.id for obs in record["observations"]]))
+
+    def read_records(self, participants):
+        """Reads the selected channels and samples of the participants' records."""
+        if not self.selection.includes_session("drive") or not self.selection.includes_label("drive"):
+            return
+
+        for participant in participants:
+            record_name = os.path.join(self.dataset_dir, participant.id)
+            header = wfdb.rdheader(record_name)
+            channels = [(idx, channel, metric) for idx, channel, metric in self.get_channel_metrics(header.sig_name)
+                        if self.selection.includes_modality(channel, self.get_srad_recorder_id(participant))]
+            first, stop = self.selection.get_sample_range(header.sig_len, header.fs, header.base_datetime)
+            if not channels or stop <= first:
                 continue
 
-            obs = Observation(
-                id=f"{self.study_id}-{participant.id}-{self.observation_idx:05}-{metric.lower()}",
+            wfdb_record = wfdb.rdrecord(record_name, sampfrom=first, sampto=stop,
+                                        channels=[idx for idx, _, _ in channels], return_res=self.signal_resolution)
+            yield {"participant": participant, "channels": channels, "record": wfdb_record, "offset": first}
+
+    def encode_record(self, record):
+        participant, wfdb_record = record["participant"], record.pop("record")
+        # Samples x channels physical values, each column is encoded as a (strided) view without copying the record.
+        signals = wfdb_record.p_signal
+        start = wfdb_record.base_datetime
+        if start is not None and record["offset"]:
+            start += timedelta(seconds=record["offset"] / wfdb_record.fs)
+
+        record["chunks"] = []
+        record["observations"] = []
+        for column, (_, channel, metric) in enumerate(record["channels"]):
+            obs, obs_chunks = self.encode_signal(
+                (participant.id, "drive", channel.lower()),
+                signals[:, column],
+                frequency=wfdb_record.fs,
+                start=start,
+                offset=record["offset"],
+                label="drive",
+                session="drive",
                 status="final",
                 code={"coding": [{"code": f"drive exercise"}]},
-                device={"reference": f"DeviceMetric/{self.get_srad_recorder_id(participant)}-{metric.lower()}-dm"},
-                valueAttachment={
-                    "contentType": "application/python-pickle",
-                    "data": base64.encodebytes(pickle.dumps(modality_df)).decode("utf-8")}
-            )
+                device={"reference": f"DeviceMetric/{self.get_srad_recorder_id(participant)}-{metric.lower()}-dm"})
+
+            record["chunks"].extend(obs_chunks)
+            record["observations"].append(obs)
 
-            observations.append(obs)
+        return record
 
-        for obs in observations:
-            self.server.create(obs)
+    def upload_record(self, record):
+        self.server.create_all(record.pop("chunks"))
+        self.server.create_all(record["observations"])
+        self.catalog_uploaded(record["observations"])
+        return record
 
     def get_srad_recorder_id(self, participant):
         return f"{self.study_id}-{self.device_separator}-{participant.id}"
@@ -1,7 +1,5 @@
-import base64
 import os
 import pickle
-import re
 from collections import OrderedDict
 from datetime import date
 
@@ -16,13 +14,16 @@ from fhir.resources.observation import Observation
 from fhir.resources.patient import Patient
 from fhir.resources.quantity import Quantity
 from fhir.resources.questionnaire import Questionnaire
-from fhir.resources.questionnaireresponse import QuestionnaireResponse
 from fhir.resources.range import Range
 
 from loaders.loader import Loader
+from loaders.questionnaire_response import QuestionnaireResponseBuilder
+from loaders.timeline import LabelTimeline
+from loaders.wesad_metadata import read_participant_metadata
 from resources.empatica_e4 import empatica_e4
 from resources.respiban_pro import respiban_pro
 from static_resources.questionnaires import get_link_id, get_questionnaire_url
+from static_resources.search_parameters.codex import get_category
 from utils import get_reference, get_list_of_references
 
 
@@ -40,14 +41,16 @@ def generate_item(num, item):
 class WESADLoader(Loader):
     """Implements the Loader abstract class to load the WESAD dataset."""
 
-    def __init__(self, dataset_dir, fhir_server):
+    def __init__(self, dataset_dir, fhir_server, **kwargs):
         study_id = "WESAD"
         title = "Wearable Stress and Affect Detection"
-        super().__init__(os.path.join(dataset_dir, "WESAD"), fhir_server, study_id, title, "Schmidt et al.", date(day=16, month=10, year=2018))
+        super().__init__(os.path.join(dataset_dir, "WESAD"), fhir_server, study_id, title, "Schmidt et al.",
+                         date(day=16, month=10, year=2018), **kwargs)
 
         self.sessions = {}
         self.questionnaires = ["PANAS", "SAM", "STAI", "SSSQ"]
-        self.stress_session_label = "stress"
+        # Name of the stress session in the quest files.
+        self.stress_session_label = "TSST"
         self.label_codes = {
             0: "not defined / transient",
             1: "baseline",
@@ -79,14 +82,10 @@ class WESADLoader(Loader):
             "Did you smoke within the last hour?",
             "Do you feel ill today?"
         ]
-        self.load_study_prerequisites_questionnaire()
 
-
-
-    def resample_labels(self, labels, metric):
-        idx = np.round(np.arange(0, len(labels) * 1 / self.label_f, 1 / self.signal_freq[metric.lower()]) / (
-                1 / self.label_f)).astype(int)
-        return labels[idx]
+    def prepare(self, upload=True):
+        if upload:
+            self.load_study_prerequisites_questionnaire()
 
     def resample_indices_range(self, range, metric):
         low, high = range
@@ -96,49 +95,73 @@ class WESADLoader(Loader):
         return low, high
 
     def read_dataset(self):
-        for participant in self.patients:
-            self.read_participant(participant)
-
-        return
+        self.read_participants(self.get_selected_patients())
 
     def read_participant(self, participant):
+        self.read_participants([participant])
+
+    def read_participants(self, participants):
+        """The pickle of the next participant is read while the current one is loaded. The segments of a participant
+        are linked to its sessions as they are encoded, so they are encoded and uploaded in a single stage."""
+        pipeline = self.pipeline(max_queue_size=1)
+        pipeline.add_stage("load", self.load_participant_data)
+        for _ in pipeline.run(self.read_participant_data(participants), source="parse"):
+            pass
+
+    def read_participant_data(self, participants):
+        for participant in participants:
+            with open(f"{self.dataset_dir}/{participant.id}/{participant.id}.pkl", "br") as data_file:
+                yield participant, pickle.load(data_file, encoding='latin1')
+
+    def load_participant_data(self, item):
+        """Session Observations are written once, after all their segments are uploaded. Questionnaire responses
+        are linked to their session through `partOf` and are therefore uploaded after the sessions."""
+        participant, self.participant_data = item
         self.load_readme_file(participant)
         self.load_sessions(participant)
-        for questionnaire in self.questionnaires:
-            self.load_questionnaire_answers(questionnaire, participant)
-
-        self.participant_data = pickle.load(open(f"{self.dataset_dir}/{participant.id}/{participant.id}.pkl", "br"),
-                                            encoding='latin1')
 
         current_session = self.transient_session[participant.id]
         session_times = self.session_times[participant.id]
         sessions = iter(self.sessions[participant.id])
-        for block in zip(session_times[:-1], session_times[1:]):
-            label = self.participant_data["label"][slice(*block)]
-            label_blocks = np.concatenate(([0], np.abs(np.diff(label)).cumsum()))
-            block_ids = set(label_blocks)
-            for bid in block_ids:
-                observation_members = []
-                observation_members.extend(
-                    self.load_empatica_observations(block, bid, label, label_blocks, participant))
-
-                selector = (label_blocks == bid)
-                observation_members.extend(self.read_raspiban_observations(block, label, participant, selector))
+        for block_number, block in enumerate(zip(session_times[:-1], session_times[1:])):
+            timeline = LabelTimeline.from_samples(self.participant_data["label"][slice(*block)], self.label_f)
+            # Segments are numbered by the cumulated label changes since the beginning of the block.
+            segment_numbers = np.concatenate(([0], np.abs(np.diff(timeline.values)).cumsum()))
+            for run, (_, _, value) in enumerate(timeline):
+                segment = f"segment-{block_number:02}-{segment_numbers[run]:02}"
+                session = current_session.code.coding[0].code
+                if not self.selection.includes_session(session) \
+                        or not self.selection.includes_label(self.label_codes[value]):
+                    continue
+
+                with self.timer("encode"):
+                    observation_members, chunks = self.load_empatica_observations(block, timeline, run, participant,
+                                                                                  segment, session)
+
+                    respiban_members, respiban_chunks = self.read_raspiban_observations(block, timeline, run,
+                                                                                        participant, segment, session)
+                    observation_members.extend(respiban_members)
+                    chunks.extend(respiban_chunks)
+
+                if not observation_members:
+                    continue
 
                 parent_ = Observation(
-                    id=f"WESAD-{participant.id}-{self.observation_idx:05}",
+                    id=self.ids.get(participant.id, segment),
+                    meta=self.get_meta(participant.id, session=session, label=self.label_codes[value]),
+                    category=get_category("segment"),
                     status="final",
-                    code={"coding": [{"code": f"{self.label_codes[label[selector][0]]}"}]},
-                    valueInteger=label[selector][0],
+                    code={"coding": [{"code": f"{self.label_codes[value]}"}]},
+                    valueInteger=value,
                     hasMember=get_list_of_references(observation_members),
                     subject=get_reference(participant))
 
                 self.reference_observations[participant.id].append(parent_.id)
-                current_session.hasMember.append(get_reference(parent_))
-
-                for obs in observation_members:
-                    self.server.create(obs)
+                self.links.add(current_session, parent_)
 
+                self.server.create_all(chunks)
+                self.server.create_all(observation_members)
+                self.catalog_uploaded(observation_members)
                 self.server.create(parent_)
 
             if current_session == self.transient_session[participant.id]:
@@ -147,52 +170,82 @@ class WESADLoader(Loader):
                 current_session = self.transient_session[participant.id]
 
         self.load_session_observations(participant)
+        for questionnaire in self.questionnaires:
+            self.load_questionnaire_answers(questionnaire, participant)
+
+        self.participant_data = None
 
-    def read_raspiban_observations(self, block, label, participant, selector):
+    def read_raspiban_observations(self, block, timeline, run, participant, segment, session):
+        """Returns the Observations of the RespiBAN signals during `run` of the label `timeline` of a block, sampled
+        like the labels."""
         observation_members = []
+        chunks = []
         respiban_data = self.participant_data["signal"]["chest"]
-        device_data = self.device_observations[participant.id][self.get_respiban_id(participant.id)] = []
+        device_data = (self.device_observations
+                       .setdefault(participant.id, {})
+                       .setdefault(self.get_respiban_id(participant.id), []))
         for metric in respiban_data.keys():
-            data = respiban_data[metric][slice(*block)]
-            obs = Observation(
-                id=f"WESAD-{participant.id}-{self.observation_idx:05}-RespiBAN-{metric.lower()}",
+            if not self.selection.includes_modality(metric, self.get_respiban_id(participant.id)):
+                continue
+
+            start, end = timeline.get_sample_range(run, self.label_f)
+            data = respiban_data[metric][block[0] + start:block[0] + end]
+            offset = block[0] + start
+            first, stop = self.selection.get_sample_range(len(data), self.label_f, offset=offset)
+            if stop <= first:
+                continue
+
+            obs, obs_chunks = self.encode_signal(
+                (participant.id, segment, "RespiBAN", metric.lower()),
+                data[first:stop],
+                frequency=self.label_f,
+                offset=offset + first,
+                label=self.label_codes[timeline.values[run]],
+                session=session,
                 status="final",
-                code={"coding": [{"code": f"{self.label_codes[label[selector][0]]}"}]},
-                device={"reference": f"DeviceMetric/WESAD-RespiBAN-{participant.id}-{metric.lower()}-dm"},
-                valueAttachment={
-                    "contentType": "application/python-pickle",
-                    "data": base64.encodebytes(pickle.dumps(data[selector, :])).decode("utf-8")}
-            )
+                code={"coding": [{"code": f"{self.label_codes[timeline.values[run]]}"}]},
+                device={"reference": f"DeviceMetric/WESAD-RespiBAN-{participant.id}-{metric.lower()}-dm"})
             observation_members.append(obs)
+            chunks.extend(obs_chunks)
             device_data.append(obs.id)
-        return observation_members
+        return observation_members, chunks
 
-    def load_empatica_observations(self, block, bid, label, label_blocks, participant):
+    def load_empatica_observations(self, block, timeline, run, participant, segment, session):
+        """Returns the Observations of the Empatica signals during `run` of the label `timeline` of a block, a sample
+        being in the run of the label sample nearest to it."""
         observation_members = []
+        chunks = []
         empatica_data = self.participant_data["signal"]["wrist"]
         device_data = (self.device_observations
                        .setdefault(participant.id, {})
                        .setdefault(self.get_empatica_id(participant.id), []))
         for metric in empatica_data.keys():
-            resampled_block = self.resample_indices_range(block, metric)
-            data = empatica_data[metric][slice(*resampled_block)]
+            if not self.selection.includes_modality(metric, self.get_empatica_id(participant.id)):
+                continue
 
-            resampled_labels = self.resample_labels(label, metric)
-            resampled_blocks = self.resample_labels(label_blocks, metric)
-            selector = (resampled_blocks == bid)
-
-            obs = Observation(
-                id=f"WESAD-{participant.id}-{self.observation_idx:05}-E4-{metric.lower()}",
+            resampled_block = self.resample_indices_range(block, metric)
+            start, end = timeline.get_sample_range(run, self.signal_freq[metric.lower()],
+                                                   length=resampled_block[1] - resampled_block[0], nearest=True)
+            data = empatica_data[metric][resampled_block[0] + start:resampled_block[0] + end]
+            offset = resampled_block[0] + start
+            first, stop = self.selection.get_sample_range(len(data), self.signal_freq[metric.lower()], offset=offset)
+            if stop <= first:
+                continue
+
+            obs, obs_chunks = self.encode_signal(
+                (participant.id, segment, "E4", metric.lower()),
+                data[first:stop],
+                frequency=self.signal_freq[metric.lower()],
+                offset=offset + first,
+                label=self.label_codes[timeline.values[run]],
+                session=session,
                 status="final",
-                code={"coding": [{"code": f"{self.label_codes[resampled_labels[selector][0]]}"}]},
-                device={"reference": f"DeviceMetric/WESAD-E4-{participant.id}-{metric.lower()}-dm"},
-                valueAttachment={
-                    "contentType": "application/python-pickle",
-                    "data": base64.encodebytes(pickle.dumps(data[selector, :])).decode("utf-8")}
-            )
+                code={"coding": [{"code": f"{self.label_codes[timeline.values[run]]}"}]},
+                device={"reference": f"DeviceMetric/WESAD-E4-{participant.id}-{metric.lower()}-dm"})
             observation_members.append(obs)
+            chunks.extend(obs_chunks)
             device_data.append(obs.id)
-        return observation_members
+        return observation_members, chunks
 
     def get_patients(self):
         cd, participants, files_ = next(os.walk(self.dataset_dir))
@@ -249,16 +302,22 @@ class WESADLoader(Loader):
         return f"{self.study_id}-RespiBAN-{participant_id}"
 
     def load_questionnaire_answers(self, questionnaire, participant):
-        questionnaire_lines = self.__read_participant_answers_from_file(participant, questionnaire)
+        answer_rows = self.get_metadata(participant).answers(questionnaire)
         sessions = self.sessions[participant.id].keys()
-        for session, q_line in zip(sessions, questionnaire_lines):
-            if questionnaire == "sssq":
+        for session, answers in zip(sessions, answer_rows):
+            if questionnaire == "SSSQ":
                 """Unlike other questionnaires, SSSQ is only administered once after the stress session."""
                 session = self.stress_session_label
 
+            if not self.selection.includes_session(session):
+                continue
+
             session_observation = self.sessions[participant.id][session]
-            answers = []
-            for item, c in enumerate(q_line.split(";")[1:-1]):
+            response = QuestionnaireResponseBuilder(get_questionnaire_url(questionnaire, self.server),
+                                                    get_reference(participant),
+                                                    part_of=[get_reference(session_observation)],
+                                                    meta=self.get_meta(participant.id, session=session))
+            for item, c in enumerate(answers):
                 try:
                     int(c)
                 except ValueError:
@@ -272,53 +331,28 @@ class WESADLoader(Loader):
                     """Correct Item ID since 23 and 24 are only asked during stress conditions"""
                     item += 2
 
-                qr = QuestionnaireResponse(
-                    id=f"WESAD-{participant.id}-{self.observation_idx:05}-questionnaire-response",
-                    questionnaire=get_questionnaire_url(questionnaire, self.server),
-                    status="completed",
-                    source=get_reference(participant),
-                    partOf=[get_reference(session_observation)],
-                    item=[{
-                        "linkId": get_link_id(questionnaire, item),
-                        "answer": [{"valueCoding": Coding(code=int(c))}]}
-                    ])
-
-                session_observation.hasMember.append(get_reference(qr))
-                self.questionnaire_responses[participant.id].append(qr.id)
-                self.server.create(qr)
-
-    def __read_participant_answers_from_file(self, participant, questionnaire):
-        file_name = os.path.join(self.dataset_dir, participant.id, f"{participant.id}_quest.csv")
-        questionnaire_lines = []
-        with open(file_name) as answers_file:
-            for line in answers_file:
-                if questionnaire not in line:
-                    continue
+                response.add(get_link_id(questionnaire, item), {"valueCoding": Coding(code=int(c))})
 
-                questionnaire_lines.append(line)
-        return questionnaire_lines
+            if len(response) == 0:
+                continue
 
-    def load_sessions(self, participant):
-        def convert_times(time):
-            if "." in time:
-                minutes, seconds = time.split(".")
-            else:
-                minutes, seconds = time, "0"
+            qr = response.build(self.ids.get(participant.id, session, questionnaire))
+            self.questionnaire_responses[participant.id].append(qr.id)
+            self.server.create(qr)
 
-            seconds = int(minutes) * 60 + int(seconds)
-            return Quantity(value=700 * seconds, unit="1/700 s")
-
-        file_name = os.path.join(self.dataset_dir, participant.id, f"{participant.id}_quest.csv")
-        with open(file_name) as answers_file:
-            lines = answers_file.readlines()[:4]
+    def load_sessions(self, participant):
+        def convert_times(seconds):
+            return Quantity(value=self.label_f * seconds, unit=f"1/{self.label_f} s")
 
-        sessions = lines[1].split(";")[1:6]
-        starts = [convert_times(item) for item in lines[2].split(";")[1:6]]
-        ends = [convert_times(item) for item in lines[3].split(";")[1:6]]
+        metadata = self.get_metadata(participant)
+        sessions = metadata.sessions
+        starts = [convert_times(seconds) for seconds in metadata.starts]
+        ends = [convert_times(seconds) for seconds in metadata.ends]
         self.transient_session[participant.id] = Observation(
             status="final",
-            id=f"WESAD-{participant.id}-TRANSIENT",
-            hasMember=[],
+            id=self.ids.get(participant.id, "TRANSIENT"),
+            meta=self.get_meta(participant.id, session="transient"),
+            category=get_category("session"),
             code=CodeableConcept(coding=[Coding(code="transient", display="transient")],
                                  text=f"Session name: Transient"),
             text=Narrative(status="generated",
@@ -330,8 +364,9 @@ class WESADLoader(Loader):
             session_dic = self.sessions.setdefault(participant.id, OrderedDict())
             session_dic[session] = Observation(
                 status="final",
-                id=f"WESAD-{participant.id}-{session.replace(' ', '-').upper()}",
-                hasMember=[],
+                id=self.ids.get(participant.id, session.upper()),
+                meta=self.get_meta(participant.id, session=session),
+                category=get_category("session"),
                 code=CodeableConcept(coding=[Coding(code=session, display=session)], text=f"Session name: {session}"),
                 text=Narrative(status="generated",
                                div=f"The session {session} duration, expressed as the start and end time in reference "
@@ -344,12 +379,14 @@ class WESADLoader(Loader):
 
         self.reference_observations.setdefault(participant.id, []).extend(
             [ses.id for ses in self.sessions[participant.id].values()])
-        self.load_session_observations(participant)
 
-    def load_session_observations(self, participant):
-        self.server.create(self.transient_session[participant.id])
+        self.links.register(self.transient_session[participant.id])
         for session_observation in self.sessions[participant.id].values():
-            self.server.create(session_observation)
+            self.links.register(session_observation)
+
+    def load_session_observations(self, participant):
+        self.links.commit(self.server, [self.transient_session[participant.id],
+                                        *self.sessions[participant.id].values()])
 
     def load_study_prerequisites_questionnaire(self):
         study_prerequisites = Questionnaire(
@@ -360,38 +397,14 @@ class WESADLoader(Loader):
 
         self.server.create(study_prerequisites)
 
-    def load_readme_file(self, participant):
-        personal_information, study_pre_requisites, additional_notes = self.parse_readme_file(participant)
-        self.load_personal_information(participant, personal_information)
-        self.load_study_prerequisites_questionnaire_responses(participant, study_pre_requisites)
-        self.load_additional_notes(participant, additional_notes)
-
-    def parse_readme_file(self, participant):
-        filename = f"{self.dataset_dir}/{participant.id}/{participant.id}_readme.txt"
-        personal_information = []
-        study_pre_requisites = []
-        additional_notes = []
-        current_list = personal_information
-        with open(filename) as readme_file:
-            for line in readme_file:
-                if "Personal" in line:
-                    current_list = personal_information
-                    continue
-
-                if "Study" in line:
-                    current_list = study_pre_requisites
-                    continue
+    def get_metadata(self, participant):
+        return read_participant_metadata(self.dataset_dir, participant.id)
 
-                if "Additional" in line:
-                    current_list = additional_notes
-                    continue
-
-                if line.strip() == "":
-                    continue
-
-                current_list.append(line)
-
-        return personal_information, study_pre_requisites, additional_notes
+    def load_readme_file(self, participant):
+        metadata = self.get_metadata(participant)
+        self.load_personal_information(participant, metadata.personal_information)
+        self.load_study_prerequisites_questionnaire_responses(participant, metadata.study_pre_requisites)
+        self.load_additional_notes(participant, metadata.additional_notes)
 
     def load_personal_information(self, participant, personal_information):
         codings = {
@@ -422,13 +435,12 @@ class WESADLoader(Loader):
             "Age": "years"
         }
 
-        for info_line in personal_information:
-            key, unit, value = re.match(r"([a-zA-Z ]*)(|[()a-z]*): ([a-zA-Z\d.]*)", info_line).groups()
-            key = key.strip()
+        for key, unit, value in personal_information:
             value_type = value_types[key]
             value = Quantity(value=value, unit=value_units.get(key, unit)) if value_type == "valueQuantity" else value
             obs = Observation(
-                id=f"WESAD-{participant.id}-{self.observation_idx:05}",
+                id=self.ids.get(participant.id, "info", key),
+                meta=self.get_meta(participant.id),
                 status="final",
                 code={"coding": [codings[key]]},
                 subject=get_reference(participant),
@@ -439,32 +451,29 @@ class WESADLoader(Loader):
             self.server.create(obs)
 
     def load_study_prerequisites_questionnaire_responses(self, participant, study_pre_requisites):
-        for question_line in study_pre_requisites:
-            question, answer = re.match(r"([a-zA-Z\s]*\?)\s*([a-zA-Z]*)", question_line).groups()
+        response = QuestionnaireResponseBuilder("Questionnaire/WASAD-study-prerequisites", get_reference(participant),
+                                                meta=self.get_meta(participant.id))
+        for question, answer in study_pre_requisites:
             question_id = self.prerequisite_questions.index(question)
+            response.add(f"WASAD-study-prerequisite-question-{question_id + 1:02}", {"valueString": answer})
 
-            stuqr = QuestionnaireResponse(
-                id=f"WESAD-{participant.id}-{self.observation_idx:05}-study-prerequisite",
-                questionnaire="Questionnaire/WASAD-study-prerequisites",
-                status="completed",
-                source=get_reference(participant),
-                item=[{
-                    "linkId": f"WASAD-study-prerequisite-question-{question_id + 1:02}",
-                    "answer": [{"valueString": answer}]}
-                ])
+        if len(response) == 0:
+            return
 
-            self.patient_observations[participant.id].append(stuqr.id)
-            self.server.create(stuqr)
+        stuqr = response.build(self.ids.get(participant.id, "study-prerequisite"))
+        self.patient_observations[participant.id].append(stuqr.id)
+        self.server.create(stuqr)
 
     def load_additional_notes(self, participant, additional_notes):
         obs = Observation(
-            id=f"WESAD-{participant.id}-{self.observation_idx:05}",
+            id=self.ids.get(participant.id, "notes"),
+            meta=self.get_meta(participant.id),
             status="final",
             code={"coding": [{"code": "48767-8",
                               "system": "https://loinc.org",
                               "display": "Annotation"}]},
             subject=get_reference(participant),
-            valueString="".join(additional_notes)
+            valueString=additional_notes
         )
         self.patient_observations[participant.id].append(obs.id)
         self.server.create(obs)
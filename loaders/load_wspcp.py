@@ -1,7 +1,5 @@
-import base64
 import os
-import pickle
-from datetime import datetime, date
+from datetime import date
 from glob import glob
 from zipfile import ZipFile
 
@@ -12,26 +10,32 @@ from fhir.resources.observation import Observation
 from fhir.resources.patient import Patient
 
 from loaders.loader import Loader
-from resources.empatica_e4 import empatica_e4
+from resources.empatica_e4 import empatica_e4, empatica_read_csv
+from static_resources.search_parameters.codex import get_category, get_component_code
 from utils import get_reference, get_list_of_references
 
 
 class WSPCPLoader(Loader):
     """Implements the Loader abstract class to load the WSPCP dataset."""
 
-    def __init__(self, dataset_dir, fhir_server):
+    def __init__(self, dataset_dir, fhir_server, **kwargs):
         title = "Wearable Stress and Affect Detection"
         study_id = "WSPCPL"
 
-        data_name = next(os.walk(dataset_dir))[1][0]
-        super().__init__(os.path.join(dataset_dir, data_name), fhir_server, study_id, title, "Rafiul et al.",
-                         date(day=10, month=3, year=2022))
+        super().__init__(dataset_dir, fhir_server, study_id, title, "Rafiul et al.",
+                         date(day=10, month=3, year=2022), **kwargs)
+        self.download_dir = dataset_dir
 
-        self.unzip_data()
         self.exams = ["Final", "Midterm 1", "Midterm 2"]
         self.grades = {}
         self.load_grades()
 
+    def prepare(self, upload=True):
+        # The data is in the directory the archive unzips to, which does not exist before the download.
+        data_name = next(os.walk(self.download_dir))[1][0]
+        self.dataset_dir = os.path.join(self.download_dir, data_name)
+        self.unzip_data()
+
     def load_grades(self):
         """Source StudentGrades.txt"""
         self.grades.update({
@@ -63,12 +67,6 @@ class WSPCPLoader(Loader):
 
         return [device], [resources], [device_association]
 
-    def read_dataset(self):
-        for participant in self.patients:
-            self.read_participant(participant)
-
-        return
-
     def get_body_structures(self, participant):
         return {"dominant hand":
                     BodyStructure(id=f"{self.study_id}-{participant.id}-dominant-wrist",
@@ -77,63 +75,117 @@ class WSPCPLoader(Loader):
                                   description="Dominant wrist")}
 
     def read_participant(self, participant):
-        for exam in self.exams:
-            observation_members = []
-            modalities = glob(f"{self.dataset_dir}/Data/{participant.id}/{exam}/*.csv")
-            for modality_path in modalities:
-                metric = os.path.basename(modality_path)[:-4]
-                try:
-                    data = pd.read_csv(modality_path, header=None)
-                except pd.errors.EmptyDataError:
-                    continue
-
-                if metric == "tags":
-                    for idx, timestamp in pd.to_datetime(data[0]).items():
-                          observation_members.append(Observation(
-                            id=f"{self.study_id}-{participant.id}-{exam.replace(' ','-')}-E4-{metric.lower()}-{idx:04}",
-                            status="final",
-                            effectiveDateTime=timestamp,
-                            code={"coding": [{"code": f"{exam}"}]},
-                            valueBoolean=True,
-                            device={"reference": f"DeviceMetric/{self.study_id}-E4-{participant.id}-{metric.lower()}-dm"},
-                          ))
-
-                    continue
-
-                timestamp = data.iloc[0, 0]
-                if metric == "IBI":
-                    data = data.iloc[1:, :]
-
-                else:
-                    data = data.iloc[2:, :]
-
-                observation_members.append(Observation(
-                    id=f"{self.study_id}-{participant.id}-{exam.replace(' ','-')}-E4-{metric.lower()}",
-                    status="final",
-                    effectiveDateTime=timestamp,
-                    code={"coding": [{"code": f"{exam}"},
-                                     {"code": f"{self.grades[exam][participant.id]}"}
-                                     ]},
-                    device={"reference": f"DeviceMetric/{self.study_id}-E4-{participant.id}-{metric.lower()}-dm"},
-                    valueAttachment={
-                        "contentType": "application/python-pickle",
-                        "data": base64.encodebytes(pickle.dumps(data)).decode("utf-8")}
-                ))
-
-            parent_ = Observation(
-                id=f"{participant.id}-{exam.replace(' ', '-')}",
-                status="final",
-                code={"coding": [{"code": f"{exam}"}]},
-                valueQuantity={"value": self.grades[exam][participant.id], "unit": "percentage"},
-                hasMember=get_list_of_references(observation_members),
-                subject=get_reference(participant))
-
-            for obs in observation_members:
-                self.device_observations[participant.id].setdefault(self.get_empatica_id(participant), []).append(obs.id)
-                self.server.create(obs)
+        self.read_exams([(participant, exam) for exam in self.exams])
 
-            self.reference_observations[participant.id].append(parent_.id)
-            self.server.create(parent_)
+    def read_dataset(self):
+        self.read_exams([(participant, exam) for participant in self.get_selected_patients()
+                         for exam in self.exams])
+
+    def read_exams(self, units):
+        """(participant, exam) units share nothing but the server connection: they are read, encoded and uploaded, by
+        `self.max_workers` threads, in the stages of a pipeline. The participant's structures are updated in order
+        afterwards."""
+        units = [(participant, exam) for participant, exam in units
+                 if self.selection.includes_session(exam) and self.selection.includes_label(exam)]
+        pipeline = self.pipeline()
+        pipeline.add_stage("encode", self.encode_exam)
+        pipeline.add_stage("upload", self.upload_exam, workers=self.max_workers)
+        for exam in pipeline.run((self.read_exam(*unit) for unit in units), source="parse"):
+            self.record_exam(exam["participant"], exam["parent"], exam["observations"])
+
+    def record_exam(self, participant, parent_, observation_members):
+        device_data = self.device_observations[participant.id].setdefault(self.get_empatica_id(participant), [])
+        device_data.extend([obs.id for obs in observation_members])
+        self.reference_observations[participant.id].append(parent_.id)
+
+    def read_exam(self, participant, exam):
+        """Reads the selected recordings of one exam, as (metric, timestamp, frequency, data, offset)."""
+        recordings = []
+        for modality_path in glob(f"{self.dataset_dir}/Data/{participant.id}/{exam}/*.csv"):
+            metric = os.path.basename(modality_path)[:-4]
+            if not self.selection.includes_modality(metric, self.get_empatica_id(participant)):
+                continue
+
+            timestamp, frequency, data = empatica_read_csv(modality_path)
+            if data is None or len(data) == 0:
+                continue
+
+            if metric == "tags":
+                times = pd.to_datetime(data[:, 0], unit="s", utc=True)
+                data = data[[self.selection.includes_time(time, time) for time in times]]
+                first = 0
+            else:
+                first, stop = self.selection.get_sample_range(len(data), frequency,
+                                                              pd.to_datetime(timestamp, unit="s", utc=True))
+                data = data[first:stop]
+
+            if len(data) > 0:
+                recordings.append((metric, timestamp + first / frequency if frequency else timestamp, frequency,
+                                   data, first))
+
+        return {"participant": participant, "exam": exam, "recordings": recordings}
+
+    def encode_exam(self, exam_data):
+        """Encodes the recordings of one exam, and the exam Observation referencing them."""
+        participant, exam = exam_data["participant"], exam_data["exam"]
+        observation_members = []
+        chunks = []
+        for metric, timestamp, frequency, data, offset in exam_data.pop("recordings"):
+            device = {"reference": f"DeviceMetric/{self.study_id}-E4-{participant.id}-{metric.lower()}-dm"}
+            if metric == "tags":
+                observation_members.append(self.encode_tags(participant, exam, data[:, 0], device))
+                continue
+
+            obs, obs_chunks = self.encode_signal(
+                (participant.id, exam, "E4", metric.lower()),
+                data,
+                frequency=frequency,
+                start=pd.to_datetime(timestamp, unit="s", utc=True),
+                offset=offset,
+                label=exam,
+                session=exam,
+                status="final",
+                code={"coding": [{"code": f"{exam}"},
+                                 {"code": f"{self.grades[exam][participant.id]}"}
+                                 ]},
+                device=device)
+            observation_members.append(obs)
+            chunks.extend(obs_chunks)
+
+        exam_data["parent"] = Observation(
+            id=self.ids.get(participant.id, exam),
+            meta=self.get_meta(participant.id, session=exam),
+            category=get_category("session"),
+            status="final",
+            code={"coding": [{"code": f"{exam}"}]},
+            valueQuantity={"value": self.grades[exam][participant.id], "unit": "percentage"},
+            hasMember=get_list_of_references(observation_members),
+            subject=get_reference(participant))
+        exam_data["observations"] = observation_members
+        exam_data["chunks"] = chunks
+        return exam_data
+
+    def upload_exam(self, exam_data):
+        self.server.create_all(exam_data.pop("chunks"))
+        self.server.create_all(exam_data["observations"])
+        self.catalog_uploaded(exam_data["observations"])
+        self.server.create(exam_data["parent"])
+        return exam_data
+
+    def encode_tags(self, participant, exam, timestamps, device):
+        """All button presses of an exam are batched in a single Observation, one component per press."""
+        timestamps = pd.to_datetime(timestamps, unit="s", utc=True)
+        return Observation(
+            id=self.ids.get(participant.id, exam, "E4", "tags"),
+            meta=self.get_meta(participant.id, session=exam, modality="tags"),
+            category=get_category("event"),
+            status="final",
+            effectivePeriod={"start": timestamps[0], "end": timestamps[-1]},
+            code={"coding": [{"code": f"{exam}"}]},
+            valueInteger=len(timestamps),
+            component=[{"code": get_component_code("button press"), "valueDateTime": timestamp}
+                       for timestamp in timestamps],
+            device=device)
 
     def unzip_data(self):
         tale = os.path.join(self.dataset_dir, "unzipped")
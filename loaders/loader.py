@@ -1,16 +1,28 @@
+import threading
 from abc import ABCMeta, abstractmethod
+from datetime import timedelta
 
+import pandas as pd
 from fhir.resources.evidencereport import EvidenceReport
 from fhir.resources.group import Group
+from fhir.resources.observation import Observation
 from fhir.resources.practitioner import Practitioner
 from fhir.resources.researchstudy import ResearchStudy
 
 from connector import FHIRConnector
-from utils import get_reference, get_list_of_references
+from loaders.chunking import DEFAULT_CHUNK_POLICY, sample_nbytes, slice_samples
+from loaders.ids import IdAllocator
+from loaders.linking import LinkGraph
+from loaders.pipeline import Pipeline
+from loaders.selection import Selection
+from metrics import metrics
+from static_resources.search_parameters.codex import get_category, get_component_code, get_meta
+from utils import get_reference, get_list_of_references, get_pickle_attachment
 
 
 class Loader(metaclass=ABCMeta):
-    def __init__(self, dataset_dir: str, fhir_server: FHIRConnector, study_id, study_title, autor, date):
+    def __init__(self, dataset_dir: str, fhir_server: FHIRConnector, study_id, study_title, autor, date,
+                 chunk_policy=None, max_workers=4, catalog=None, selection=None):
         self.date = date
         self.author = autor
         self.study_title = study_title
@@ -41,24 +53,232 @@ class Loader(metaclass=ABCMeta):
         self.__device_index = {}
         self.__patient_devices = {}
 
-        self.__observation_idx = 0
+        self.ids = IdAllocator(study_id)
+        self.links = LinkGraph()
+        self.chunk_policy = chunk_policy if chunk_policy is not None else DEFAULT_CHUNK_POLICY
+        self.max_workers = max_workers
+        self.catalog = catalog
+        self.selection = selection if selection is not None else Selection()
+        # Catalog rows of the encoded signals by Observation id, until they are uploaded.
+        self.__catalog_rows = {}
+        self.__catalog_lock = threading.Lock()
+
+    def prepare(self, upload=True):
+        """Reads or uploads what the study needs before loading (surveys, study specific questionnaires, unzipped
+        data, ...). Called by `setup`, so that creating a loader does no work. Nothing is uploaded unless `upload` is
+        set."""
+        pass
 
     def load_dataset(self):
-        self.load_author()
-        self.load_patients()
-        self.load_body_structures()
+        self.load_data()
+        self.load_results()
+
+    def load_data(self):
+        """Uploads the participants, devices and signals of the study."""
+        self.setup()
+        with self.timer("read_dataset"):
+            self.read_dataset()
+
+    def setup(self, upload=True):
+        """Creates the author, participants, body structures, devices and group of the study, and uploads them if
+        `upload` is set. Workers of a distributed load (see `jobqueue.py`) set the study up without uploading it, the
+        coordinator already did."""
+        self.prepare(upload)
+        self.load_author(upload)
+        self.load_patients(upload)
+        self.load_body_structures(upload)
         self.__create_patient_index()
-        self.load_devices()
+        self.load_devices(upload)
         self.__create_device_index()
-        self.load_group()
-        self.read_dataset()
-        self.load_evidence_report()
-        self.load_research_study()
-
-    @property
-    def observation_idx(self):
-        self.__observation_idx += 1
-        return self.__observation_idx - 1
+        self.load_group(upload)
+
+    def load_participant(self, participant_id):
+        """Loads the data of one participant of a study that was `setup`. Returns the participant's results, see
+        `get_participant_results`."""
+        with self.timer("read_participant"):
+            self.read_participant(self.get_participant(participant_id))
+
+        if self.catalog is not None:
+            self.catalog.commit()
+
+        return self.get_participant_results(participant_id)
+
+    def get_participant_results(self, participant_id):
+        """Returns the ids of the resources of `participant_id` referenced by the EvidenceReport and, if the loader
+        has a catalog, the participant's catalog rows, as a json serializable dict."""
+        results = {"questionnaire_responses": list(self.questionnaire_responses[participant_id]),
+                   "patient_observations": list(self.patient_observations[participant_id]),
+                   "reference_observations": list(self.reference_observations[participant_id]),
+                   "device_observations": {device_id: list(observation_ids) for device_id, observation_ids
+                                           in self.device_observations[participant_id].items()},
+                   "estimated_observations": list(self.estimated_observations[participant_id])}
+        if self.catalog is not None:
+            results["catalog"] = self.catalog.find(study=self.study_id, participant=participant_id, chunks=True)
+
+        return results
+
+    def add_participant_results(self, participant_id, results):
+        """Adds the results of a participant loaded elsewhere, see `get_participant_results`."""
+        self.questionnaire_responses[participant_id].extend(results["questionnaire_responses"])
+        self.patient_observations[participant_id].extend(results["patient_observations"])
+        self.reference_observations[participant_id].extend(results["reference_observations"])
+        for device_id, observation_ids in results["device_observations"].items():
+            self.device_observations[participant_id].setdefault(device_id, []).extend(observation_ids)
+
+        self.estimated_observations[participant_id].extend(results["estimated_observations"])
+        if self.catalog is not None:
+            self.catalog.add_rows(results.get("catalog", []))
+
+    def load_results(self):
+        """Uploads the EvidenceReport and the ResearchStudy referencing what `load_data` uploaded, unless only part of
+        the study was selected (see `loaders.selection`)."""
+        if self.selection.is_complete:
+            self.load_evidence_report()
+            self.load_research_study()
+        else:
+            print(f"{self.study_id}: {self.selection} loaded, the EvidenceReport and ResearchStudy are not updated")
+
+        if self.catalog is not None:
+            self.catalog.commit()
+
+    def timer(self, stage):
+        """Times a processing stage (parse, features, encode, ...) of this study."""
+        return metrics.timer("stage_seconds", study=self.study_id, stage=stage)
+
+    def pipeline(self, max_queue_size=2):
+        """Returns an empty `Pipeline` whose stages are timed as stages of this study. Loaders reading a study as a
+        sequence of independent pieces (e.g. the segments of SDN) run them through a pipeline, so that parsing,
+        feature computation, encoding and uploads overlap instead of alternating."""
+        return Pipeline(max_queue_size, study=self.study_id)
+
+    def get_meta(self, participant_id, **tags):
+        """Returns the meta of a resource of `participant_id`, tagged with the study, the participant and the given
+        session, modality and label (see `static_resources.search_parameters.codex`)."""
+        return get_meta(study=self.study_id, participant=participant_id, **tags)
+
+    def encode_signal(self, id_parts, data, frequency=None, start=None, offset=0, label=None, session=None,
+                      category="signal", **properties):
+        """Encodes a signal (numpy array or pandas object with one sample per row) as an Observation with id
+        `self.ids.get(*id_parts)` and the given `properties` (status, code, device, ...). `id_parts` are
+        (participant, ..., modality), the Observation is tagged with them, `session` and `label`, and classified
+        with `category` (chunks as "{category}-chunk").
+
+        Signals exceeding `self.chunk_policy` are split, each chunk becoming its own Observation referenced by the
+        returned parent through `hasMember`. Chunks record their position in the recording as a "sample range"
+        component (`offset` is the position of the first sample of `data`) and, if the time of the first sample
+        (`start`) or a datetime index is available, their effectivePeriod. Components given in `properties` describe
+        the whole signal and are repeated on its chunks.
+
+        When the loader has a catalog, the rows of the parent and its chunks are added to it by `catalog_uploaded`,
+        once they are uploaded.
+
+        Returns the parent Observation and the list of chunks, which have to be created before the parent."""
+        ranges = self.chunk_policy.split(len(data), frequency, sample_nbytes(data))
+        period = self.__get_period(data, frequency, start, 0, len(data))
+        meta = self.get_meta(id_parts[0], session=session, modality=id_parts[-1], label=label)
+        if len(ranges) == 1:
+            parent = Observation(id=self.ids.get(*id_parts), valueAttachment=get_pickle_attachment(data),
+                                 meta=meta, category=get_category(category), **period, **properties)
+            self.__catalog_signal(id_parts, label, parent, [], frequency, offset, [(0, len(data))])
+            return parent, []
+
+        chunks = []
+        unit = f"1/{frequency} s" if frequency else "sample"
+        chunk_properties = dict(properties)
+        components = chunk_properties.pop("component", [])
+        for number, (chunk_start, chunk_stop) in enumerate(ranges):
+            chunks.append(Observation(
+                id=self.ids.get(*id_parts, chunk=number),
+                valueAttachment=get_pickle_attachment(slice_samples(data, chunk_start, chunk_stop)),
+                meta=meta,
+                category=get_category(f"{category}-chunk"),
+                component=[{"code": get_component_code("sample range"),
+                            "valueRange": {"low": {"value": offset + chunk_start, "unit": unit},
+                                           "high": {"value": offset + chunk_stop, "unit": unit}}},
+                           *components],
+                **self.__get_period(data, frequency, start, chunk_start, chunk_stop),
+                **chunk_properties))
+
+        parent = Observation(id=self.ids.get(*id_parts), hasMember=get_list_of_references(chunks),
+                             meta=meta, category=get_category(category), **period, **properties)
+        self.__catalog_signal(id_parts, label, parent, chunks, frequency, offset, ranges)
+        return parent, chunks
+
+    def __catalog_signal(self, id_parts, label, parent, chunks, frequency, offset, ranges):
+        if self.catalog is None:
+            return
+
+        device = parent.device.reference if parent.device is not None else None
+        common = {"study": self.study_id, "participant": id_parts[0], "device": device,
+                  "modality": str(id_parts[-1]), "label": None if label is None else str(label),
+                  "frequency": frequency}
+
+        def row(observation, sample_range, **fields):
+            attachment = observation.valueAttachment
+            if attachment is not None:
+                fields.update(payload_size=attachment.size, payload_hash=bytes(attachment.hash).decode("utf-8"))
+
+            return dict(common,
+                        resource_id=observation.id,
+                        resource_type="Observation",
+                        **self.__catalog_times(observation, frequency, offset, sample_range),
+                        **fields)
+
+        rows = [row(parent, (ranges[0][0], ranges[-1][1]))]
+        rows.extend(row(chunk, sample_range, parent_id=parent.id, chunk=number)
+                    for number, (chunk, sample_range) in enumerate(zip(chunks, ranges)))
+        with self.__catalog_lock:
+            self.__catalog_rows[parent.id] = rows
+
+    def catalog_uploaded(self, observations):
+        """Adds the catalog rows of the signals encoded as `observations` (see `encode_signal`), which the server
+        stored, to the catalog. They are committed with the results of the participant or of the study, so that the
+        catalog only lists uploaded resources."""
+        if self.catalog is None:
+            return
+
+        with self.__catalog_lock:
+            rows = [row for observation in observations for row in self.__catalog_rows.pop(observation.id, [])]
+
+        self.catalog.add_rows(rows)
+
+    @staticmethod
+    def __catalog_times(observation, frequency, offset, sample_range):
+        """Times of the first and last sample, as unix timestamps when the Observation has an effective time, else
+        as seconds from the beginning of the recording."""
+        if observation.effectivePeriod is not None:
+            return {"start": pd.Timestamp(observation.effectivePeriod.start).timestamp(),
+                    "end": pd.Timestamp(observation.effectivePeriod.end).timestamp(),
+                    "time_reference": "utc"}
+
+        if observation.effectiveDateTime is not None:
+            timestamp = pd.Timestamp(observation.effectiveDateTime).timestamp()
+            return {"start": timestamp, "end": timestamp, "time_reference": "utc"}
+
+        if not frequency:
+            return {}
+
+        chunk_start, chunk_stop = sample_range
+        return {"start": (offset + chunk_start) / frequency,
+                "end": (offset + max(chunk_stop - 1, chunk_start)) / frequency,
+                "time_reference": "recording"}
+
+    @staticmethod
+    def __get_period(data, frequency, start, chunk_start, chunk_stop):
+        if chunk_stop <= chunk_start:
+            return {}
+
+        if isinstance(getattr(data, "index", None), pd.DatetimeIndex):
+            return {"effectivePeriod": {"start": data.index[chunk_start], "end": data.index[chunk_stop - 1]}}
+
+        if start is None:
+            return {}
+
+        if not frequency:
+            return {"effectiveDateTime": start} if chunk_start == 0 and chunk_stop == len(data) else {}
+
+        return {"effectivePeriod": {"start": start + timedelta(seconds=chunk_start / frequency),
+                                    "end": start + timedelta(seconds=(chunk_stop - 1) / frequency)}}
 
     @abstractmethod
     def get_patients(self):
@@ -72,6 +292,12 @@ class Loader(metaclass=ABCMeta):
     def get_body_structures(self, patient):
         pass
 
+    @abstractmethod
+    def read_participant(self, participant):
+        """Reads, encodes and uploads the data of one participant, filling the dictionaries listed in
+        `read_dataset`. Needed to distribute the participants of a study over several workers."""
+        pass
+
     @abstractmethod
     def read_dataset(self):
         """To avoid large object references, the implementation of `read_dataset` should directly link and send
@@ -85,20 +311,27 @@ class Loader(metaclass=ABCMeta):
 
         pass
 
-    def load_patients(self):
+    def load_patients(self, upload=True):
         for patient in self.get_patients():
+            if patient.meta is None:
+                # The participant tag keeps the participant's resources together when they are routed to several
+                # endpoints, see `routing.py`.
+                patient.meta = self.get_meta(patient.id)
+
             self.patients.append(patient)
             self.init_patient_structures(patient)
-            self.server.create(patient)
+            if upload:
+                self.server.create(patient)
 
-    def load_body_structures(self):
+    def load_body_structures(self, upload=True):
         for patient in self.patients:
             body_structures = self.get_body_structures(patient)
             self.device_body_structures.setdefault(patient.id, {}).update(body_structures)
-            for bs in body_structures.values():
-                self.server.create(bs)
+            if upload:
+                for bs in body_structures.values():
+                    self.server.create(bs)
 
-    def load_devices(self):
+    def load_devices(self, upload=True):
         for patient in self.patients:
             devices, sub_devices, device_associations = self.register_devices(patient)
             self.__patient_devices[patient.id] = devices
@@ -108,15 +341,17 @@ class Loader(metaclass=ABCMeta):
 
             self.device_associations.setdefault(patient.id, []).extend([da.id for da in device_associations])
 
-        for device in self.devices:
-            self.server.create(device)
+        if upload:
+            for device in self.devices:
+                self.server.create(device)
 
-    def load_group(self):
+    def load_group(self, upload=True):
         self.group = Group(id=f"{self.study_id}-group",
                            membership="definitional",
                            member=[{"entity": get_reference(pat)} for pat in self.patients],
                            type="person")
-        self.server.create(self.group)
+        if upload:
+            self.server.create(self.group)
 
     def create_study_data_section(self):
         study_data = []
@@ -132,7 +367,9 @@ class Loader(metaclass=ABCMeta):
         subsections = [
             self.create_questionnaire_section(participant_id),
             self.create_reference_data_section(participant_id),
-            self.create_estimated_data_section(participant_id)
+            self.create_estimated_data_section(participant_id),
+            *[self.create_device_data_section(participant_id, device_id)
+              for device_id in self.device_observations[participant_id]]
         ]
         section_entries = []
         for obs_id in self.patient_observations[participant_id]:
@@ -207,10 +444,15 @@ class Loader(metaclass=ABCMeta):
         )
         self.server.create(self.research_study)
 
-    def load_author(self):
+    def load_author(self, upload=True):
         self.author = Practitioner(id=f"{self.study_id}-author", name=[{
             "use": "usual", "text": self.author}])
-        self.server.create(self.author)
+        if upload:
+            self.server.create(self.author)
+
+    def get_selected_patients(self):
+        """Returns the participants whose data is loaded, see `self.selection`."""
+        return [patient for patient in self.patients if self.selection.includes_participant(patient.id)]
 
     def get_participant(self, participant_id):
         return self.__participant_index[participant_id]
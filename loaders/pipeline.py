@@ -0,0 +1,197 @@
+"""Staged pipelines overlapping the reading, computation, encoding and upload of a study.
+
+A `Pipeline` runs each of its stages in its own workers, threads for I/O bound stages (parsing, uploading) or
+processes for CPU bound ones (features), connected by bounded queues. A stage whose next stage is behind waits instead
+of piling items up (back-pressure), so each stage holds at most about `max_queue_size` + 2 * workers items in memory.
+Items leave every stage in the order they entered it, whatever the number of workers, so loading with a pipeline
+gives the same results as loading serially.
+
+    pipeline = Pipeline(study="SDN")
+    pipeline.add_stage("features", compute_features, workers=4, processes=True, key="features")
+    pipeline.add_stage("upload", upload, workers=2)
+    for item in pipeline.run(read_segments(), source="parse"):
+        ...
+
+The functions of process stages, and the items they receive and return, must be picklable, e.g. module level
+functions. Large arrays are best passed to processes as descriptors of shared memory, see `loaders.shared_arrays`.
+The time spent on each item is recorded in the "stage_seconds" histogram by stage, and the time a stage waits for
+the next one in "stage_blocked_seconds"."""
+
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from metrics import metrics
+
+# Markers of the end of the items, and of a stopped pipeline.
+_DONE = object()
+_STOPPED = object()
+
+
+def _call_timed(function, item):
+    """Calls `function(item)` and returns its duration with its result, so process stages can be timed by the
+    parent."""
+    start = time.perf_counter()
+    result = function(item)
+    return time.perf_counter() - start, result
+
+
+class Stage:
+    def __init__(self, name, function, workers, processes, key, argument):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.processes = processes
+        self.key = key
+        self.argument = argument
+
+
+class Pipeline:
+    def __init__(self, max_queue_size=2, mp_context=None, **labels):
+        """`labels` (e.g. the study) are added to the metrics of the stages. Process stages start their workers with
+        `mp_context`, by default "spawn", as forking a process running threads is unsafe."""
+        self.max_queue_size = max_queue_size
+        self.mp_context = mp_context if mp_context is not None else multiprocessing.get_context("spawn")
+        self.labels = labels
+        self.stages = []
+
+    def add_stage(self, name, function, workers=1, processes=False, key=None, argument=None):
+        """Adds a stage calling `function(item)` on every item, in `workers` threads or processes, and passing what it
+        returns to the next stage. With a `key`, what `function` returns is stored in `item[key]` and the item is
+        passed on instead, and with an `argument`, `function` is called with `item[argument]` only, so that process
+        stages only exchange what they need. Returns the pipeline."""
+        self.stages.append(Stage(name, function, workers, processes, key, argument))
+        return self
+
+    def run(self, items, source="read"):
+        """Yields the items of the iterable `items` through every stage, in order. Iterating `items` runs in a thread
+        of its own, timed as the `source` stage. If a stage fails, the pipeline stops and its exception is raised."""
+        stop = threading.Event()
+        failures = []
+
+        def fail(exception):
+            failures.append(exception)
+            stop.set()
+
+        queues = [queue.Queue(self.max_queue_size) for _ in range(len(self.stages) + 1)]
+        executors = []
+        threads = [threading.Thread(target=self.__feed, args=(source, items, queues[0], stop, fail), daemon=True)]
+        for stage, input_queue, output_queue in zip(self.stages, queues, queues[1:]):
+            if stage.processes:
+                executor = ProcessPoolExecutor(stage.workers, mp_context=self.mp_context)
+            else:
+                executor = ThreadPoolExecutor(stage.workers, thread_name_prefix=stage.name)
+
+            executors.append(executor)
+            futures = queue.Queue(stage.workers)
+            threads.append(threading.Thread(target=self.__submit, args=(stage, executor, input_queue, futures, stop),
+                                            daemon=True))
+            threads.append(threading.Thread(target=self.__collect, args=(stage, futures, output_queue, stop, fail),
+                                            daemon=True))
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self.__get(queues[-1], stop)
+                if item is _DONE:
+                    return
+
+                if item is _STOPPED:
+                    raise failures[0]
+
+                yield item
+
+        finally:
+            stop.set()
+            for executor in executors:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+            for thread in threads:
+                thread.join()
+
+            for executor in executors:
+                executor.shutdown()
+
+    @staticmethod
+    def __put(output_queue, item, stop):
+        """Waits for room in `output_queue`. Returns False if the pipeline stopped meanwhile."""
+        while not stop.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    @staticmethod
+    def __get(input_queue, stop):
+        while not stop.is_set():
+            try:
+                return input_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return _STOPPED
+
+    def __feed(self, source, items, output_queue, stop, fail):
+        try:
+            iterator = iter(items)
+            while True:
+                start = time.perf_counter()
+                item = next(iterator, _DONE)
+                if item is not _DONE:
+                    metrics.observe("stage_seconds", time.perf_counter() - start, stage=source, **self.labels)
+
+                if not self.__put(output_queue, item, stop) or item is _DONE:
+                    return
+
+        except Exception as e:
+            fail(e)
+
+    def __submit(self, stage, executor, input_queue, futures, stop):
+        while True:
+            item = self.__get(input_queue, stop)
+            if item is _STOPPED:
+                return
+
+            if item is not _DONE:
+                argument = item[stage.argument] if stage.argument is not None else item
+                item = (item, executor.submit(_call_timed, stage.function, argument))
+
+            # The futures are queued in the order of the items, at most `workers` of them waiting to be collected.
+            if not self.__put(futures, item, stop) or item is _DONE:
+                return
+
+    def __collect(self, stage, futures, output_queue, stop, fail):
+        while True:
+            pending = self.__get(futures, stop)
+            if pending is _STOPPED:
+                return
+
+            if pending is _DONE:
+                self.__put(output_queue, _DONE, stop)
+                return
+
+            item, future = pending
+            try:
+                seconds, result = future.result()
+            except Exception as e:
+                fail(e)
+                return
+
+            if stage.key is not None:
+                item[stage.key] = result
+            else:
+                item = result
+
+            metrics.observe("stage_seconds", seconds, stage=stage.name, **self.labels)
+            start = time.perf_counter()
+            if not self.__put(output_queue, item, stop):
+                return
+
+            metrics.observe("stage_blocked_seconds", time.perf_counter() - start, stage=stage.name, **self.labels)
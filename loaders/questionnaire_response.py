@@ -0,0 +1,35 @@
+from fhir.resources.questionnaireresponse import QuestionnaireResponse
+
+
+class QuestionnaireResponseBuilder:
+    """Collects the answers given in one administration of a questionnaire and builds a single QuestionnaireResponse
+    holding all of them, instead of one resource per answered item."""
+
+    def __init__(self, questionnaire, source, part_of=None, meta=None):
+        self.questionnaire = questionnaire
+        self.source = source
+        self.part_of = part_of
+        self.meta = meta
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, link_id, answer):
+        """`answer` is a FHIR answer value, e.g. {"valueString": "YES"}."""
+        self.items.append({"linkId": link_id, "answer": [answer]})
+
+    def build(self, resource_id, status="completed"):
+        properties = {}
+        if self.part_of is not None:
+            properties["partOf"] = self.part_of
+
+        if self.meta is not None:
+            properties["meta"] = self.meta
+
+        return QuestionnaireResponse(id=resource_id,
+                                     questionnaire=self.questionnaire,
+                                     status=status,
+                                     source=self.source,
+                                     item=self.items,
+                                     **properties)
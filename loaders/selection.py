@@ -0,0 +1,150 @@
+"""Selection of the part of a study to load, or to read back.
+
+A `Selection` restricts a load, or a `reader.WindowReader`, to some participants, devices, modalities, sessions,
+labels and a time range, every criterion left to None selecting everything. Loaders apply it as early as they can:
+unselected participants and sessions are not read at all, unselected modalities are skipped when listing files, zip
+members or record channels, and the time range is applied to the sample ranges of the signals before they are sliced
+and encoded.
+
+- Devices are matched against the device ids, e.g. "E4", "RespiBAN" or "Recorder".
+- Modalities are the modality tags of the signals, e.g. "eda" or "bvp". A modality also selects the features derived
+  from it, e.g. "eda-mean", which have no device.
+- Sessions and labels are the session and label tags, e.g. "TSST" and "stress" in WESAD, and the exams in WSPCP.
+- Times are datetimes, or seconds from the beginning of a participant's recording for the studies without absolute
+  times (WESAD). A criterion a study has no data for, e.g. sessions in SRAD, selects everything.
+
+    # E4 EDA of the stress sessions of WESAD
+    Selection(devices=["E4"], modalities=["eda"], sessions=["TSST"])
+
+Resource ids being deterministic, a partial load overwrites the resources it selects. The EvidenceReport and the
+ResearchStudy are only written by loads of a whole study, as they would miss the resources that were not selected."""
+
+import math
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+def get_seconds(value):
+    """Returns a datetime as a unix timestamp (naive datetimes being UTC), and a number of seconds as is."""
+    if isinstance(value, datetime):
+        return (value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)).timestamp()
+
+    return float(value)
+
+
+class Selection:
+    def __init__(self, participants=None, devices=None, modalities=None, sessions=None, labels=None, start=None,
+                 end=None):
+        self.participants = set(participants) if participants is not None else None
+        self.devices = {device.lower() for device in devices} if devices is not None else None
+        self.modalities = {modality.lower() for modality in modalities} if modalities is not None else None
+        self.sessions = {str(session) for session in sessions} if sessions is not None else None
+        self.labels = {str(label) for label in labels} if labels is not None else None
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        criteria = {name: value for name, value in vars(self).items() if value is not None}
+        return f"Selection({', '.join(f'{name}={value!r}' for name, value in criteria.items())})"
+
+    @property
+    def is_complete(self):
+        """Whether everything is selected."""
+        return all(value is None for value in vars(self).values())
+
+    @property
+    def is_absolute(self):
+        """Whether the time range is given as datetimes, rather than as seconds from the beginning of recordings."""
+        return any(isinstance(value, datetime) for value in (self.start, self.end))
+
+    def includes_participant(self, participant_id):
+        return self.participants is None or participant_id in self.participants
+
+    def includes_modality(self, modality, device=None):
+        """Whether the signals of `modality` recorded by `device` (a device id, None for derived signals) are
+        selected."""
+        modality = str(modality).lower()
+        if self.modalities is not None and modality not in self.modalities \
+                and modality.split("-")[0] not in self.modalities:
+            return False
+
+        if self.devices is None or device is None:
+            return True
+
+        return any(part in self.devices for part in str(device).lower().split("-"))
+
+    def includes_session(self, session):
+        return self.sessions is None or session is None or str(session) in self.sessions
+
+    def includes_label(self, label):
+        return self.labels is None or label is None or str(label) in self.labels
+
+    def includes_time(self, start, end, absolute=True):
+        """Whether the time range [start, end] overlaps the selected one. Absolute times are only compared to an
+        absolute selection, and times relative to the recording to a relative one."""
+        if (self.start is None and self.end is None) or absolute != self.is_absolute:
+            return True
+
+        if self.start is not None and get_seconds(end) < get_seconds(self.start):
+            return False
+
+        return self.end is None or get_seconds(start) < get_seconds(self.end)
+
+    def get_sample_range(self, length, frequency, start=None, offset=0):
+        """Returns the range [first, stop) of the selected samples of a signal of `length` samples at `frequency`,
+        whose first sample is at time `start` if known, and is sample `offset` of the recording."""
+        if (self.start is None and self.end is None) or not frequency:
+            return 0, length
+
+        if self.is_absolute:
+            if start is None:
+                return 0, length
+
+            origin = get_seconds(start)
+        else:
+            origin = offset / frequency
+
+        # Rounding avoids losing a sample to floating point errors when the range starts exactly on one.
+        first = 0 if self.start is None else math.ceil(round((get_seconds(self.start) - origin) * frequency, 6))
+        stop = length if self.end is None else math.ceil(round((get_seconds(self.end) - origin) * frequency, 6))
+        first = min(max(first, 0), length)
+        return first, min(max(stop, first), length)
+
+    def get_times_range(self, times, origin=None):
+        """Returns the range [first, stop) of the selected samples of a signal sampled at `times`, sorted unix
+        timestamps in seconds, of a recording that started at `origin`."""
+        if self.start is None and self.end is None:
+            return 0, len(times)
+
+        if not self.is_absolute:
+            if origin is None:
+                return 0, len(times)
+
+            times = np.asarray(times) - origin
+
+        first = 0 if self.start is None else int(np.searchsorted(times, get_seconds(self.start)))
+        stop = len(times) if self.end is None else int(np.searchsorted(times, get_seconds(self.end)))
+        return first, max(first, stop)
+
+    def includes_row(self, row):
+        """Whether a row of the catalog (see `catalog.py`) is selected. Sessions are not in the catalog."""
+        return (self.includes_participant(row["participant"])
+                and self.includes_modality(row["modality"] or "", row["device"].split("/")[-1]
+                                           if row["device"] else None)
+                and self.includes_label(row["label"])
+                and (row["start"] is None
+                     or self.includes_time(row["start"], row["end"], row["time_reference"] == "utc")))
+
+    def get_time_range(self, start, end, time_reference="utc"):
+        """Returns the intersection of [start, end), times in seconds in `time_reference`, and the selected range."""
+        if (self.start is None and self.end is None) or (time_reference == "utc") != self.is_absolute:
+            return start, end
+
+        if self.start is not None:
+            start = max(start, get_seconds(self.start))
+
+        if self.end is not None:
+            end = min(end, get_seconds(self.end))
+
+        return start, end
@@ -0,0 +1,208 @@
+"""Hand-off of signal arrays to the processes of a pipeline through shared memory.
+
+A `SharedArrayPool` copies arrays once into blocks of shared memory (`multiprocessing.shared_memory`) and returns
+`SharedArray` descriptors (block name, dtype, shape and offset), which are small to pickle. Processes `attach` a
+descriptor to get a read-only numpy view of the block, without copying it. Views of rows of a shared array (e.g. the
+segments of a recording) are descriptors of the same block at another offset.
+
+Blocks are reference counted: each descriptor returned by the pool holds a reference until it is `release`d. Released
+blocks are reused for the next arrays, up to `max_free_blocks`, and unlinked otherwise or when the pool is closed.
+
+    with SharedArrayPool() as pool:
+        shared = pool.put(signal)
+        segment = pool.view(shared, 0, 1000)
+        pool.release(shared)
+        executor.submit(compute, segment)   # compute calls attach(segment)
+        ...
+        pool.release(segment)
+"""
+
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+ALIGNMENT = 64
+
+# Blocks attached by this process, by name.
+_attached = {}
+_attached_lock = threading.Lock()
+
+
+class SharedArray:
+    """Descriptor of an array stored in the shared memory block `name`."""
+
+    def __init__(self, name, dtype, shape, offset=0):
+        self.name = name
+        self.dtype = np.dtype(dtype).str
+        self.shape = tuple(shape)
+        self.offset = offset
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape, dtype=np.int64)) * np.dtype(self.dtype).itemsize
+
+
+class SharedFrame:
+    """Descriptor of a numeric pandas DataFrame with a DatetimeIndex (e.g. an Empatica modality): its values, index
+    (as nanoseconds) and columns."""
+
+    def __init__(self, values: SharedArray, index: SharedArray, columns, tz=None):
+        self.values = values
+        self.index = index
+        self.columns = list(columns)
+        self.tz = tz
+
+
+class _Block:
+    def __init__(self, size):
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.size = size
+        self.used = 0
+        self.references = 0
+
+
+def attach(shared: SharedArray):
+    """Returns a read-only numpy view of a shared array, in any process."""
+    with _attached_lock:
+        memory = _attached.get(shared.name)
+        if memory is None:
+            memory = _attached[shared.name] = shared_memory.SharedMemory(name=shared.name)
+
+    array = np.ndarray(shared.shape, dtype=shared.dtype, buffer=memory.buf, offset=shared.offset)
+    array.flags.writeable = False
+    return array
+
+
+def attach_frame(shared: SharedFrame):
+    """Returns the DataFrame of a `SharedFrame`, whose values are a view of the shared memory."""
+    index = pd.DatetimeIndex(attach(shared.index).view("datetime64[ns]"))
+    if shared.tz is not None:
+        index = index.tz_localize("UTC").tz_convert(shared.tz)
+
+    return pd.DataFrame(attach(shared.values), index=index, columns=shared.columns, copy=False)
+
+
+def detach(name=None):
+    """Closes the blocks attached by this process (or block `name`) that are no longer viewed, so that unlinked
+    blocks are freed."""
+    with _attached_lock:
+        for block_name in [name] if name is not None else list(_attached):
+            memory = _attached.get(block_name)
+            if memory is None:
+                continue
+
+            try:
+                memory.close()
+            except BufferError:
+                # Arrays still view the block.
+                continue
+
+            del _attached[block_name]
+
+
+class SharedArrayPool:
+    def __init__(self, block_size=16 * 1024 * 1024, max_free_blocks=4):
+        self.block_size = block_size
+        self.max_free_blocks = max_free_blocks
+        self.__blocks = {}
+        self.__free = []
+        self.__current = None
+        self.__lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def put(self, array) -> SharedArray:
+        """Copies `array` into shared memory. Returns its descriptor, which holds a reference to the block."""
+        array = np.ascontiguousarray(array)
+        with self.__lock:
+            block, offset = self.__allocate(array.nbytes)
+            shared = SharedArray(block.memory.name, array.dtype, array.shape, offset)
+            block.references += 1
+
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.memory.buf, offset=offset)[...] = array
+        return shared
+
+    def view(self, shared: SharedArray, start, stop) -> SharedArray:
+        """Returns the descriptor of the rows `start:stop` of a shared array, without copying them. It holds its own
+        reference to the block."""
+        start, stop, _ = slice(start, stop).indices(shared.shape[0])
+        stop = max(stop, start)
+        row_nbytes = shared.nbytes // shared.shape[0] if shared.shape[0] else 0
+        with self.__lock:
+            self.__blocks[shared.name].references += 1
+
+        return SharedArray(shared.name, shared.dtype, (stop - start, *shared.shape[1:]),
+                           shared.offset + start * row_nbytes)
+
+    def release(self, shared: SharedArray):
+        """Drops the reference of a descriptor. A block without references is reused, or unlinked."""
+        with self.__lock:
+            block = self.__blocks[shared.name]
+            block.references -= 1
+            if block.references > 0:
+                return
+
+            block.used = 0
+            if block is self.__current:
+                return
+
+            del self.__blocks[shared.name]
+            if block.size == self.block_size and len(self.__free) < self.max_free_blocks:
+                self.__free.append(block)
+            else:
+                self.__unlink(block)
+
+    def put_frame(self, frame) -> SharedFrame:
+        """Copies a numeric DataFrame with a DatetimeIndex into shared memory."""
+        tz = str(frame.index.tz) if frame.index.tz is not None else None
+        index = frame.index.tz_convert("UTC").tz_localize(None) if tz is not None else frame.index
+        return SharedFrame(self.put(frame.to_numpy()), self.put(index.asi8), frame.columns, tz)
+
+    def view_frame(self, shared: SharedFrame, start, stop) -> SharedFrame:
+        return SharedFrame(self.view(shared.values, start, stop), self.view(shared.index, start, stop),
+                           shared.columns, shared.tz)
+
+    def release_frame(self, shared: SharedFrame):
+        self.release(shared.values)
+        self.release(shared.index)
+
+    def close(self):
+        """Unlinks every block. Descriptors of the pool must not be attached anymore."""
+        with self.__lock:
+            for block in list(self.__blocks.values()) + self.__free:
+                self.__unlink(block)
+
+            self.__blocks = {}
+            self.__free = []
+            self.__current = None
+
+    def __allocate(self, nbytes):
+        if nbytes > self.block_size:
+            # Large arrays get a block of their own, unlinked once released.
+            block = _Block(nbytes)
+            self.__blocks[block.memory.name] = block
+            block.used = nbytes
+            return block, 0
+
+        current = self.__current
+        if current is None or current.used + nbytes > current.size:
+            # The full block stays allocated until its arrays are released, see `release`.
+            current = self.__free.pop() if self.__free else _Block(self.block_size)
+            self.__blocks[current.memory.name] = current
+            self.__current = current
+
+        offset = current.used
+        current.used = -(-(offset + nbytes) // ALIGNMENT) * ALIGNMENT
+        return current, offset
+
+    @staticmethod
+    def __unlink(block):
+        detach(block.memory.name)
+        block.memory.close()
+        block.memory.unlink()
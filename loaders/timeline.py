@@ -0,0 +1,117 @@
+"""Run-length encoded label timelines.
+
+Labels change rarely compared to the sampling rate of the signals they annotate, e.g. the 700 Hz label vector of a
+WESAD participant holds a few dozen runs over hours of recording. A `LabelTimeline` stores the runs of labels, as
+(start, end, value) with `start` and `end` in integer ticks of 1 / `frequency` seconds, instead of a label per sample.
+It is built once, from a label per sample or from labelled periods, and then:
+
+- queried by time (`get_value`, `find`),
+- projected onto the samples of a signal at any sampling rate (`get_sample_range`), so that the samples of a run are
+  a range of the signal rather than a boolean mask over it,
+- and turned into the labelled periods of the label Observations of the loaders (`get_period`).
+
+    timeline = LabelTimeline.from_samples(labels, frequency=700)
+    for run, (start, end, value) in enumerate(timeline):
+        first, stop = timeline.get_sample_range(run, frequency=4)
+        eda[first:stop]
+"""
+
+import math
+
+import numpy as np
+
+
+class LabelTimeline:
+    def __init__(self, starts, ends, values, frequency=1):
+        """Runs [starts[i], ends[i]) of label values[i], in ticks of 1 / `frequency` seconds. Runs are sorted and do not
+        overlap, empty runs are dropped."""
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        not_empty = ends > starts
+        self.starts = starts[not_empty]
+        self.ends = ends[not_empty]
+        self.values = np.asarray(values)[not_empty]
+        self.frequency = frequency
+
+    @classmethod
+    def from_samples(cls, labels, frequency=1, start=0):
+        """Returns the timeline of a label per sample, `labels`, at `frequency`, whose first sample is tick `start`."""
+        labels = np.asarray(labels)
+        if len(labels) == 0:
+            return cls([], [], labels, frequency)
+
+        changes = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+        starts = np.concatenate(([0], changes))
+        ends = np.concatenate((changes, [len(labels)]))
+        return cls(starts + start, ends + start, labels[starts], frequency)
+
+    @classmethod
+    def from_periods(cls, periods, start, end, default=None, frequency=1):
+        """Returns the timeline of [start, end) labelled by `periods`, (start, end, value) in ticks, a period taking
+        precedence over the ones before it, and `default` elsewhere. Neighbouring runs of the same value are merged."""
+        boundaries = sorted({start, end, *(min(max(tick, start), end) for period in periods for tick in period[:2])})
+        starts, ends, values = [], [], []
+        for run_start, run_end in zip(boundaries[:-1], boundaries[1:]):
+            value = default
+            for period_start, period_end, period_value in periods:
+                if period_start <= run_start and run_end <= period_end:
+                    value = period_value
+
+            if values and values[-1] == value:
+                ends[-1] = run_end
+                continue
+
+            starts.append(run_start)
+            ends.append(run_end)
+            values.append(value)
+
+        return cls(starts, ends, np.array(values, dtype=object), frequency)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts.tolist(), self.ends.tolist(), self.values.tolist())
+
+    def find(self, ticks):
+        """Returns the index of the run holding each of `ticks`, -1 outside of the runs."""
+        ticks = np.asarray(ticks, dtype=np.int64)
+        runs = np.searchsorted(self.starts, ticks, side="right") - 1
+        inside = (runs >= 0) & (ticks < self.ends[np.maximum(runs, 0)]) if len(self) else np.zeros_like(ticks, bool)
+        return np.where(inside, runs, -1)
+
+    def get_value(self, tick, default=None):
+        run = int(self.find(tick))
+        return self.values[run] if run >= 0 else default
+
+    def get_period(self, run):
+        """Returns the (start, end) of a run in seconds."""
+        return self.starts[run] / self.frequency, self.ends[run] / self.frequency
+
+    def get_sample_range(self, run, frequency, origin=0, length=None, nearest=False):
+        """Returns the range [first, stop) of the samples of a signal at `frequency`, whose first sample is at tick
+        `origin`, that lie in a run, clipped to the `length` of the signal. With `nearest`, a sample is in the run of
+        the tick nearest to it (rounding half to even, as numpy does) rather than of the tick it falls in."""
+        ticks_per_sample = self.frequency / frequency
+        first = self.__get_first_sample(self.starts[run] - origin, ticks_per_sample, nearest)
+        stop = self.__get_first_sample(self.ends[run] - origin, ticks_per_sample, nearest)
+        if length is not None:
+            first, stop = min(first, length), min(stop, length)
+
+        return max(first, 0), max(stop, first, 0)
+
+    @staticmethod
+    def __get_first_sample(tick, ticks_per_sample, nearest):
+        """Returns the first sample at or after `tick`."""
+        if not nearest:
+            return math.ceil(round(tick / ticks_per_sample, 6))
+
+        # The estimate is corrected on the exact rounding of the neighbouring samples.
+        sample = math.ceil((tick - 0.5) / ticks_per_sample)
+        while np.round(sample * ticks_per_sample) < tick:
+            sample += 1
+
+        while np.round((sample - 1) * ticks_per_sample) >= tick:
+            sample -= 1
+
+        return sample
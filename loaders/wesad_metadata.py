@@ -0,0 +1,103 @@
+"""Parser of the metadata WESAD stores next to the signals of each participant (`S*_quest.csv` and `S*_readme.txt`)."""
+
+import functools
+import os
+import re
+
+PERSONAL_INFORMATION_PATTERN = re.compile(r"([a-zA-Z ]*)(|[()a-z]*): ([a-zA-Z\d.]*)")
+PREREQUISITE_PATTERN = re.compile(r"([a-zA-Z\s]*\?)\s*([a-zA-Z]*)")
+
+# The quest files label the SAM questionnaire as DIM.
+QUESTIONNAIRE_TAGS = {"SAM": "DIM"}
+
+
+def convert_time(time):
+    """Converts the minutes.seconds notation of the quest files to seconds."""
+    if "." in time:
+        minutes, seconds = time.split(".")
+    else:
+        minutes, seconds = time, "0"
+
+    return int(minutes) * 60 + int(seconds)
+
+
+class WESADParticipantMetadata:
+    """Everything known about a participant besides the signals: sessions with their start and end time (in seconds
+    from the beginning of the recording), the answers of every questionnaire, personal information, study
+    prerequisites and additional notes. It only holds plain python objects, so it can be sent to worker processes."""
+
+    def __init__(self, participant_id, sessions, starts, ends, questionnaire_rows, personal_information,
+                 study_pre_requisites, additional_notes):
+        self.participant_id = participant_id
+        self.sessions = sessions
+        self.starts = starts
+        self.ends = ends
+        self.questionnaire_rows = questionnaire_rows
+        self.personal_information = personal_information
+        self.study_pre_requisites = study_pre_requisites
+        self.additional_notes = additional_notes
+
+    def answers(self, questionnaire):
+        """Returns the answer rows of `questionnaire`, one per administration, in the order of the file."""
+        return self.questionnaire_rows.get(QUESTIONNAIRE_TAGS.get(questionnaire, questionnaire), [])
+
+
+def parse_quest_file(file_name):
+    """Returns the session names, start and end times and the answer rows of the quest file, grouped by
+    questionnaire. Answer rows are the answers of one administration (the fields between the questionnaire tag and
+    the end of the line)."""
+    with open(file_name) as quest_file:
+        lines = quest_file.readlines()
+
+    sessions = lines[1].split(";")[1:6]
+    starts = [convert_time(item) for item in lines[2].split(";")[1:6]]
+    ends = [convert_time(item) for item in lines[3].split(";")[1:6]]
+
+    questionnaire_rows = {}
+    for line in lines[4:]:
+        fields = line.split(";")
+        if not fields[0].startswith("#"):
+            continue
+
+        questionnaire_rows.setdefault(fields[0].lstrip("# ").strip(), []).append(fields[1:-1])
+
+    return sessions, starts, ends, questionnaire_rows
+
+
+def parse_readme_file(file_name):
+    """Returns the personal information as (key, unit, value) tuples, the study prerequisites as (question, answer)
+    tuples and the additional notes as a single string."""
+    sections = {"Personal": [], "Study": [], "Additional": []}
+    current_list = sections["Personal"]
+    with open(file_name) as readme_file:
+        for line in readme_file:
+            section = next((name for name in sections if name in line), None)
+            if section is not None:
+                current_list = sections[section]
+                continue
+
+            if line.strip() == "":
+                continue
+
+            current_list.append(line)
+
+    personal_information = []
+    for info_line in sections["Personal"]:
+        key, unit, value = PERSONAL_INFORMATION_PATTERN.match(info_line).groups()
+        personal_information.append((key.strip(), unit, value))
+
+    study_pre_requisites = [PREREQUISITE_PATTERN.match(line).groups() for line in sections["Study"]]
+    return personal_information, study_pre_requisites, "".join(sections["Additional"])
+
+
+@functools.lru_cache(maxsize=None)
+def read_participant_metadata(dataset_dir, participant_id):
+    """Reads the quest and readme files of a participant exactly once, later calls return the cached object."""
+    participant_dir = os.path.join(dataset_dir, participant_id)
+    sessions, starts, ends, questionnaire_rows = parse_quest_file(
+        os.path.join(participant_dir, f"{participant_id}_quest.csv"))
+    personal_information, study_pre_requisites, additional_notes = parse_readme_file(
+        os.path.join(participant_dir, f"{participant_id}_readme.txt"))
+
+    return WESADParticipantMetadata(participant_id, sessions, starts, ends, questionnaire_rows, personal_information,
+                                    study_pre_requisites, additional_notes)
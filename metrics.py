@@ -0,0 +1,176 @@
+"""Instrumentation for the ingest pipeline.
+
+`Metrics` keeps counters and histograms in memory (cheap enough to be used around every HTTP call) and exports them in
+the Prometheus text format, either to a file or through a small HTTP endpoint. `ProgressReporter` replaces per-resource
+printing with a rate-limited summary line."""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 300.)
+SIZE_BUCKETS = (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24, 1 << 26, 1 << 28)
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(label_key, **extra):
+    items = list(label_key) + [(k, str(v)) for k, v in extra.items()]
+    if not items:
+        return ""
+
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Thread safe registry of counters and histograms identified by name and labels."""
+
+    def __init__(self, prefix="codex"):
+        self.prefix = prefix
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__histograms = {}
+        self.__buckets = {}
+
+    def name(self, name):
+        return f"{self.prefix}_{name}" if self.prefix else name
+
+    def register_histogram(self, name, buckets):
+        self.__buckets[self.name(name)] = tuple(buckets)
+
+    def increment(self, name, value=1, **labels):
+        key = (self.name(name), _label_key(labels))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        name = self.name(name)
+        key = (name, _label_key(labels))
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram(self.__buckets.get(name, LATENCY_BUCKETS))
+
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes the wall time spent in the block, in seconds, into the `name` histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter_value(self, name, **labels):
+        with self.__lock:
+            return self.__counters.get((self.name(name), _label_key(labels)), 0)
+
+    def to_prometheus(self):
+        lines = []
+        with self.__lock:
+            counters = sorted(self.__counters.items())
+            histograms = sorted(self.__histograms.items(), key=lambda item: item[0])
+            declared = set()
+            for (name, labels), value in counters:
+                if name not in declared:
+                    lines.append(f"# TYPE {name} counter")
+                    declared.add(name)
+
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+            for (name, labels), histogram in histograms:
+                if name not in declared:
+                    lines.append(f"# TYPE {name} histogram")
+                    declared.add(name)
+
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, le=bound)} {cumulative}")
+
+                lines.append(f"{name}_bucket{_format_labels(labels, le='+Inf')} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        with open(path, "w") as metrics_file:
+            metrics_file.write(self.to_prometheus())
+
+    def serve(self, port, host="0.0.0.0"):
+        """Starts a daemon thread answering every GET with the Prometheus text exposition of the registry."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class ProgressReporter:
+    """Counts processed items and prints a summary at most once every `interval` seconds."""
+
+    def __init__(self, interval=10., out=print):
+        self.interval = interval
+        self.out = out
+        self.__lock = threading.Lock()
+        self.__counts = {}
+        self.__start = time.monotonic()
+        self.__last_report = self.__start
+
+    def update(self, kind, value=1):
+        now = time.monotonic()
+        with self.__lock:
+            self.__counts[kind] = self.__counts.get(kind, 0) + value
+            if now - self.__last_report < self.interval:
+                return
+
+            self.__last_report = now
+            counts = dict(self.__counts)
+
+        self.report(counts, now - self.__start)
+
+    def report(self, counts=None, elapsed=None):
+        if counts is None:
+            with self.__lock:
+                counts = dict(self.__counts)
+
+        elapsed = time.monotonic() - self.__start if elapsed is None else elapsed
+        total = sum(counts.values())
+        detail = ", ".join(f"{kind}: {count}" for kind, count in sorted(counts.items()))
+        self.out(f"[{elapsed:8.1f}s] {total} resources ({total / max(elapsed, 1e-9):.1f}/s) {detail}")
+
+
+metrics = Metrics()
+metrics.register_histogram("payload_bytes", SIZE_BUCKETS)
+progress = ProgressReporter()
@@ -0,0 +1,185 @@
+"""Random access to fixed-length windows of the signals stored on the FHIR server.
+
+`WindowReader` maps (participant, modality, time window) to the covering Observations through the catalog (see
+`catalog.py`), fetches them, asynchronously when they are prefetched, and decodes them into numpy. Decoded chunks are
+kept in a size-bounded memory cache, backed by an optional disk cache of their payloads keyed by the payload hash.
+A `loaders.selection.Selection` restricts the reader to some participants, modalities, labels and a time range: the
+Observations it excludes are not fetched, and windows are clipped to the selected time range.
+
+    reader = WindowReader(FHIRConnector(url), Catalog("datasets/catalog.sqlite"), cache_dir="cache")
+    for window in reader.windows([("S5", "bvp", t, t + 60) for t in range(0, 3600, 60)], device="E4"):
+        train(window.data, window.labels)
+"""
+
+import math
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cache import DiskCache, MemoryCache
+from catalog import Catalog
+from connector import FHIRConnector
+from loaders.selection import Selection
+from utils import get_attachment_payload, read_pickle_payload
+
+# `data` holds the samples of the window, `labels` the (start, end, label) of the signals it was cut from.
+Window = namedtuple("Window", ["data", "labels"])
+
+
+def get_lags(data, lags):
+    """Returns the lagged copies of a signal (e.g. the lagged means of the SDN features) described by the "lags"
+    component of its Observation, `lags` being the (low, high) range of the component. Column i holds the samples
+    `lags[0] + i` rows earlier, NaN before the first sample. The columns are strided views of one padded copy of the
+    signal."""
+    low, high = lags
+    data = np.asarray(data, dtype=float).ravel()
+    padded = np.concatenate((np.full(high, np.nan), data))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, high + 1)
+    # Row i of the windows ends with sample i, lag k being at position high - k.
+    return windows[:, high - low::-1]
+
+
+def get_lag_range(observation):
+    """Returns the (low, high) range of the "lags" component of an Observation (a dict), None if it has none."""
+    for component in observation.get("component", []):
+        if any(coding.get("code") == "lags" for coding in component["code"].get("coding", [])):
+            return int(component["valueRange"]["low"]["value"]), int(component["valueRange"]["high"]["value"])
+
+    return None
+
+
+def get_nbytes(data):
+    if hasattr(data, "memory_usage"):
+        return int(np.sum(data.memory_usage(index=True)))
+
+    return np.asarray(data).nbytes
+
+
+class WindowReader:
+    def __init__(self, server: FHIRConnector, catalog: Catalog, cache_dir=None, memory_bytes=512 * 1024 * 1024,
+                 disk_bytes=4 * 1024 * 1024 * 1024, max_workers=4, selection: Selection = None):
+        self.server = server
+        self.catalog = catalog
+        self.selection = selection if selection is not None else Selection()
+        self.memory = MemoryCache(memory_bytes)
+        self.disk = DiskCache(cache_dir, disk_bytes) if cache_dir is not None else None
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__pending = {}
+        self.__lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
+
+    def get_rows(self, participant, modality, start, end, study=None, device=None):
+        """Returns the catalog rows of the Observations holding the samples of the window, i.e. the chunks of split
+        signals and the signals that were not split, that are selected. `device` filters by a part of the DeviceMetric
+        reference, e.g. "E4"."""
+        rows = self.catalog.find(study=study, participant=participant, modality=modality, start=start, end=end,
+                                 chunks=True)
+        return [row for row in rows if row["payload_hash"] is not None
+                and (device is None or device in (row["device"] or "")) and self.selection.includes_row(row)]
+
+    def prefetch(self, participant, modality, start, end, study=None, device=None):
+        """Starts fetching the Observations of a window in the background."""
+        for row in self.get_rows(participant, modality, start, end, study, device):
+            if row["payload_hash"] not in self.memory:
+                self.__submit(row)
+
+    def read(self, participant, modality, start, end, study=None, device=None):
+        """Returns the `Window` of samples in [start, end), times being in the `time_reference` of the catalog, clipped
+        to the selected time range."""
+        pieces = []
+        labels = []
+        for row in self.get_rows(participant, modality, start, end, study, device):
+            row_start, row_end = self.selection.get_time_range(start, end, row["time_reference"])
+            if row_end <= row_start:
+                continue
+
+            piece = self.slice(self.__get(row), row, row_start, row_end)
+            if len(piece) == 0:
+                continue
+
+            pieces.append(piece)
+            labels.append((float(max(row["start"], row_start)), float(min(row["end"], row_end)), row["label"]))
+
+        if not pieces:
+            return Window(np.empty(0), [])
+
+        return Window(np.concatenate(pieces), labels)
+
+    def windows(self, requests, lookahead=4, study=None, device=None):
+        """Yields the windows of `requests`, (participant, modality, start, end) tuples, while the following
+        `lookahead` windows are being prefetched."""
+        queued = deque()
+        requests = iter(requests)
+        for request in requests:
+            queued.append(request)
+            self.prefetch(*request, study=study, device=device)
+            if len(queued) > lookahead:
+                yield self.read(*queued.popleft(), study=study, device=device)
+
+        while queued:
+            yield self.read(*queued.popleft(), study=study, device=device)
+
+    @staticmethod
+    def slice(data, row, start, end):
+        """Returns the samples of `data`, the decoded Observation of `row`, that lie in [start, end)."""
+        if isinstance(getattr(data, "index", None), pd.DatetimeIndex):
+            times = data.index.asi8 / 1e9
+            return data.iloc[np.searchsorted(times, start):np.searchsorted(times, end)].to_numpy()
+
+        data = data.to_numpy() if hasattr(data, "to_numpy") else np.asarray(data)
+        if not row["frequency"]:
+            return data
+
+        # Rounding avoids losing a sample to floating point errors when the window starts exactly on one.
+        first = max(math.ceil(round((start - row["start"]) * row["frequency"], 6)), 0)
+        last = max(math.ceil(round((end - row["start"]) * row["frequency"], 6)), 0)
+        return data[first:last]
+
+    def __get(self, row):
+        data = self.memory.get(row["payload_hash"])
+        if data is not None:
+            return data
+
+        return self.__submit(row).result()
+
+    def __submit(self, row):
+        key = row["payload_hash"]
+        with self.__lock:
+            future = self.__pending.get(key)
+            if future is None:
+                future = self.__executor.submit(self.__load, row)
+                self.__pending[key] = future
+
+        return future
+
+    def __load(self, row):
+        key = row["payload_hash"]
+        try:
+            data = self.memory.get(key)
+            if data is not None:
+                return data
+
+            payload = self.disk.get(key) if self.disk is not None else None
+            if payload is None:
+                observation = self.server.read("Observation", row["resource_id"], cached=False)
+                payload = get_attachment_payload(observation["valueAttachment"])
+                if self.disk is not None:
+                    self.disk.put(key, payload)
+
+            data = read_pickle_payload(payload)
+            self.memory.put(key, data, get_nbytes(data))
+            return data
+        finally:
+            with self.__lock:
+                self.__pending.pop(key, None)
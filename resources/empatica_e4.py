@@ -1,20 +1,19 @@
 import os
 from glob import glob
 
+import numpy as np
 import pandas as pd
 from fhir.resources.device import Device
 from fhir.resources.devicemetric import DeviceMetric
 
-from static_resources.device_definition.empatica_e4 import empatica_e4_definition, empatica_e4_acc_definition, \
-    empatica_e4_bvp_definition, empatica_e4_eda_definition, empatica_e4_temperature_definition, \
-    empatica_e4_ibi_definition, empatica_e4_hr_definition, empatica_e4_tags_definition
+from static_resources.device_definition import empatica_e4 as definitions
 from utils import get_reference, get_codeable_reference
 
 
 def empatica_e4(device_properties=None, acc_props=None, bvp_props=None, eda_props=None,
                 temp_props=None, ibi_props=None, hr_props=None):
     defaults_ = {"status": "active",
-                 "definition": get_codeable_reference(empatica_e4_definition),
+                 "definition": get_codeable_reference(definitions.empatica_e4_definition),
                  }
 
     # Initialize parameters
@@ -44,7 +43,7 @@ def __create_bvp(bvp_props, empatica, resources):
     bvp_props_ = {
         "id": f"{empatica.id}-bvp",
         "status": "active",
-        "definition": get_codeable_reference(empatica_e4_bvp_definition),
+        "definition": get_codeable_reference(definitions.empatica_e4_bvp_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 64, "unit": "Hz"}}
@@ -65,7 +64,7 @@ def __create_eda(eda_props, empatica, resources):
     eda_props_ = {
         "id": f"{empatica.id}-eda",
         "status": "active",
-        "definition": get_codeable_reference(empatica_e4_eda_definition),
+        "definition": get_codeable_reference(definitions.empatica_e4_eda_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 4, "unit": "Hz"}}
@@ -86,7 +85,7 @@ def __create_temperature(temp_props, empatica, resources):
     temp_props_ = {
         "id": f"{empatica.id}-temp",
         "status": "active",
-        "definition": get_codeable_reference(empatica_e4_temperature_definition),
+        "definition": get_codeable_reference(definitions.empatica_e4_temperature_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 4, "unit": "Hz"}}
@@ -107,7 +106,7 @@ def __create_accelerometer(acc_props, empatica, resources):
     acc_props_ = {
         "id": f"{empatica.id}-acc",
         "status": "active",
-        "definition": get_codeable_reference(empatica_e4_acc_definition),
+        "definition": get_codeable_reference(definitions.empatica_e4_acc_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 32, "unit": "Hz"}},
@@ -131,7 +130,7 @@ def __create_ibi(ibi_props, empatica, resources):
     ibi_props_ = {
         "id": f"{empatica.id}-ibi",
         "status": "active",
-        "definition": get_codeable_reference(empatica_e4_ibi_definition),
+        "definition": get_codeable_reference(definitions.empatica_e4_ibi_definition),
     }
     ibi_props_.update(ibi_props)
     ibi_device = __empatica_e4_modality(empatica, **ibi_props_)
@@ -148,7 +147,7 @@ def __create_tags(empatica, resources):
     tags_props_ = {
         "id": f"{empatica.id}-tags",
         "status": "active",
-        "definition": get_codeable_reference(empatica_e4_tags_definition),
+        "definition": get_codeable_reference(definitions.empatica_e4_tags_definition),
     }
 
     tags_device = __empatica_e4_modality(empatica, **tags_props_)
@@ -165,7 +164,7 @@ def __create_hr(hr_props, empatica, resources):
     hr_props_ = {
         "id": f"{empatica.id}-hr",
         "status": "active",
-        "definition": get_codeable_reference(empatica_e4_hr_definition),
+        "definition": get_codeable_reference(definitions.empatica_e4_hr_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 1, "unit": "Hz"}}
@@ -182,6 +181,36 @@ def __create_hr(hr_props, empatica, resources):
     resources.extend([hr_device, hr_device_metric])
 
 
+def empatica_read_csv(modality_path):
+    """Reads a single csv file of an empatica data dir without building intermediate DataFrames. It returns the start
+    timestamp (unix time in seconds), the sampling frequency and a float64 numpy array with one sample per row.
+
+    IBI files have no frequency and their first column holds the offset of each beat from the start time; tags files
+    have neither start time nor frequency and hold one button press timestamp per row. Empty files return
+    (None, None, None)."""
+    metric = os.path.basename(modality_path)[:-4]
+    with open(modality_path) as csv_file:
+        header = csv_file.readline()
+        if header.strip() == "":
+            return None, None, None
+
+        if metric == "tags":
+            rows = [float(header)] + [float(line) for line in csv_file if line.strip()]
+            return None, None, np.array(rows, dtype=np.float64).reshape(-1, 1)
+
+        timestamp = float(header.split(",")[0])
+        frequency = None
+        if metric != "IBI":
+            frequency = float(csv_file.readline().split(",")[0])
+
+        try:
+            values = pd.read_csv(csv_file, header=None, dtype=np.float64, engine="c").to_numpy()
+        except pd.errors.EmptyDataError:
+            values = np.empty((0, len(header.split(","))), dtype=np.float64)
+
+    return timestamp, frequency, values
+
+
 def empatica_read_dataframe(data_dir, tz=None):
     """Reads csv files from an empatica data dir. It returns a dictionary with key value pairs set to the modality
     and the dataframe respectively. The dataframe contains time indexed values."""
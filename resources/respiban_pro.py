@@ -1,16 +1,14 @@
 from fhir.resources.device import Device
 from fhir.resources.devicemetric import DeviceMetric
 
-from static_resources.device_definition.respiban import respiban_definition, respiban_acc_definition, \
-    respiban_pzt_definition, respiban_eda_definition, respiban_temperature_definition, respiban_ecg_definition, \
-    respiban_emg_definition
+from static_resources.device_definition import respiban as definitions
 from utils import get_reference, get_codeable_reference
 
 
 def respiban_pro(device_properties=None, acc_props=None, pzt_props=None, eda_props=None, temp_props=None,
              emg_props=None, ecg_props=None):
     defaults_ = {"status": "active",
-                 "definition": get_codeable_reference(respiban_definition),
+                 "definition": get_codeable_reference(definitions.respiban_definition),
                  }
 
     # Initialize parameters
@@ -38,7 +36,7 @@ def __create_pzt(pzt_props, respiban, resources):
     pzt_props_ = {
         "id": f"{respiban.id}-resp",
         "status": "active",
-        "definition": get_codeable_reference(respiban_pzt_definition),
+        "definition": get_codeable_reference(definitions.respiban_pzt_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 700, "unit": "Hz"}}
@@ -59,7 +57,7 @@ def __create_eda(eda_props, respiban, resources):
     eda_props_ = {
         "id": f"{respiban.id}-eda",
         "status": "active",
-        "definition": get_codeable_reference(respiban_eda_definition),
+        "definition": get_codeable_reference(definitions.respiban_eda_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 700, "unit": "Hz"}}
@@ -80,7 +78,7 @@ def __create_ecg(ecg_props, respiban, resources):
     ecg_props_ = {
         "id": f"{respiban.id}-ecg",
         "status": "active",
-        "definition": get_codeable_reference(respiban_ecg_definition),
+        "definition": get_codeable_reference(definitions.respiban_ecg_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 700, "unit": "Hz"}}
@@ -101,7 +99,7 @@ def __create_emg(emg_props, respiban, resources):
     emg_props_ = {
         "id": f"{respiban.id}-emg",
         "status": "active",
-        "definition": get_codeable_reference(respiban_emg_definition),
+        "definition": get_codeable_reference(definitions.respiban_emg_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 700, "unit": "Hz"}}
@@ -122,7 +120,7 @@ def __create_temperature(temp_props, respiban, resources):
     temp_props_ = {
         "id": f"{respiban.id}-temp",
         "status": "active",
-        "definition": get_codeable_reference(respiban_temperature_definition),
+        "definition": get_codeable_reference(definitions.respiban_temperature_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 700, "unit": "Hz"}}
@@ -143,7 +141,7 @@ def __create_accelerometer(acc_props, respiban, resources):
     acc_props_ = {
         "id": f"{respiban.id}-acc",
         "status": "active",
-        "definition": get_codeable_reference(respiban_acc_definition),
+        "definition": get_codeable_reference(definitions.respiban_acc_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 700, "unit": "Hz"}}
@@ -1,8 +1,7 @@
 from fhir.resources.device import Device
 from fhir.resources.devicemetric import DeviceMetric
 
-from static_resources.device_definition.srad_recorder import srad_recorder_definition, srad_recorder_emg_definition, \
-    srad_recorder_ekg_definition, srad_recorder_sc_definition, srad_recorder_resp_definition
+from static_resources.device_definition import srad_recorder as definitions
 from utils import get_codeable_reference, get_reference
 
 
@@ -10,7 +9,7 @@ def __create_ekg(ekg_props, srad_recorder_, resources, channels):
     ekg_props_ = {
         "id": f"{srad_recorder_.id}-ecg",
         "status": "active",
-        "definition": get_codeable_reference(srad_recorder_ekg_definition),
+        "definition": get_codeable_reference(definitions.srad_recorder_ekg_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 15.5, "unit": "Hz"}}
@@ -38,7 +37,7 @@ def __create_emg(emg_props, srad_recorder_, resources, channels):
     emg_props_ = {
         "id": f"{srad_recorder_.id}-emg",
         "status": "active",
-        "definition": get_codeable_reference(srad_recorder_emg_definition),
+        "definition": get_codeable_reference(definitions.srad_recorder_emg_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 15.5, "unit": "Hz"}}
@@ -59,7 +58,7 @@ def __create_sc(channel, sc_props, srad_recorder_, resources, channels):
     sc_props_ = {
         "id": f"{srad_recorder_.id}-sc-{channel}",
         "status": "active",
-        "definition": get_codeable_reference(srad_recorder_sc_definition),
+        "definition": get_codeable_reference(definitions.srad_recorder_sc_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 15.5, "unit": "Hz"}}
@@ -88,7 +87,7 @@ def __create_resp(pzt_props, srad_recorder_, resources, channels):
     pzt_props_ = {
         "id": f"{srad_recorder_.id}-resp",
         "status": "active",
-        "definition": get_codeable_reference(srad_recorder_resp_definition),
+        "definition": get_codeable_reference(definitions.srad_recorder_resp_definition),
         "property": [
             {"type": {"coding": [{"code": "sampling rate"}]},
              "valueQuantity": {"value": 15.5, "unit": "Hz"}}
@@ -113,7 +112,7 @@ def srad_recorder(device_properties=None,
                   sc_1_props=None,
                   sc_2_props=None):
     defaults_ = {"status": "active",
-                 "definition": get_codeable_reference(srad_recorder_definition),
+                 "definition": get_codeable_reference(definitions.srad_recorder_definition),
                  }
 
     # Initialize parameters
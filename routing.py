@@ -0,0 +1,253 @@
+"""Upload of the studies to several FHIR endpoints, e.g. HAPI replicas or the partitions of a partitioned HAPI server.
+
+`RoutingConnector` has the interface of `FHIRConnector` and sends each resource to one of its endpoints, chosen by
+rendezvous hashing of a stable key, the study and participant (or only the study) of the resource. All the resources
+of a participant end up on the same endpoint, and adding or removing an endpoint only moves the participants of that
+endpoint. The key of a resource is found, in order:
+
+- from its study and participant tags (see `static_resources.search_parameters.codex`),
+- from the endpoint of the resources it references, when they were all routed to the same one, e.g. the Patient of a
+  BodyStructure.
+
+Other resources, the static resources (DeviceDefinitions, Questionnaires, SearchParameters, ...), devices and
+the study level resources (Group, EvidenceReport, ResearchStudy, ...), are sent to every endpoint, so each endpoint
+holds the full index of the study. References of study level resources to other endpoints are not resolved: HAPI
+partitions need `partitioning.allow_references_across_partitions`, replicas `enforce_referential_integrity_on_write`
+turned off.
+
+Each endpoint has its own `FHIRConnector`, so its own connection pool and upload controller. Endpoints are checked in
+the background, writes to an endpoint that is down wait for it to be back up to `unhealthy_timeout` seconds."""
+
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fhir.resources.resource import Resource
+from fhirclient.server import FHIRNotFoundException, FHIRPermissionDeniedException, FHIRUnauthorizedException
+from requests import HTTPError, RequestException
+
+from connector import FHIRConnector
+from metrics import metrics
+from static_resources.search_parameters.codex import TAG_SYSTEMS
+
+BROADCAST_RESOURCE_TYPES = ("SearchParameter", "DeviceDefinition", "Questionnaire", "CodeSystem", "ValueSet")
+
+# Route of the resources sent to every endpoint.
+EVERY_ENDPOINT = -1
+
+# Errors of an endpoint that is down or misconfigured, fhirclient raising its own exceptions for 401, 403 and 404.
+ENDPOINT_ERRORS = (HTTPError, RequestException, FHIRNotFoundException, FHIRPermissionDeniedException,
+                   FHIRUnauthorizedException)
+
+
+def get_partition_urls(url, partitions):
+    """Returns the base URLs of the partitions of a HAPI server using URL based partitioning, e.g.
+    http://localhost:8080/fhir/P1."""
+    return [f"{url.rstrip('/')}/{partition}" for partition in partitions]
+
+
+def get_tag(resource: Resource, name):
+    if resource.meta is None or not resource.meta.tag:
+        return None
+
+    return next((tag.code for tag in resource.meta.tag if tag.system == TAG_SYSTEMS[name]), None)
+
+
+def get_references(value):
+    """Yields the "Type/id" references found in the json of a resource."""
+    if isinstance(value, dict):
+        if isinstance(value.get("reference"), str):
+            yield value["reference"]
+
+        for item in value.values():
+            yield from get_references(item)
+
+    elif isinstance(value, list):
+        for item in value:
+            yield from get_references(item)
+
+
+class RoutingConnector:
+    def __init__(self, urls, key="participant", health_interval=30., unhealthy_timeout=300., cache=None):
+        if key not in ("participant", "study"):
+            raise RuntimeError(f"Unknown routing key {key}, use participant or study")
+
+        self.urls = list(urls)
+        self.key = key
+        self.unhealthy_timeout = unhealthy_timeout
+        self.connectors = [FHIRConnector(url, cache=cache) for url in self.urls]
+        self.healthy = [True] * len(self.connectors)
+        self.__routes = {}
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__health_thread = None
+        if health_interval:
+            self.check_health()
+            self.__health_thread = threading.Thread(target=self.__check_health_periodically, args=(health_interval,),
+                                                    daemon=True)
+            self.__health_thread.start()
+
+    @property
+    def base_uri(self):
+        """Base of the canonical URLs (e.g. of Questionnaires), which must be the same on every endpoint."""
+        return self.connectors[0].base_uri
+
+    def close(self):
+        self.__stop.set()
+        if self.__health_thread is not None:
+            self.__health_thread.join()
+
+    def check_health(self):
+        """Checks that every endpoint answers its CapabilityStatement. Returns the health of each endpoint."""
+        for index, connector in enumerate(self.connectors):
+            try:
+                connector.get_json("metadata", "CapabilityStatement")
+                healthy = True
+            except ENDPOINT_ERRORS as e:
+                healthy = False
+                if self.healthy[index]:
+                    print(f"Endpoint {self.urls[index]} is down: {e}")
+
+            if healthy and not self.healthy[index]:
+                print(f"Endpoint {self.urls[index]} is back up")
+
+            self.healthy[index] = healthy
+            metrics.increment("endpoint_checks_total", endpoint=self.urls[index], healthy=healthy)
+
+        return list(self.healthy)
+
+    def __check_health_periodically(self, interval):
+        while not self.__stop.wait(interval):
+            self.check_health()
+
+    def __wait_healthy(self, index):
+        deadline = time.time() + self.unhealthy_timeout
+        while not self.healthy[index]:
+            if time.time() > deadline:
+                raise RuntimeError(f"Endpoint {self.urls[index]} is down")
+
+            time.sleep(1.)
+
+    def get_endpoint(self, study, participant=None):
+        """Returns the index of the endpoint of a participant (or of a study), by rendezvous hashing: the endpoint
+        whose hash with the key is the highest."""
+        key = study if self.key == "study" or participant is None else f"{study}/{participant}"
+        return max(range(len(self.urls)),
+                   key=lambda index: hashlib.sha1(f"{self.urls[index]}|{key}".encode("utf-8")).digest())
+
+    def route(self, resource: Resource):
+        """Returns the index of the endpoint of `resource`, or EVERY_ENDPOINT."""
+        if resource.resource_type in BROADCAST_RESOURCE_TYPES:
+            return EVERY_ENDPOINT
+
+        study = get_tag(resource, "study")
+        participant = get_tag(resource, "participant")
+        if study is not None and (participant is not None or self.key == "study"):
+            return self.get_endpoint(study, participant)
+
+        with self.__lock:
+            endpoints = {self.__routes.get(reference, EVERY_ENDPOINT)
+                         for reference in get_references(json.loads(resource.json()))} - {EVERY_ENDPOINT}
+
+        # Resources referencing several participants, e.g. the Group of a study, are on every endpoint.
+        return endpoints.pop() if len(endpoints) == 1 else EVERY_ENDPOINT
+
+    def __get_endpoints(self, resource: Resource):
+        endpoint = self.route(resource)
+        if endpoint == EVERY_ENDPOINT and not resource.id:
+            raise RuntimeError(f"{resource.resource_type} without id cannot be created on every endpoint")
+
+        return [endpoint] if endpoint != EVERY_ENDPOINT else list(range(len(self.connectors)))
+
+    def __record(self, resource: Resource, endpoints):
+        with self.__lock:
+            self.__routes[f"{resource.resource_type}/{resource.id}"] = \
+                endpoints[0] if len(endpoints) == 1 else EVERY_ENDPOINT
+
+    def create(self, resource: Resource):
+        endpoints = self.__get_endpoints(resource)
+        for endpoint in endpoints:
+            self.__wait_healthy(endpoint)
+            self.connectors[endpoint].create(resource)
+
+        self.__record(resource, endpoints)
+
+    def update(self, resource: Resource):
+        endpoints = self.__locate(resource.resource_type, resource.id)
+        if not endpoints:
+            raise RuntimeError(f"Cannot update {resource.resource_type}/{resource.id}, no endpoint holds it")
+
+        for endpoint in endpoints:
+            self.__wait_healthy(endpoint)
+            self.connectors[endpoint].update(resource)
+
+    def create_all(self, resources):
+        """Same as `FHIRConnector.create_all`, the resources of each endpoint being sent concurrently."""
+        routes = [(resource, self.__get_endpoints(resource)) for resource in resources]
+        batches = {}
+        for resource, endpoints in routes:
+            for endpoint in endpoints:
+                batches.setdefault(endpoint, []).append(resource)
+
+        def send(endpoint):
+            self.__wait_healthy(endpoint)
+            self.connectors[endpoint].create_all(batches[endpoint])
+
+        with ThreadPoolExecutor(max_workers=len(self.connectors)) as executor:
+            for future in [executor.submit(send, endpoint) for endpoint in batches]:
+                future.result()
+
+        for resource, endpoints in routes:
+            self.__record(resource, endpoints)
+
+    def __locate(self, resource_type, resource_id):
+        """Returns the endpoints holding a resource, from the routes of this run or by reading it on each one."""
+        with self.__lock:
+            endpoint = self.__routes.get(f"{resource_type}/{resource_id}")
+
+        if endpoint is not None:
+            return [endpoint] if endpoint != EVERY_ENDPOINT else list(range(len(self.connectors)))
+
+        endpoints = []
+        for index, connector in enumerate(self.connectors):
+            try:
+                connector.read(resource_type, resource_id, cached=False)
+                endpoints.append(index)
+            except FHIRNotFoundException:
+                continue
+
+        return endpoints
+
+    def read(self, resource_type, resource_id, cached=True):
+        endpoints = self.__locate(resource_type, resource_id)
+        if not endpoints:
+            raise FHIRNotFoundException(None)
+
+        return self.connectors[next((e for e in endpoints if self.healthy[e]), endpoints[0])].read(
+            resource_type, resource_id, cached)
+
+    def search_all(self, resource_type, params=None, cached=True):
+        """Yields the matches of every endpoint, once for resources stored on every endpoint."""
+        seen = set()
+        for connector in self.connectors:
+            for resource in connector.search_all(resource_type, params, cached):
+                if resource["id"] not in seen:
+                    seen.add(resource["id"])
+                    yield resource
+
+    def patch(self, resource_type, resource_id, operations, fhirpath=False):
+        for endpoint in self.__locate(resource_type, resource_id):
+            self.__wait_healthy(endpoint)
+            self.connectors[endpoint].patch(resource_type, resource_id, operations, fhirpath)
+
+    def append_references(self, resource_type, resource_id, element, references):
+        for endpoint in self.__locate(resource_type, resource_id):
+            self.__wait_healthy(endpoint)
+            self.connectors[endpoint].append_references(resource_type, resource_id, element, references)
+
+    def append_section_entries(self, resource_id, section_title, references, resource_type="EvidenceReport"):
+        for endpoint in self.__locate(resource_type, resource_id):
+            self.__wait_healthy(endpoint)
+            self.connectors[endpoint].append_section_entries(resource_id, section_title, references, resource_type)
@@ -0,0 +1,135 @@
+"""A small scheduler of tasks with dependencies.
+
+Tasks are functions added with the names of the tasks they depend on. `run` starts every task whose dependencies are
+done, so independent tasks (e.g. the downloads and loads of different datasets) run concurrently, at most
+`max_workers` at a time. Tasks can also be put in named pools with their own limit, e.g. to bound how many datasets
+are held in memory by concurrent loads.
+
+    scheduler = Scheduler(max_workers=4, limits={"load": 2})
+    scheduler.add("download WESAD", download, "WESAD")
+    scheduler.add("load WESAD", load, "WESAD", after=["download WESAD"], pool="load")
+    scheduler.run()
+"""
+
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from metrics import metrics
+
+
+class Task:
+    def __init__(self, name, function, args, kwargs, after, pool):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.after = list(after)
+        self.pool = pool
+
+
+class Scheduler:
+    def __init__(self, max_workers=4, limits=None):
+        self.max_workers = max_workers
+        self.limits = dict(limits or {})
+        self.tasks = {}
+        self.results = {}
+        self.__lock = threading.Lock()
+
+    def add(self, name, function, *args, after=(), pool=None, **kwargs):
+        """Adds the task `name` calling `function(*args, **kwargs)` once the tasks in `after` are done. Returns
+        `name`."""
+        if name in self.tasks:
+            raise RuntimeError(f"Task {name} already exists")
+
+        self.tasks[name] = Task(name, function, args, kwargs, after, pool)
+        return name
+
+    def result(self, name):
+        """Returns what the task `name` returned, for the tasks depending on it."""
+        with self.__lock:
+            return self.results[name]
+
+    def run(self):
+        """Runs every task. If a task fails the tasks depending on it are not started, the others run to the end, and
+        a RuntimeError naming the failed tasks is raised from the first failure. Returns the results by task name."""
+        self.__check()
+        pending = dict(self.tasks)
+        running = {}
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for task in self.__get_ready(pending, running, failed):
+                    del pending[task.name]
+                    running[executor.submit(self.__run_task, task)] = task
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    if future.exception() is not None:
+                        failed[task.name] = future.exception()
+                        print(f"Task {task.name} failed: {future.exception()!r}")
+
+        if failed or pending:
+            skipped = f", skipped {', '.join(pending)}" if pending else ""
+            raise RuntimeError(f"Failed {', '.join(failed)}{skipped}") from next(iter(failed.values()), None)
+
+        return self.results
+
+    def __run_task(self, task):
+        with metrics.timer("task_seconds", task=task.name):
+            result = task.function(*task.args, **task.kwargs)
+
+        with self.__lock:
+            self.results[task.name] = result
+
+    def __get_ready(self, pending, running, failed):
+        in_use = {}
+        for task in running.values():
+            in_use[task.pool] = in_use.get(task.pool, 0) + 1
+
+        ready = []
+        for task in list(pending.values()):
+            if any(name in failed for name in task.after):
+                # Nothing depending on a failed task can run, so it is failed too.
+                del pending[task.name]
+                failed[task.name] = RuntimeError(f"Dependency of {task.name} failed")
+                continue
+
+            if any(name in pending or name not in self.results for name in task.after):
+                continue
+
+            if task.pool in self.limits and in_use.get(task.pool, 0) >= self.limits[task.pool]:
+                continue
+
+            in_use[task.pool] = in_use.get(task.pool, 0) + 1
+            ready.append(task)
+
+        return ready
+
+    def __check(self):
+        for task in self.tasks.values():
+            unknown = [name for name in task.after if name not in self.tasks]
+            if unknown:
+                raise RuntimeError(f"Task {task.name} depends on unknown tasks {', '.join(unknown)}")
+
+        # Depth first search for cycles, which would leave tasks waiting forever.
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == "done":
+                return
+
+            if state.get(name) == "visiting":
+                raise RuntimeError(f"Cyclic task dependencies: {' -> '.join(path + [name])}")
+
+            state[name] = "visiting"
+            for dependency in self.tasks[name].after:
+                visit(dependency, path + [name])
+
+            state[name] = "done"
+
+        for name in self.tasks:
+            visit(name, [])
@@ -1,63 +1,87 @@
+import functools
+
 from fhir.resources.devicedefinition import DeviceDefinition
 from fhir.resources.fhirtypes import DeviceDefinitionHasPartType
 
 from connector import FHIRConnector
 from utils import get_list_of_references
 
-srad_recorder_ekg_definition = DeviceDefinition(
-    id="SradRecorderEKG",
-    **{
-        "deviceName": [{
-            "name": "Electrocardiogram",
-            "type": "user-friendly-name"
-        }],
-    }
+# Built on first use by `get_definitions`, in the order they have to be created.
+DEFINITIONS = (
+    "srad_recorder_ekg_definition",
+    "srad_recorder_emg_definition",
+    "srad_recorder_resp_definition",
+    "srad_recorder_sc_definition",
+    "srad_recorder_definition",
 )
 
-srad_recorder_emg_definition = DeviceDefinition(
-    id="SradRecorderEMG",
-    **{
-        "deviceName": [{
-            "name": "Electromyography",
-            "type": "user-friendly-name"
-        }],
-    }
-)
-srad_recorder_resp_definition = DeviceDefinition(
-    id="SradRecorderResp",
-    **{
-        "deviceName": [{
-            "name": "Respiration Sensor",
-            "type": "user-friendly-name"
-        }],
-    }
-)
-srad_recorder_sc_definition = DeviceDefinition(
-    id="SradRecorderGSR",
-    **{
-        "deviceName": [{
-            "name": "Skin conductivity",
-            "type": "user-friendly-name"
-        }],
-    }
-)
-srad_recorder_definition = DeviceDefinition(
-    id="SradRecorder",
 
-    modelNumber="Srad",
-    hasPart=[DeviceDefinitionHasPartType(reference=part) for part in get_list_of_references([
-        srad_recorder_ekg_definition,
-        srad_recorder_emg_definition,
-        srad_recorder_resp_definition,
-        srad_recorder_sc_definition,
-        srad_recorder_sc_definition])])
+@functools.lru_cache(maxsize=None)
+def get_definitions():
+    """Builds the DeviceDefinitions of the SRAD recorder once, returns them by name."""
+    srad_recorder_ekg_definition = DeviceDefinition(
+        id="SradRecorderEKG",
+        **{
+            "deviceName": [{
+                "name": "Electrocardiogram",
+                "type": "user-friendly-name"
+            }],
+        }
+    )
+
+    srad_recorder_emg_definition = DeviceDefinition(
+        id="SradRecorderEMG",
+        **{
+            "deviceName": [{
+                "name": "Electromyography",
+                "type": "user-friendly-name"
+            }],
+        }
+    )
+    srad_recorder_resp_definition = DeviceDefinition(
+        id="SradRecorderResp",
+        **{
+            "deviceName": [{
+                "name": "Respiration Sensor",
+                "type": "user-friendly-name"
+            }],
+        }
+    )
+    srad_recorder_sc_definition = DeviceDefinition(
+        id="SradRecorderGSR",
+        **{
+            "deviceName": [{
+                "name": "Skin conductivity",
+                "type": "user-friendly-name"
+            }],
+        }
+    )
+    srad_recorder_definition = DeviceDefinition(
+        id="SradRecorder",
+
+        modelNumber="Srad",
+        hasPart=[DeviceDefinitionHasPartType(reference=part) for part in get_list_of_references([
+            srad_recorder_ekg_definition,
+            srad_recorder_emg_definition,
+            srad_recorder_resp_definition,
+            srad_recorder_sc_definition,
+            srad_recorder_sc_definition])])
+
+    return {"srad_recorder_ekg_definition": srad_recorder_ekg_definition,
+            "srad_recorder_emg_definition": srad_recorder_emg_definition,
+            "srad_recorder_resp_definition": srad_recorder_resp_definition,
+            "srad_recorder_sc_definition": srad_recorder_sc_definition,
+            "srad_recorder_definition": srad_recorder_definition}
+
+
+def __getattr__(name):
+    """The definitions are module attributes built on first access (PEP 562)."""
+    if name in DEFINITIONS:
+        return get_definitions()[name]
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def create_srad_recorder_definitions(server: FHIRConnector):
-    for def_ in [srad_recorder_ekg_definition,
-                 srad_recorder_emg_definition,
-                 srad_recorder_resp_definition,
-                 srad_recorder_sc_definition,
-                 srad_recorder_definition
-                 ]:
+    for def_ in get_definitions().values():
         server.create(def_)
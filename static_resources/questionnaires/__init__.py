@@ -14,5 +14,5 @@ def get_link_id(questionnaire, item):
 
 
 def get_questionnaire_url(questionnaire, connector: FHIRConnector):
-    return connector.server.base_uri + f"Questionnaire/{questionnaire}"
+    return connector.base_uri + f"Questionnaire/{questionnaire}"
 
@@ -1,3 +1,5 @@
+import functools
+
 from connector import FHIRConnector
 
 from fhir.resources.coding import Coding
@@ -23,12 +25,23 @@ def generate_item(num,item):
     return q_item
 
 
-panas_questionnaire = Questionnaire(
-    id="PANAS",
-    status="active",
-    item=[generate_item(num, item) for num, item in enumerate(panas_items)],
-)
+@functools.lru_cache(maxsize=None)
+def get_questionnaire():
+    """Builds the PANAS Questionnaire once."""
+    return Questionnaire(
+        id="PANAS",
+        status="active",
+        item=[generate_item(num, item) for num, item in enumerate(panas_items)],
+    )
+
+
+def __getattr__(name):
+    """`panas_questionnaire` is built on first access (PEP 562)."""
+    if name == "panas_questionnaire":
+        return get_questionnaire()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def crate_panas_questionnaire(server: FHIRConnector):
-    server.create(panas_questionnaire)
+    server.create(get_questionnaire())
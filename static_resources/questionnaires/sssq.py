@@ -1,3 +1,5 @@
+import functools
+
 from connector import FHIRConnector
 
 from fhir.resources.coding import Coding
@@ -26,12 +28,23 @@ def generate_item(num, item):
     return q_item
 
 
-sssq_questionnaire = Questionnaire(
-    id="SSSQ",
-    status="active",
-    item=[generate_item(num, item) for num, item in enumerate(sssq_items)],
-)
+@functools.lru_cache(maxsize=None)
+def get_questionnaire():
+    """Builds the SSSQ Questionnaire once."""
+    return Questionnaire(
+        id="SSSQ",
+        status="active",
+        item=[generate_item(num, item) for num, item in enumerate(sssq_items)],
+    )
+
+
+def __getattr__(name):
+    """`sssq_questionnaire` is built on first access (PEP 562)."""
+    if name == "sssq_questionnaire":
+        return get_questionnaire()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def crate_sssq_questionnaire(server: FHIRConnector):
-    server.create(sssq_questionnaire)
+    server.create(get_questionnaire())
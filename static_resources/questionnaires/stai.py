@@ -1,3 +1,5 @@
+import functools
+
 from connector import FHIRConnector
 
 from fhir.resources.coding import Coding
@@ -21,12 +23,23 @@ def generate_item(num,item):
     return q_item
 
 
-stai_questionnaire = Questionnaire(
-    id="STAI",
-    status="active",
-    item=[generate_item(num, item) for num, item in enumerate(stai_items)],
-)
+@functools.lru_cache(maxsize=None)
+def get_questionnaire():
+    """Builds the STAI Questionnaire once."""
+    return Questionnaire(
+        id="STAI",
+        status="active",
+        item=[generate_item(num, item) for num, item in enumerate(stai_items)],
+    )
+
+
+def __getattr__(name):
+    """`stai_questionnaire` is built on first access (PEP 562)."""
+    if name == "stai_questionnaire":
+        return get_questionnaire()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def crate_stai_questionnaire(server: FHIRConnector):
-    server.create(stai_questionnaire)
\ No newline at end of file
+    server.create(get_questionnaire())
@@ -0,0 +1,78 @@
+"""Tags, categories and custom SearchParameters shared by the Observations and QuestionnaireResponses of every study.
+
+The loaders tag each resource with its study, participant, session, modality and label (`get_meta`), and the
+SearchParameters below expose those tags as indexed search parameters, e.g.
+`Observation?study=WESAD&label=stress&modality=bvp&category=signal`."""
+
+import functools
+
+from fhir.resources.searchparameter import SearchParameter
+
+from connector import FHIRConnector
+
+CODEX_URL = "https://github.com/llopera/CODEXplus/fhir"
+
+TAG_SYSTEMS = {
+    "study": f"{CODEX_URL}/CodeSystem/study",
+    "participant": f"{CODEX_URL}/CodeSystem/participant",
+    "session": f"{CODEX_URL}/CodeSystem/session",
+    "modality": f"{CODEX_URL}/CodeSystem/modality",
+    "label": f"{CODEX_URL}/CodeSystem/label",
+}
+
+# Observation.category: signal, signal-chunk, feature, segment, session, label or event.
+CATEGORY_SYSTEM = f"{CODEX_URL}/CodeSystem/observation-category"
+
+# Observation.component.code, e.g. the "sample range" of a signal chunk.
+COMPONENT_SYSTEM = f"{CODEX_URL}/CodeSystem/observation-component"
+
+TAGGED_RESOURCES = ["Observation", "QuestionnaireResponse"]
+
+
+def get_tags(**values):
+    """Returns the meta.tag codings of the given study, participant, session, modality and label, skipping None."""
+    return [{"system": TAG_SYSTEMS[name], "code": str(value)} for name, value in values.items() if value is not None]
+
+
+def get_meta(**values):
+    return {"tag": get_tags(**values)}
+
+
+def get_category(code):
+    return [{"coding": [{"system": CATEGORY_SYSTEM, "code": code}]}]
+
+
+def get_component_code(code):
+    return {"coding": [{"system": COMPONENT_SYSTEM, "code": code}]}
+
+
+def generate_search_parameter(name, system):
+    return SearchParameter(
+        id=f"codex-{name}",
+        url=f"{CODEX_URL}/SearchParameter/codex-{name}",
+        name=f"codex-{name}",
+        status="active",
+        description=f"Search by the {name} tag of CODEX+ resources",
+        code=name,
+        base=TAGGED_RESOURCES,
+        type="token",
+        expression=" | ".join(f"{resource}.meta.tag.where(system='{system}')" for resource in TAGGED_RESOURCES),
+        processingMode="normal")
+
+
+@functools.lru_cache(maxsize=None)
+def get_search_parameters():
+    return [generate_search_parameter(name, system) for name, system in TAG_SYSTEMS.items()]
+
+
+def __getattr__(name):
+    """`codex_search_parameters` is built on first access (PEP 562)."""
+    if name == "codex_search_parameters":
+        return get_search_parameters()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def create_codex_search_parameters(server: FHIRConnector):
+    for search_parameter in get_search_parameters():
+        server.create(search_parameter)
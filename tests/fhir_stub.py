@@ -0,0 +1,154 @@
+"""In-memory FHIR server for the tests of the connectors, serving the requests `FHIRConnector` sends: reads with ETags,
+writes, batch Bundles, PATCH and searches by `_id` and `_lastUpdated`, paged with `_count` and `_offset`."""
+
+import hashlib
+import itertools
+import json
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+
+class FHIRStub:
+    def __init__(self):
+        self.resources = {}
+        # (method, path, body) of every request but the reads of the CapabilityStatement.
+        self.requests = []
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0), self.__get_handler())
+        self.url = f"http://127.0.0.1:{self.__server.server_address[1]}/fhir"
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def store(self, resource):
+        last_updated = datetime.now(timezone.utc).isoformat()
+        resource = dict(resource, meta=dict(resource.get("meta", {}), lastUpdated=last_updated))
+        with self.__lock:
+            if not resource.get("id"):
+                resource["id"] = str(next(self.__ids))
+
+            self.resources[(resource["resourceType"], resource["id"])] = resource
+
+        return resource
+
+    def count(self, method):
+        return sum(request[0] == method for request in self.requests)
+
+    def search(self, resource_type, query):
+        with self.__lock:
+            matches = [resource for (stored_type, _), resource in self.resources.items()
+                       if stored_type == resource_type]
+
+        if "_id" in query:
+            ids = set(query["_id"][0].split(","))
+            matches = [resource for resource in matches if resource["id"] in ids]
+
+        if "_lastUpdated" in query:
+            since = query["_lastUpdated"][0].removeprefix("gt")
+            matches = [resource for resource in matches if resource["meta"]["lastUpdated"] > since]
+
+        return matches
+
+    def __get_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path, query = self.__parse()
+                if path == ["metadata"]:
+                    return self.__send(200, {"resourceType": "CapabilityStatement"})
+
+                stub.requests.append(("GET", self.path, None))
+                if len(path) == 2:
+                    return self.__read(*path)
+
+                matches = stub.search(path[0], query)
+                if query.get("_summary") == ["count"]:
+                    return self.__send(200, {"resourceType": "Bundle", "type": "searchset", "total": len(matches)})
+
+                count = int(query.get("_count", ["50"])[0])
+                offset = int(query.get("_offset", ["0"])[0])
+                bundle = {"resourceType": "Bundle", "type": "searchset", "total": len(matches),
+                          "meta": {"lastUpdated": datetime.now(timezone.utc).isoformat()},
+                          "entry": [{"resource": resource, "search": {"mode": "match"}}
+                                    for resource in matches[offset:offset + count]],
+                          "link": []}
+                if offset + count < len(matches):
+                    next_query = dict({name: values[0] for name, values in query.items()}, _offset=offset + count)
+                    bundle["link"].append({"relation": "next", "url": f"{stub.url}/{path[0]}?{urlencode(next_query)}"})
+
+                self.__send(200, bundle)
+
+            def do_PUT(self):
+                body = self.__read_body()
+                stub.requests.append(("PUT", self.path, body))
+                self.__send(201, stub.store(body))
+
+            def do_POST(self):
+                path, _ = self.__parse()
+                body = self.__read_body()
+                stub.requests.append(("POST", self.path, body))
+                if path:
+                    return self.__send(201, stub.store(body))
+
+                entries = []
+                for entry in body.get("entry", []):
+                    resource = stub.store(entry["resource"])
+                    entries.append({"response": {"status": "201 Created",
+                                                 "location": f"{resource['resourceType']}/{resource['id']}"}})
+
+                self.__send(200, {"resourceType": "Bundle", "type": "batch-response", "entry": entries})
+
+            def do_PATCH(self):
+                # Patches are recorded, not applied.
+                stub.requests.append(("PATCH", self.path, self.__read_body()))
+                self.__send(200, {"resourceType": "OperationOutcome"})
+
+            def __read(self, resource_type, resource_id):
+                resource = stub.resources.get((resource_type, resource_id))
+                if resource is None:
+                    return self.__send(404, {"resourceType": "OperationOutcome"})
+
+                etag = f'W/"{hashlib.sha1(json.dumps(resource, sort_keys=True).encode()).hexdigest()[:8]}"'
+                if self.headers.get("If-None-Match") == etag:
+                    return self.__send(304, None, {"ETag": etag})
+
+                self.__send(200, resource, {"ETag": etag})
+
+            def __parse(self):
+                url = urlparse(self.path)
+                # The first part of the path is the "fhir" base.
+                return [part for part in url.path.split("/") if part][1:], parse_qs(url.query)
+
+            def __read_body(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return json.loads(self.rfile.read(length)) if length else None
+
+            def __send(self, status, body, headers=None):
+                data = json.dumps(body).encode("utf-8") if body is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/fhir+json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
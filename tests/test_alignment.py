@@ -0,0 +1,46 @@
+"""Alignment of signals onto a time grid, see `loaders.alignment`."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from loaders.alignment import align, get_positions
+
+TIMES = [0, 10, 20, 30]
+GRID = [-5, 0, 4, 5, 6, 25, 35]
+
+
+@pytest.mark.parametrize("method, tolerance, expected", [
+    ("exact", None, [-1, 0, -1, -1, -1, -1, -1]),
+    ("backward", None, [-1, 0, 0, 0, 0, 2, 3]),
+    ("backward", 4, [-1, 0, 0, -1, -1, -1, -1]),
+    # Ties go to the earlier sample.
+    ("nearest", None, [0, 0, 0, 0, 1, 2, 3]),
+    ("nearest", 4, [-1, 0, 0, -1, 1, -1, -1]),
+])
+def test_positions_of_the_matching_samples(method, tolerance, expected):
+    assert get_positions(TIMES, GRID, method, tolerance).tolist() == expected
+
+
+def test_positions_without_samples_or_with_an_unknown_method():
+    assert get_positions([], GRID, "nearest").tolist() == [-1] * len(GRID)
+    with pytest.raises(RuntimeError, match="Unknown alignment method"):
+        get_positions(TIMES, GRID, "forward")
+
+
+def get_frame(name, frequency, seconds):
+    index = pd.date_range("2020-01-01", periods=int(seconds * frequency), freq=pd.Timedelta(seconds=1 / frequency),
+                          tz="US/Central")
+    return pd.DataFrame({name: np.arange(len(index), dtype=float)}, index=index)
+
+
+def test_align_matches_the_union_of_the_frames():
+    frames = {"EDA": get_frame("EDA", 4, 20), "HR": get_frame("HR", 1, 15), "TEMP": get_frame("TEMP", 4, 10)}
+    grid = frames["HR"].index
+    expected = pd.concat(frames, axis=1).reindex(grid)
+    pd.testing.assert_frame_equal(align(frames, grid), expected)
+
+    frames["TEMP"] = frames["TEMP"].iloc[:0]
+    aligned = align(frames, grid, ["TEMP", "HR"], method="backward")
+    assert aligned.columns.tolist() == [("TEMP", "TEMP"), ("HR", "HR")]
+    assert aligned["TEMP"].isnull().all().all() and aligned[("HR", "HR")].tolist() == list(range(15))
@@ -0,0 +1,71 @@
+"""Caches of `cache`, and the read-through cache of `FHIRConnector`."""
+
+import multiprocessing
+import os
+
+import cache
+from cache import DiskCache, ResponseCache
+from connector import FHIRConnector
+from fhir_stub import FHIRStub
+
+
+def get_size(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if not entry.name.endswith(".part"))
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    disk = DiskCache(str(tmp_path), 1000)
+    for index in range(10):
+        disk.put(f"key-{index}", bytes(100))
+
+    assert disk.get("key-0") is not None
+    disk.put("key-10", bytes(100))
+    assert disk.get("key-0") is not None and disk.get("key-1") is None
+    assert get_size(str(tmp_path)) == disk.nbytes <= 1000
+
+
+def test_disk_cache_does_not_scan_on_every_write(tmp_path, monkeypatch):
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(cache.os, "scandir", lambda path: scans.append(path) or scandir(path))
+    disk = DiskCache(str(tmp_path), 10_000)
+    for index in range(1000):
+        disk.put(f"key-{index}", bytes(100))
+
+    # A scan when the cache is created, then one each time 10% of the cache was written.
+    assert len(scans) <= 1 + 1000 // 10
+    assert get_size(str(tmp_path)) <= 10_000
+
+
+def fill(directory, prefix):
+    disk = DiskCache(directory, 10_000)
+    for index in range(300):
+        disk.put(f"{prefix}-{index}", bytes(100))
+
+
+def test_disk_cache_shared_by_processes(tmp_path):
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=fill, args=(str(tmp_path), prefix)) for prefix in "ab"]
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join(timeout=60)
+
+    assert [process.exitcode for process in processes] == [0, 0]
+    assert get_size(str(tmp_path)) <= 10_000
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+
+
+def test_response_cache_is_keyed_by_url():
+    # Fresh entries are served without asking the server, from the entry of the server that sent them.
+    shared = ResponseCache(max_age=60)
+    with FHIRStub() as first, FHIRStub() as second:
+        first.store({"resourceType": "Patient", "id": "P1", "gender": "female"})
+        second.store({"resourceType": "Patient", "id": "P1", "gender": "male"})
+        connectors = [FHIRConnector(first.url, cache=shared), FHIRConnector(second.url, cache=shared)]
+
+        for _ in range(2):
+            assert [connector.read("Patient", "P1")["gender"] for connector in connectors] == ["female", "male"]
+
+        assert first.count("GET") == second.count("GET") == 1
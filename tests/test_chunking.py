@@ -0,0 +1,30 @@
+"""Chunk boundaries of `loaders.chunking.ChunkPolicy`."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from loaders.chunking import ChunkPolicy, sample_nbytes
+
+
+@pytest.mark.parametrize("n_samples", [0, 1, 99, 100, 101, 250, 1000])
+def test_chunks_cover_the_samples_once(n_samples):
+    chunks = ChunkPolicy(max_seconds=25).split(n_samples, frequency=4)
+    # Consecutive chunks of 100 samples, the last one holding the rest.
+    assert [start for start, _ in chunks] == list(range(0, max(n_samples, 1), 100))
+    assert [stop for _, stop in chunks] == [start + 100 for start, _ in chunks[:-1]] + [n_samples]
+
+
+def test_the_tightest_limit_applies():
+    policy = ChunkPolicy(max_seconds=10, max_bytes=800)
+    assert policy.chunk_samples(frequency=64, sample_nbytes=16) == 50
+    assert policy.chunk_samples(frequency=1, sample_nbytes=16) == 10
+    assert policy.chunk_samples(sample_nbytes=16) == 50
+    assert policy.chunk_samples(frequency=64, sample_nbytes=10_000) == 1
+    assert ChunkPolicy().split(10 ** 6, frequency=700) == [(0, 10 ** 6)]
+
+
+def test_sample_size_includes_the_index():
+    frame = pd.DataFrame({"x": np.zeros(10), "y": np.zeros(10)}, index=pd.date_range("2020", periods=10, freq="s"))
+    assert sample_nbytes(frame) == 24
+    assert sample_nbytes(np.zeros((10, 3), dtype=np.float32)) == 12 and sample_nbytes([]) == 1
@@ -0,0 +1,59 @@
+"""Assembly of the exported signals of a participant, see `export.StudyExporter.assemble`."""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from export import StudyExporter, get_times, save_array
+
+
+def write_signal(source_dir, name, data, start=None, frequency=1):
+    os.makedirs(source_dir, exist_ok=True)
+    save_array(os.path.join(source_dir, f"{name}.npy"), np.asarray(data))
+    if start is not None:
+        times = pd.date_range(start, periods=len(data), freq=pd.Timedelta(seconds=1 / frequency), tz="UTC")
+        save_array(os.path.join(source_dir, f"{name}.time.npy"), times.asi8.astype("datetime64[ns]"))
+
+
+def test_sources_are_assembled_in_time_order(tmp_path):
+    participant_dir = str(tmp_path / "P1")
+    e4_dir = os.path.join(participant_dir, "eda", "E4-eda-dm")
+    # Ids in the opposite order of the times, the times decide.
+    write_signal(e4_dir, "a-late", [4., 5.], start="2020-01-01 00:00:02")
+    write_signal(e4_dir, "b-early", [1., 2., 3.], start="2020-01-01 00:00:00", frequency=1.5)
+    chest_dir = os.path.join(participant_dir, "eda", "RespiBAN-eda-dm")
+    write_signal(chest_dir, "segment-01", [30.])
+    write_signal(chest_dir, "segment-00", [10., 20.])
+
+    StudyExporter.assemble(participant_dir)
+
+    assert np.load(f"{e4_dir}.npy").tolist() == [1., 2., 3., 4., 5.]
+    times = np.load(f"{e4_dir}.time.npy")
+    assert len(times) == 5 and np.all(np.diff(times.astype(np.int64)) > 0)
+    assert np.load(f"{chest_dir}.npy").tolist() == [10., 20., 30.]
+    assert not os.path.exists(f"{chest_dir}.time.npy")
+    assert StudyExporter.get_exported_ids(participant_dir) == {"a-late", "b-early", "segment-00", "segment-01"}
+
+
+def test_sources_are_assembled_again_when_a_signal_is_added(tmp_path):
+    participant_dir = str(tmp_path / "P1")
+    source_dir = os.path.join(participant_dir, "hr", "derived")
+    write_signal(source_dir, "segment-00", [1.])
+    StudyExporter.assemble(participant_dir)
+    os.utime(f"{source_dir}.npy", (0, 0))
+    write_signal(source_dir, "segment-01", [2.])
+
+    StudyExporter.assemble(participant_dir)
+
+    assert np.load(f"{source_dir}.npy").tolist() == [1., 2.]
+
+
+def test_times_are_spread_over_the_effective_period():
+    observation = {"effectivePeriod": {"start": "2020-01-01T00:00:00+00:00", "end": "2020-01-01T00:00:01+00:00"}}
+    times = get_times(observation, np.zeros(5))
+    assert np.diff(times.astype(np.int64)).tolist() == [250_000_000] * 4
+    assert get_times({}, np.zeros(5)) is None
+
+    index = pd.date_range("2020-01-01", periods=3, freq="250ms", tz="US/Central")
+    assert get_times({}, pd.Series([1, 2, 3], index=index)).astype(np.int64).tolist() == index.asi8.tolist()
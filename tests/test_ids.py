@@ -0,0 +1,27 @@
+"""Deterministic resource ids of `loaders.ids`."""
+
+import pytest
+
+from loaders.ids import FHIR_ID_MAX_LENGTH, IdAllocator
+
+
+def test_ids_are_built_from_the_coordinates():
+    ids = IdAllocator("SDN")
+    assert ids.get("SDN-5C", "segment 12", "EDA", chunk=3) == "SDN-5C-segment-12-EDA-c0003"
+    assert ids.get("SDN-5C", "segment 12", "EDA", chunk=3) == "SDN-5C-segment-12-EDA-c0003"
+    assert ids.get("S2", None, "", "BVP") == "SDN-S2-BVP"
+
+
+def test_long_ids_are_truncated_with_a_digest():
+    ids = IdAllocator("WESAD")
+    first = ids.get("S2", "x" * 100, "EDA")
+    second = ids.get("S2", "x" * 100, "TEMP")
+    assert len(first) == len(second) == FHIR_ID_MAX_LENGTH
+    assert first != second and first[:40] == second[:40]
+
+
+def test_colliding_coordinates_fail():
+    ids = IdAllocator("SRAD")
+    ids.get("drive01", "foot EDA")
+    with pytest.raises(RuntimeError, match="allocated to both"):
+        ids.get("drive01", "foot/EDA")
@@ -0,0 +1,101 @@
+"""Distributed loads through `jobqueue`, with workers in separate processes. Run from the repository root with
+`python -m pytest tests`."""
+
+import multiprocessing
+import os
+from collections import namedtuple
+from functools import partial
+
+import pytest
+
+from jobqueue import JobQueue, coordinate, work
+
+Participant = namedtuple("Participant", ["id"])
+
+STUDY = "TEST"
+LEASE_SECONDS = 1
+
+
+class FakeLoader:
+    """Loads participants named "crash-..." by killing its worker the first time (or every time with `crash_always`),
+    as a worker dying in the middle of a participant would."""
+
+    def __init__(self, directory, participants=(), crash_always=False):
+        self.directory = directory
+        self.participants = participants
+        self.crash_always = crash_always
+        self.results = {}
+        self.reported = False
+
+    def setup(self, upload=True):
+        pass
+
+    def get_selected_patients(self):
+        return [Participant(participant) for participant in self.participants]
+
+    def load_participant(self, participant_id):
+        marker = os.path.join(self.directory, participant_id)
+        if participant_id.startswith("crash") and (self.crash_always or not os.path.exists(marker)):
+            open(marker, "w").close()
+            os._exit(1)
+
+        return {"participant": participant_id, "worker": os.getpid()}
+
+    def add_participant_results(self, participant_id, results):
+        self.results[participant_id] = results
+
+    def load_results(self):
+        self.reported = True
+
+
+def run_worker(path, directory, crash_always=False):
+    queue = JobQueue(path, lease_seconds=LEASE_SECONDS)
+    try:
+        work(queue, partial(FakeLoader, directory, crash_always=crash_always), idle_timeout=5, poll_interval=0.1)
+    finally:
+        queue.close()
+
+
+def start_workers(path, directory, count, crash_always=False):
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(path, directory, crash_always)) for _ in range(count)]
+    for worker in workers:
+        worker.start()
+
+    return workers
+
+
+def test_expired_jobs_are_loaded_by_other_workers(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    participants = [f"P{number}" for number in range(8)] + ["crash-1", "crash-2"]
+    loader = FakeLoader(str(tmp_path), participants)
+    queue = JobQueue(path, lease_seconds=LEASE_SECONDS)
+    workers = start_workers(path, str(tmp_path), 3)
+    try:
+        coordinate(queue, STUDY, loader, poll_interval=0.1)
+    finally:
+        for worker in workers:
+            worker.join(timeout=30)
+
+        queue.close()
+
+    assert loader.reported
+    assert sorted(loader.results) == sorted(participants)
+    assert [worker.exitcode for worker in workers].count(1) == 2
+
+
+def test_coordinator_fails_expired_jobs_without_workers(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    loader = FakeLoader(str(tmp_path), ["crash-1"])
+    queue = JobQueue(path, lease_seconds=LEASE_SECONDS, max_attempts=1)
+    workers = start_workers(path, str(tmp_path), 1, crash_always=True)
+    try:
+        with pytest.raises(RuntimeError, match="Lease expired"):
+            coordinate(queue, STUDY, loader, poll_interval=0.1)
+    finally:
+        for worker in workers:
+            worker.join(timeout=30)
+
+        queue.close()
+
+    assert not loader.reported
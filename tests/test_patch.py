@@ -0,0 +1,64 @@
+"""FHIRPath Patch helpers of `connector`, against the in-memory server of `fhir_stub`."""
+
+from fhir.resources.observation import Observation
+
+from connector import FHIRConnector, PatchBatch, get_section_path
+from fhir_stub import FHIRStub
+from loaders.linking import LinkGraph
+
+
+def get_operations(request):
+    """Returns the (path, name, reference) of the `add` operations of a PATCH request."""
+    operations = []
+    for parameter in request[2]["parameter"]:
+        parts = {part["name"]: part for part in parameter["part"]}
+        operations.append((parts["path"]["valueString"], parts["name"]["valueString"],
+                           parts["value"]["valueReference"]["reference"]))
+
+    return operations
+
+
+def get_observation(observation_id):
+    return Observation(id=observation_id, status="final", code={"text": "test"})
+
+
+def test_batch_sends_one_patch_per_target():
+    with FHIRStub() as stub:
+        server = FHIRConnector(stub.url)
+        batch = PatchBatch()
+        for index in range(3):
+            batch.append_reference("Observation/session", "hasMember", {"reference": f"Observation/member-{index}"})
+            batch.append_reference("Observation/segment", "derivedFrom", {"reference": f"Observation/base-{index}"})
+
+        batch.append_section_entry("report", "Stress", {"reference": "Observation/session"})
+        assert len(batch) == 3
+
+        batch.flush(server)
+        patches = {request[1].split("/fhir/")[1]: get_operations(request)
+                   for request in stub.requests if request[0] == "PATCH"}
+
+    assert len(batch) == 0
+    assert sorted(patches) == ["EvidenceReport/report", "Observation/segment", "Observation/session"]
+    assert patches["Observation/session"] == [("Observation", "hasMember", f"Observation/member-{index}")
+                                              for index in range(3)]
+    assert patches["Observation/segment"] == [("Observation", "derivedFrom", f"Observation/base-{index}")
+                                              for index in range(3)]
+    assert patches["EvidenceReport/report"] == [("EvidenceReport.section.where(title='Stress')", "entryReference",
+                                                 "Observation/session")]
+
+
+def test_link_graph_patches_stored_containers():
+    with FHIRStub() as stub:
+        graph = LinkGraph()
+        session = get_observation("session")
+        for index in range(4):
+            graph.add(session, get_observation(f"member-{index}"))
+
+        graph.patch(FHIRConnector(stub.url))
+        assert stub.count("PATCH") == 1
+        assert stub.count("PUT") == stub.count("POST") == 0
+
+
+def test_section_titles_are_escaped():
+    assert get_section_path("EvidenceReport", "Participant's \\ results") == \
+           "EvidenceReport.section.where(title='Participant\\'s \\\\ results')"
@@ -0,0 +1,52 @@
+"""`RoutingConnector` over several in-memory servers, see `fhir_stub`."""
+
+import pytest
+from fhir.resources.patient import Patient
+
+from cache import ResponseCache
+from fhir_stub import FHIRStub
+from routing import RoutingConnector
+
+
+def get_observation(observation_id, value):
+    return {"resourceType": "Observation", "id": observation_id, "status": "final", "code": {"text": value}}
+
+
+@pytest.mark.parametrize("max_age", [0, 60])
+def test_search_all_returns_the_matches_of_every_endpoint(max_age):
+    with FHIRStub() as first, FHIRStub() as second:
+        first.store(get_observation("a", "first"))
+        first.store(get_observation("shared", "everywhere"))
+        second.store(get_observation("b", "second"))
+        second.store(get_observation("shared", "everywhere"))
+        # The endpoints share a cache, as with `app.init_fhir_server`.
+        routing = RoutingConnector([first.url, second.url], health_interval=0, cache=ResponseCache(max_age=max_age))
+        try:
+            for _ in range(2):
+                matches = routing.search_all("Observation", {"_id": "a,b,shared"})
+                assert sorted(match["id"] for match in matches) == ["a", "b", "shared"]
+
+        finally:
+            routing.close()
+
+
+def test_unreachable_or_unknown_endpoints_are_unhealthy():
+    with FHIRStub() as stub:
+        # The stub answers 404 to the CapabilityStatement of a partition it does not serve.
+        routing = RoutingConnector([stub.url, f"{stub.url}/P9", "http://127.0.0.1:9/fhir"], health_interval=0)
+        try:
+            assert routing.check_health() == [True, False, False]
+        finally:
+            routing.close()
+
+
+def test_update_of_a_resource_stored_nowhere_fails():
+    with FHIRStub() as first, FHIRStub() as second:
+        routing = RoutingConnector([first.url, second.url], health_interval=0)
+        try:
+            with pytest.raises(RuntimeError, match="no endpoint holds it"):
+                routing.update(Patient(id="P1"))
+        finally:
+            routing.close()
+
+        assert first.count("POST") == second.count("POST") == 0
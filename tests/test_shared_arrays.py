@@ -0,0 +1,23 @@
+"""Shared memory hand-off of `loaders.shared_arrays`, as used by the features stage of `loaders.load_sdn`."""
+
+import numpy as np
+import pandas as pd
+
+from loaders import shared_arrays
+from loaders.load_sdn import compute_features, get_shared_features
+from loaders.shared_arrays import SharedArrayPool
+
+
+def get_frame(name, frequency, size):
+    index = pd.date_range("2020-01-01", periods=size, freq=pd.Timedelta(seconds=1 / frequency), tz="US/Central")
+    return pd.DataFrame({name: np.random.default_rng(size).random(size)}, index=index)
+
+
+def test_features_stage_detaches_the_blocks_it_attached():
+    sensor_data = {"EDA": get_frame("EDA", 4, 800), "TEMP": get_frame("TEMP", 4, 800), "HR": get_frame("HR", 1, 200)}
+    with SharedArrayPool() as pool:
+        shared_data = {name: pool.put_frame(frame) for name, frame in sensor_data.items()}
+        features = get_shared_features(shared_data)
+
+        assert shared_arrays._attached == {}
+        pd.testing.assert_frame_equal(features, compute_features(sensor_data))
@@ -0,0 +1,82 @@
+"""Adaptive concurrency and batch size of the uploads, see `throttle.UploadController`."""
+
+import time
+
+import pytest
+
+from throttle import UploadController, get_retry_after
+
+
+def send(controller, **outcome):
+    controller.acquire()
+    controller.release(**outcome)
+
+
+def test_additive_increase_up_to_the_limits():
+    controller = UploadController(initial_limit=4, max_limit=5, bundle_size=20, max_bundle_size=22)
+    send(controller, latency=0.1, entries=20)
+    assert (controller.limit, controller.bundle_size) == (4.25, 21)
+    for _ in range(3):
+        send(controller, latency=0.1, entries=20)
+
+    assert 4.9 < controller.limit < 5 and controller.bundle_size == 22
+    for _ in range(20):
+        send(controller, latency=0.1, entries=20)
+
+    assert controller.limit == 5 and controller.in_flight == 0
+
+
+def test_failures_halve_once_per_round_trip():
+    controller = UploadController(initial_limit=8, bundle_size=40)
+    send(controller, latency=10., failed=True)
+    send(controller, latency=10., failed=True)
+    assert (controller.limit, controller.get_bundle_size()) == (4, 20)
+
+    # Close to the values at which the server was overloaded, they grow ten times slower.
+    controller = UploadController(initial_limit=2, min_limit=2, bundle_size=20)
+    send(controller, failed=True)
+    assert (controller.limit, controller.get_bundle_size()) == (2, 10)
+    for _ in range(10):
+        send(controller, latency=0.1, entries=10)
+
+    assert controller.bundle_size == pytest.approx(17 + 3 * 0.1)
+
+
+def test_rising_latency_halves():
+    controller = UploadController(initial_limit=8, bundle_size=40, max_limit=8, max_bundle_size=40)
+    for _ in range(10):
+        send(controller, latency=0.1, entries=40)
+
+    send(controller, latency=40., entries=40)
+    assert (controller.limit, controller.get_bundle_size()) == (4, 20)
+
+
+def test_rejected_requests_change_nothing():
+    controller = UploadController(initial_limit=4, bundle_size=20)
+    send(controller, latency=10., failed=True, rejected=True)
+    assert (controller.limit, controller.bundle_size, controller.in_flight) == (4, 20, 0)
+
+
+def test_retry_after_pauses_and_keeps_the_bundle_size():
+    controller = UploadController(initial_limit=4, bundle_size=20)
+    send(controller, latency=0.01, failed=True, retry_after=0.2)
+    assert (controller.limit, controller.get_bundle_size()) == (2, 20)
+    assert controller.paused_until > time.time()
+
+    start = time.time()
+    controller.acquire()
+    assert time.time() - start >= 0.15
+    controller.release(rejected=True)
+
+
+class Response:
+    def __init__(self, retry_after):
+        self.headers = {"Retry-After": retry_after} if retry_after is not None else {}
+
+
+def test_retry_after_and_backoff_delays():
+    assert get_retry_after(Response("120")) == 120.
+    assert get_retry_after(Response("Thu, 01 Jan 1970 00:00:00 GMT")) == 0.
+    assert get_retry_after(Response("soon")) is None
+    assert get_retry_after(Response(None)) is None and get_retry_after(None) is None
+    assert [UploadController().get_backoff(attempt) for attempt in (0, 1, 2, 10)] == [0.5, 1., 2., 30.]
@@ -0,0 +1,50 @@
+"""Run-length encoded label timelines of `loaders.timeline`."""
+
+import numpy as np
+import pytest
+
+from loaders.timeline import LabelTimeline
+
+
+def test_runs_of_a_label_per_sample():
+    timeline = LabelTimeline.from_samples([0, 0, 1, 1, 1, 0, 2], frequency=700, start=10)
+    assert list(timeline) == [(10, 12, 0), (12, 15, 1), (15, 16, 0), (16, 17, 2)]
+    assert timeline.find([9, 10, 14, 15, 16, 17]).tolist() == [-1, 0, 1, 2, 3, -1]
+    assert timeline.get_value(13) == 1 and timeline.get_value(100, default="none") == "none"
+    assert timeline.get_period(1) == (12 / 700, 15 / 700)
+    assert len(LabelTimeline.from_samples([])) == 0 and LabelTimeline([], [], []).find([0]).tolist() == [-1]
+
+
+def test_later_periods_take_precedence():
+    timeline = LabelTimeline.from_periods([(0, 50, "base"), (20, 30, "stress"), (40, 80, "amusement")], 10, 60,
+                                          default="transient")
+    assert list(timeline) == [(10, 20, "base"), (20, 30, "stress"), (30, 40, "base"), (40, 60, "amusement")]
+
+    # Neighbouring runs of the same value are merged, gaps take the default.
+    timeline = LabelTimeline.from_periods([(0, 5, "a"), (5, 10, "a"), (15, 20, "b")], 0, 25)
+    assert list(timeline) == [(0, 10, "a"), (10, 15, None), (15, 20, "b"), (20, 25, None)]
+
+
+@pytest.mark.parametrize("frequency", [1, 4, 32, 64, 700, 3.3])
+@pytest.mark.parametrize("origin", [0, 7, -3])
+def test_sample_ranges_match_the_samples_of_each_run(frequency, origin):
+    labels = np.repeat([0, 1, 2, 1, 0, 3], [333, 701, 1, 1399, 64, 2000])
+    timeline = LabelTimeline.from_samples(labels, frequency=700, start=5)
+    ticks_per_sample = 700 / frequency
+    samples = np.arange(int(len(labels) / ticks_per_sample) + 10)
+    length = len(samples) - 5
+    # A sample falls in the tick it starts in, or with `nearest` is resampled onto the nearest tick as np.round does.
+    falls_in = timeline.find(np.floor(origin + samples * ticks_per_sample + 1e-9))
+    nearest = timeline.find(origin + np.round(samples * ticks_per_sample))
+    for run in range(len(timeline)):
+        for runs, is_nearest in ((falls_in, False), (nearest, True)):
+            expected = np.flatnonzero(runs[:length] == run)
+            first, stop = timeline.get_sample_range(run, frequency, origin=origin, length=length, nearest=is_nearest)
+            assert list(range(first, stop)) == expected.tolist()
+
+
+def test_sample_ranges_are_clipped_to_the_signal():
+    timeline = LabelTimeline([0, 100], [100, 200], ["a", "b"], frequency=10)
+    assert timeline.get_sample_range(0, 1, origin=50) == (0, 5)
+    assert timeline.get_sample_range(1, 1, length=12) == (10, 12)
+    assert timeline.get_sample_range(1, 1, length=5) == (5, 5)
@@ -0,0 +1,133 @@
+"""Adaptive concurrency and batch size of the uploads to the FHIR server.
+
+`UploadController` keeps the number of requests in flight and the number of resources per batch Bundle near what
+the server can take, with additive increase and multiplicative decrease (AIMD, as TCP congestion control): both grow
+slowly while requests succeed quickly, and are halved when the server shows signs of overload, i.e. HTTP 429 and 5xx
+responses, connection errors, or a latency per resource rising well above its long term average. Close to the limit
+at which the server was last overloaded, they grow ten times slower. A `Retry-After` header pauses every upload until
+the time given by the server and only decreases the concurrency, the server limiting the rate of requests rather than
+their size."""
+
+import email.utils
+import threading
+import time
+
+from metrics import metrics
+
+# Statuses of overloaded servers, the request can be sent again as it is. Conflicts (409, 412) are not retried, they
+# would fail again the same way.
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+
+
+def get_retry_after(response):
+    """Returns the number of seconds to wait given by the `Retry-After` header of `response`, or None."""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+
+    if value.strip().isdigit():
+        return float(value)
+
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.)
+    except (TypeError, ValueError):
+        return None
+
+
+class UploadController:
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=16, bundle_size=20, min_bundle_size=1,
+                 max_bundle_size=200, max_bundle_bytes=32 * 1024 * 1024, latency_tolerance=3., max_retries=5):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.bundle_size = float(bundle_size)
+        self.min_bundle_size = min_bundle_size
+        self.max_bundle_size = max_bundle_size
+        self.max_bundle_bytes = max_bundle_bytes
+        self.latency_tolerance = latency_tolerance
+        self.max_retries = max_retries
+
+        self.in_flight = 0
+        self.paused_until = 0.
+        self.__latencies = {}
+        self.__last_decrease = 0.
+        self.__overload_limit = None
+        self.__overload_bundle_size = None
+        self.__condition = threading.Condition()
+
+    def get_bundle_size(self):
+        return int(self.bundle_size)
+
+    def acquire(self):
+        """Waits until one more request can be sent."""
+        with self.__condition:
+            while True:
+                pause = self.paused_until - time.time()
+                if pause <= 0 and self.in_flight < int(self.limit):
+                    break
+
+                self.__condition.wait(pause if pause > 0 else None)
+
+            self.in_flight += 1
+
+    def release(self, latency=None, entries=1, failed=False, retry_after=None, rejected=False):
+        """Records the outcome of a request sent after `acquire`: its `latency` and number of resources, whether it
+        `failed` because the server is overloaded, and the `Retry-After` of the response. A request `rejected` for
+        another reason (e.g. 400 or 422, an invalid resource) says nothing of the load of the server and changes
+        neither the concurrency nor the batch size."""
+        with self.__condition:
+            self.in_flight -= 1
+            if rejected:
+                self.__condition.notify_all()
+                return
+
+            now = time.time()
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+                metrics.increment("upload_backoffs_total", reason="retry-after")
+
+            congested = False
+            if not failed and latency is not None:
+                # The recent latency per resource is compared to its long term average, both averaged over requests
+                # of about the same size (a power of 2) as small requests take longer per resource.
+                per_entry = latency / max(entries, 1)
+                size = max(entries, 1).bit_length()
+                recent, baseline = self.__latencies.get(size, (per_entry, per_entry))
+                recent = 0.8 * recent + 0.2 * per_entry
+                baseline = 0.99 * baseline + 0.01 * per_entry
+                self.__latencies[size] = (recent, baseline)
+                congested = recent > self.latency_tolerance * baseline
+
+            if failed or congested:
+                # Requests sent before the decrease fail or are slow as well, only one decrease per round trip. A
+                # server asking to retry later is limiting the request rate, the Bundles are not too large.
+                if now - self.__last_decrease > (latency or 0.):
+                    self.__overload_limit = self.limit
+                    self.limit = max(self.limit / 2, self.min_limit)
+                    if retry_after is None:
+                        self.__overload_bundle_size = self.bundle_size
+                        self.bundle_size = max(self.bundle_size / 2, self.min_bundle_size)
+
+                    self.__last_decrease = now
+                    metrics.increment("upload_backoffs_total", reason="error" if failed else "latency")
+            else:
+                # About one more request in flight per round of `limit` successful requests and one more resource per
+                # Bundle per request, ten times less close to the values at which the server was last overloaded.
+                self.limit = min(self.limit + self.__get_step(1 / self.limit, self.limit, self.__overload_limit),
+                                 self.max_limit)
+                self.bundle_size = min(self.bundle_size + self.__get_step(1, self.bundle_size,
+                                                                          self.__overload_bundle_size),
+                                       self.max_bundle_size)
+
+            self.__condition.notify_all()
+
+    @staticmethod
+    def __get_step(step, value, overload_value):
+        if overload_value is not None and value > 0.8 * overload_value:
+            return step / 10
+
+        return step
+
+    def get_backoff(self, attempt):
+        """Seconds to wait before sending a request again, when the server did not say."""
+        return min(0.5 * 2 ** attempt, 30.)
@@ -1,3 +1,7 @@
+import base64
+import hashlib
+import pickle
+
 from fhir.resources.codeableconcept import CodeableConcept
 from fhir.resources.resource import Resource
 
@@ -25,6 +29,33 @@ def get_codeable_reference(resource: Resource, code: [CodeableConcept, None, str
     return codeable_reference
 
 
+def get_pickle_attachment(data):
+    """Encodes data as a base64 python-pickle Attachment, with the size and SHA-1 hash of the pickled bytes."""
+    payload = pickle.dumps(data)
+    return {"contentType": "application/python-pickle",
+            "data": base64.encodebytes(payload).decode("utf-8"),
+            "size": len(payload),
+            "hash": base64.b64encode(hashlib.sha1(payload).digest()).decode("utf-8")}
+
+
+def get_attachment_payload(attachment):
+    """Returns the pickled bytes of a python-pickle Attachment (as returned by the server, i.e. a dict)."""
+    if attachment.get("contentType") != "application/python-pickle":
+        raise RuntimeError(f"Unsupported attachment content type {attachment.get('contentType')}")
+
+    return base64.b64decode(attachment["data"])
+
+
+def read_pickle_payload(payload):
+    """Decodes the pickled bytes of a python-pickle Attachment, see `get_attachment_payload`."""
+    return pickle.loads(payload)
+
+
+def read_pickle_attachment(attachment):
+    """Decodes the data of a python-pickle Attachment (as returned by the server, i.e. a dict)."""
+    return read_pickle_payload(get_attachment_payload(attachment))
+
+
 def get_file_name(content_disposition):
     list_cd = [item.strip().split("=") for item in content_disposition.split(";")]
 